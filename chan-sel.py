@@ -6,19 +6,17 @@ Perform necessary run/channel selection bookkeeping for
 ===================== C. Wiseman (USC) =====================
 """
 import sys, os, time
-import tinydb as db
 import numpy as np
 
 # LAT libraries
 import dsi
-bkg = dsi.BkgInfo()
-cal = dsi.CalInfo()
-det = dsi.DetInfo()
+bkg, cal, det = dsi.bkg, dsi.cal, dsi.det # loaded on first use
 
 def main(argv):
 
     ds, cIdx, mod = None, None, None
     writeDB = False
+    nProc = None
 
     # NOTE: the options also outline a rough 'procedure' to use this code.
     for i, opt in enumerate(argv):
@@ -31,13 +29,15 @@ def main(argv):
             cIdx = int(argv[i+2])
         if opt=="-m":
             mod = int(argv[i+1])
+        if opt=="-n":
+            nProc = int(argv[i+1])
         if opt=="-db":
             print("Adding results to DB ...")
             writeDB = True
 
         # scan datasets for trapThresh and HV changes.
         if opt=="-set":
-            settingsMgr(ds,cIdx,mod,writeDB)
+            settingsMgr(ds,cIdx,mod,writeDB,nProc)
         if opt == "-d":
             dumpSettings(ds)
 
@@ -136,12 +136,15 @@ def spotCheckThresh():
             print(ch, detCPD, detID, threshHG)
 
 
-def settingsMgr(dsIn=None, subIn=None, modIn=None, writeDB=False):
-    """ ./chan-sel.py [-ds [dsNum]] [-cidx [dsNum] [cIdx]] [-m [modNum]] -set
+def settingsMgr(dsIn=None, subIn=None, modIn=None, writeDB=False, nProc=None):
+    """ ./chan-sel.py [-ds [dsNum]] [-cidx [dsNum] [cIdx]] [-m [modNum]] [-n [nProc]] -set
     Manages which ds and cIdx's we call getSettings for.
     """
     global pMons, detCH # these are updated within getSettings
 
+    # write the DB records once per dataset, instead of re-writing the file for each one
+    calDB = dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir) if writeDB else None
+
     # loop over datasets
     for ds in [0,1,2,3,4,5,6]:
         if dsIn is not None and ds!=dsIn:
@@ -151,6 +154,18 @@ def settingsMgr(dsIn=None, subIn=None, modIn=None, writeDB=False):
         pMons = set()
         detCH = {d:[] for d in det.allDets} # analysis channel (HG) setting
 
+        # read all the runs of this DS at once, so the process pool stays busy.
+        # getSettings then finds them in the cache.
+        runList = set()
+        for key in cal.GetKeys(ds):
+            if modIn is not None and "m%d" % modIn not in key:
+                continue
+            for cIdx in range(cal.GetIdxs(key)):
+                if subIn is None or cIdx==subIn:
+                    runList.update(getSettingsRunList(ds, key, cIdx))
+        if len(runList) > 0:
+            scanRunSettings(sorted(runList), nProc)
+
         # loop over keys in this DS
         for key in cal.GetKeys(ds):
 
@@ -166,13 +181,130 @@ def settingsMgr(dsIn=None, subIn=None, modIn=None, writeDB=False):
                     continue
 
                 # now that ds, cIdx, and module are determined, we can call getSettings
-                getSettings(ds, key, mod, cIdx, writeDB)
+                getSettings(ds, key, mod, cIdx, writeDB, calDB, nProc)
+
+        if writeDB: calDB.commit()
 
         print("DS:%d settings found." % ds)
         np.savez("./data/ds%d_detChans.npz" % ds, detCH, pMons)
 
 
-def getSettings(ds, key, mod, cIdx, writeDB=False):
+def getSettingsRunList(ds, key, cIdx):
+    """ Runs scanned by getSettings for one calIdx. """
+    # We only want to access the cal and GOOD bkg runs that fall in this run list,
+    # and also assert that HV values do NOT change during calibration runs.  (why would they?)
+    # These decisions are made to save processing time.
+    runList = []
+    calLo, calHi = cal.GetCalRunCoverage(key,cIdx)
+    for run in bkg.getRunList(ds):
+        if (calLo <= run <= calHi):
+            runList.append(run)
+    calList = cal.GetCalList(key,cIdx)
+    runList.append(calList[0])
+    runList = sorted(runList) # if the cal run isn't before the bkg runs, it's not the first run in this list
+    return runList
+
+
+def readRunSettings(args):
+    """ Digest of the ChannelSettings/ChannelMap of one gatified run file.
+    Runs in a worker process of scanRunSettings.  Returns [run, digest]:
+        {"stamp":[size, mtime], "pMons":[chans], "chans":[[ch, detID, threshHG, hvActual], ...]}
+    in the order of GetEnabledIDList.  digest is None if the settings objects aren't in the file.
+    """
+    from ROOT import TFile, MJTChannelMap, MJTChannelSettings
+    run, fname = args
+    st = os.stat(fname)
+    tf = TFile(fname)
+
+    # make sure ChannelSettings and ChannelMap exist in this file
+    objs = [key.GetName() for key in tf.GetListOfKeys()]
+    if "ChannelSettings" not in objs or "ChannelMap" not in objs:
+        print("Settings objects not found in file:",fname)
+        tf.Close()
+        return [run, {"stamp":[st.st_size, st.st_mtime], "pMons":None, "chans":None}]
+    chSet = tf.Get("ChannelSettings")
+    chMap = tf.Get("ChannelMap")
+
+    chPulser = chMap.GetPulserChanList()
+    dig = {"stamp":[st.st_size, st.st_mtime], "pMons":[int(chPulser[i]) for i in range(len(chPulser))], "chans":[]}
+
+    for ch in chSet.GetEnabledIDList():
+        detCPD = chMap.GetString(ch,"kStringName")+"D"+str(chMap.GetInt(ch,"kDetectorPosition"))
+        detID = ''.join(i for i in detCPD if i.isdigit())
+        if detID == '0':
+            dig["chans"].append([int(ch), detID, 0, 0])
+            continue
+
+        # access threshold and HV settings
+        gretCrate = chMap.GetInt(ch,"kVME")
+        gretCard = chMap.GetInt(ch,"kCardSlot")
+        gretHG = chMap.GetInt(ch,"kChanHi")
+        threshHG = chSet.GetInt("TRAP Threshold",gretCrate,gretCard,gretHG,"ORGretina4MModel")
+
+        hvCrate = chMap.GetInt(ch,"kHVCrate")
+        hvCard = chMap.GetInt(ch,"kHVCard")
+        hvChan = chMap.GetInt(ch,"kHVChan")
+        hvActual = chSet.GetInt("targets",hvCrate,hvCard,hvChan,"OREHS8260pModel")
+
+        dig["chans"].append([int(ch), detID, int(threshHG), int(hvActual)])
+
+    tf.Close()
+    return [run, dig]
+
+
+def scanRunSettings(runList, nProc=None):
+    """ Returns {run:digest} (see readRunSettings) for the runs in runList.
+    Digests are cached in $LATDATADIR/runSettingsCache.json, and a run file is only
+    opened (in a process pool) if it isn't in the cache, or changed since it was read.
+    Missing and blind runs are skipped, and not cached.
+    """
+    import json
+    from multiprocessing import Pool
+    from ROOT import GATDataSet
+
+    cacheFile = "%s/runSettingsCache.json" % dsi.dataDir
+    cache = {}
+    if os.path.isfile(cacheFile):
+        with open(cacheFile) as f:
+            cache = {int(run):dig for run, dig in json.load(f).items()}
+
+    # use GDS once just to pull out the path.
+    gds = GATDataSet()
+    runPath = gds.GetPathToRun(runList[0],GATDataSet.kGatified)
+    filePath = '/'.join(runPath.split('/')[:-1])
+
+    digests, toRead = {}, []
+    for run in runList:
+
+        # make sure file exists and it's not blind before trying to load it
+        fname = filePath + "/mjd_run%d.root" % run
+        if not os.path.isfile(fname) or not os.access(fname, os.R_OK):
+            continue
+        st = os.stat(fname)
+        dig = cache.get(run)
+        if dig is not None and dig["stamp"] == [st.st_size, st.st_mtime]:
+            digests[run] = dig
+        else:
+            toRead.append((run, fname))
+
+    if len(toRead) > 0:
+        print("Reading settings from %d of %d runs ..." % (len(toRead), len(runList)))
+        pool = Pool(nProc)
+        for run, dig in pool.imap_unordered(readRunSettings, toRead):
+            cache[run] = dig
+            digests[run] = dig
+        pool.close()
+        pool.join()
+        tmpFile = "%s.%d.tmp" % (cacheFile, os.getpid())
+        with open(tmpFile, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmpFile, cacheFile)
+
+    # runs w/o settings objects are in the cache, but not in the results
+    return {run:dig for run, dig in digests.items() if dig["chans"] is not None}
+
+
+def getSettings(ds, key, mod, cIdx, writeDB=False, calDB=None, nProc=None):
     """
     Scan datasets for trapThresh and HV changes.
     Go by cIdx and write entries to calDB-v2.json.
@@ -183,8 +315,10 @@ def getSettings(ds, key, mod, cIdx, writeDB=False):
 
     HV Thresholds:
         {"key":"hvBias_[key]_c[cIdx]", "value": {det:[(run1,thr1),(run2,thr2)...]} }
+
+    If 'calDB' (a dsi.CalDB) is given, the caller is responsible for calDB.commit().
+    The run files are read by scanRunSettings, so only runs not in the settings cache are opened.
     """
-    from ROOT import GATDataSet, TFile, MJTChannelMap, MJTChannelSettings
     global pMons, detCH
 
     # this is the data we're gonna save
@@ -193,68 +327,28 @@ def getSettings(ds, key, mod, cIdx, writeDB=False):
     detTH = {d:[] for d in det.allDets} # trap threshold setting
     detHV = {d:[] for d in det.allDets} # HV bias setting
 
-    # We only want to access the cal and GOOD bkg runs that fall in this run list,
-    # and also assert that HV values do NOT change during calibration runs.  (why would they?)
-    # These decisions are made to save processing time.
-    runList = []
-    calLo, calHi = cal.GetCalRunCoverage(key,cIdx)
-    for run in bkg.getRunList(ds):
-        if (calLo <= run <= calHi):
-            runList.append(run)
-    calList = cal.GetCalList(key,cIdx)
-    runList.append(calList[0])
-    runList = sorted(runList) # if the cal run isn't before the bkg runs, it's not the first run in this list
+    runList = getSettingsRunList(ds, key, cIdx)
 
     print("\nDS%d M%d (%s) cIdx %d (%d runs) %s %s" % (ds,mod,key,cIdx,len(runList),dbKeyTH,dbKeyHV))
 
-    # use GDS once just to pull out the path.
-    gds = GATDataSet()
-    runPath = gds.GetPathToRun(runList[0],GATDataSet.kGatified)
-    filePath = '/'.join(runPath.split('/')[:-1])
-
-    # track time per run so we can identify slowdowns on PDSF
+    # read the settings of each run (in parallel, only opening runs that aren't cached yet)
     start = time.time()
+    digests = scanRunSettings(runList, nProc)
 
-    # begin loop over runs
-    for idx, run in enumerate(runList):
-
-        # print progress
-        # f = np.fabs(100*idx/len(runList) % 10)
-        # if f < 0.5:
-        #     print("%d/%d (run %d) %.1f%% done." % (idx, len(runList), run, 100*idx/len(runList)))
-
-        # make sure file exists and it's not blind before trying to load it
-        fname = filePath + "/mjd_run%d.root" % run
-        if not os.path.isfile(fname):
-            # print("Couldn't find run",run,":",fname)
-            continue
-        if not os.access(fname, os.R_OK):
-            # print("File is blind:",fname)
-            continue
-        tf = TFile(fname)
-
-        # make sure ChannelSettings and ChannelMap exist in this file
-        objs = [key.GetName() for key in tf.GetListOfKeys()]
-        if "ChannelSettings" not in objs or "ChannelMap" not in objs:
-            print("Settings objects not found in file:",fname)
-            tf.Close()
+    # derive the change points from the per-run digests
+    for run in runList:
+        dig = digests.get(run)
+        if dig is None:
             continue
-        chSet = tf.Get("ChannelSettings")
-        chMap = tf.Get("ChannelMap")
 
         # load pulser monitor channel list
-        chPulser = chMap.GetPulserChanList()
-        chPulser = [chPulser[i] for i in range(len(chPulser))]
+        chPulser = list(dig["pMons"])
         if ds == 1: chPulser.extend([674, 675, 677]) # 674, 675, 677 are not in the MJTChannelMap's due to a bug
         pMons.update(chPulser)
 
         # loop over enabled channels
         thrReset = False
-        for ch in chSet.GetEnabledIDList():
-
-            detName = chMap.GetString(ch, "kDetectorName")
-            detCPD = chMap.GetString(ch,"kStringName")+"D"+str(chMap.GetInt(ch,"kDetectorPosition"))
-            detID = ''.join(i for i in detCPD if i.isdigit())
+        for ch, detID, threshHG, hvActual in dig["chans"]:
 
             # skip pulser monitors / special channels
             if detID == '0':
@@ -263,24 +357,6 @@ def getSettings(ds, key, mod, cIdx, writeDB=False):
                     pMons.add(ch)
                 continue
 
-            # access threshold and HV settings
-            gretCrate = chMap.GetInt(ch,"kVME")
-            gretCard = chMap.GetInt(ch,"kCardSlot")
-            gretHG = chMap.GetInt(ch,"kChanHi")
-            gretLG = chMap.GetInt(ch,"kChanLo")
-            threshHG = chSet.GetInt("TRAP Threshold",gretCrate,gretCard,gretHG,"ORGretina4MModel")
-            threshLG = chSet.GetInt("TRAP Threshold",gretCrate,gretCard,gretLG,"ORGretina4MModel")
-            # print(ch, detCPD, detID, gretCrate, gretCard, gretHG, gretLG)
-            # if detCPD=='C1P2D2':
-                # print(ch, detCPD, detID, threshHG)
-
-            hvCrate = chMap.GetInt(ch,"kHVCrate")
-            hvCard = chMap.GetInt(ch,"kHVCard")
-            hvChan = chMap.GetInt(ch,"kHVChan")
-            hvTarget = chMap.GetInt(ch,"kMaxVoltage")
-            hvActual = chSet.GetInt("targets",hvCrate,hvCard,hvChan,"OREHS8260pModel")
-            # print(ch, detCPD, detID, hvCrate, hvCard, hvChan, hvTarget, hvActual)
-
             # fill our data objects
             thisTH = (run, threshHG) # NOTE: HG only
             thisHV = (run, hvActual)
@@ -319,9 +395,6 @@ def getSettings(ds, key, mod, cIdx, writeDB=False):
         if thrReset:
             print("Thresholds reset, run %d" % run)
 
-        tf.Close()
-        # return # limit to 1 run
-
     # note the time elapsed
     timeElapsed = time.time()-start
     print("Elapsed: %.4f sec, %.4f sec/run" % (timeElapsed, timeElapsed/len(runList)))
@@ -334,10 +407,13 @@ def getSettings(ds, key, mod, cIdx, writeDB=False):
 
     # fill the DB
     if writeDB:
-        calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-        pars = db.Query()
-        dsi.setDBRecord({"key":dbKeyTH, "vals":detTH}, forceUpdate=True, calDB=calDB, pars=pars)
-        dsi.setDBRecord({"key":dbKeyHV, "vals":detHV}, forceUpdate=True, calDB=calDB, pars=pars)
+        if calDB is None:
+            with dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir) as calDB:
+                dsi.setDBRecord({"key":dbKeyTH, "vals":detTH}, forceUpdate=True, calDB=calDB)
+                dsi.setDBRecord({"key":dbKeyHV, "vals":detHV}, forceUpdate=True, calDB=calDB)
+        else:
+            dsi.setDBRecord({"key":dbKeyTH, "vals":detTH}, forceUpdate=True, calDB=calDB)
+            dsi.setDBRecord({"key":dbKeyHV, "vals":detHV}, forceUpdate=True, calDB=calDB)
         print("DB filled.")
 
 
@@ -357,8 +433,7 @@ def dumpSettings(ds):
     #     print(key, detCH[key])
 
     # get HV and TF vals from DB with a regex
-    calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    pars = db.Query()
+    calDB = dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir)
     #
     # print("DB Threshold values:")
     # thrList = calDB.search(pars.key.matches("trapThr_ds%d" % ds))
@@ -380,7 +455,7 @@ def dumpSettings(ds):
 
     # get a particular key
     dbKeyTH = "trapThr_ds0_m1_c23"
-    dbValTH = dsi.getDBRecord(dbKeyTH,calDB=calDB,pars=pars)
+    dbValTH = dsi.getDBRecord(dbKeyTH,calDB=calDB)
 
     # debug: print the values
     for val in sorted(dbValTH):
@@ -410,9 +485,8 @@ def fillDetInfo():
     detHV, detTH = {}, {}
 
     # load all possible values, as in settingsMgr
-    detDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    detPars = db.Query()
-    cal = dsi.CalInfo()
+    detDB = dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir)
+    cal = dsi.getCalInfo()
     for ds in [0,1,2,3,4,5,6]:
     # for ds in [3]:
         print("scanning ds",ds)
@@ -426,10 +500,10 @@ def fillDetInfo():
 
                 # load the DB records
                 dbKeyTH = "trapThr_%s_c%d" % (key, cIdx)
-                dbValTH = dsi.getDBRecord(dbKeyTH,calDB=detDB,pars=detPars)
+                dbValTH = dsi.getDBRecord(dbKeyTH,calDB=detDB)
 
                 dbKeyHV = "hvBias_%s_c%d" % (key, cIdx)
-                dbValHV = dsi.getDBRecord(dbKeyHV,calDB=detDB,pars=detPars)
+                dbValHV = dsi.getDBRecord(dbKeyHV,calDB=detDB)
 
                 # debug: print the record
                 # for val in sorted(dbValTH):
@@ -552,6 +626,8 @@ def getSubRanges():
         1) Thresholds changed ==> identify bkgIdx & output sub-ranges s/t we can re-run auto-thresh.
         TODO: 2) HV changed - identify bkgIdx and calIdx
     Use the result to make some decisions about data ranges.
+    The settings of every run in a dataset are put in (run x detector) matrices,
+    and the change points come from one diff over each matrix.
     """
     verbose = False
 
@@ -568,65 +644,59 @@ def getSubRanges():
             dsNum = ds
         if verbose: print("DS:",ds)
 
-        # loop over subsets
+        # all runs in the dataset, and the subset each one belongs to
         ranges = bkg.getRanges(ds)
+        runs, subs = [], []
         for sub in ranges:
-            # print(ds,sub)
-            # if sub!=37: continue
             runList = bkg.getRunList(ds,sub)
-
-            # if verbose: print("sub:%d  runLo %d  runHi %d  nRuns %d" % (sub, runList[0], runList[-1], len(runList)))
-
-            # continue
-
-            # these are how we have to divide the given subset.
-            thLo, thHi = runList[0], runList[-1]
-            hvLo, hvHi = runList[0], runList[-1]
-
-            # bookkeeping vars
-            thReset, hvReset = False, False
-            nHV, nTh = 0, 0
-            prevTh = det.getTrapThreshAtRun(dsNum, runList[0]) # these interpolate between runs
-            prevHV = det.getHVAtRun(dsNum, runList[0])         #
+            runs.extend(runList)
+            subs.extend([sub]*len(runList))
+        runs, subs = np.asarray(runs), np.asarray(subs)
+        if len(runs)==0: continue
+
+        # settings matrices (these interpolate between runs), and the change points.
+        # a change at row i means run i has different settings than run i-1, in the same subset.
+        cpdList, thMat = det.getSettingMatrix(dsNum, runs, "th")
+        cpdHV, hvMat = det.getSettingMatrix(dsNum, runs, "hv")
+        sameSub = subs[1:] == subs[:-1]
+        thChg = np.flatnonzero(np.any(np.diff(thMat, axis=0) != 0, axis=1) & sameSub) + 1
+        hvDiff = np.diff(hvMat, axis=0) != 0
+        hvChg = np.flatnonzero(np.any(hvDiff, axis=1) & sameSub) + 1
+        m1Col = np.asarray([cpd[0]=='1' for cpd in cpdHV], dtype=bool)
+        m2Col = np.asarray([cpd[0]=='2' for cpd in cpdHV], dtype=bool)
+
+        # row range of each subset
+        subBounds = np.flatnonzero(np.concatenate(([True], subs[1:] != subs[:-1], [True])))
+
+        for iLo, iHi in zip(subBounds[:-1], subBounds[1:]):
+            sub = int(subs[iLo])
             tmpThreshRanges = []
             tmpCutTuneRanges = []
 
-            # loop over runs
-            for idx, run in enumerate(runList):
-                # print(run)
-                nHV += 1
-                nTh += 1
-
-                th = det.getTrapThreshAtRun(dsNum,run)
-                hv = det.getHVAtRun(dsNum,run)
-
-                # check for thresh change
-                if th != prevTh:
-                    nDet = 0
-                    for cpd in sorted(th):
-                        if prevTh[cpd] != th[cpd]:
-                            nDet += 1
-                            # this is REALLY verbose.  but allows you to see the actual changing values.
-                            # if verbose: print("  Thr change, run %d, det %s (%s), %d -> %d" % (run,cpd,det.getCPDChan(dsNum,cpd),prevTh[cpd],th[cpd]))
-                    thReset = True
-                    thHi = runList[idx-1]
-                    # print("  thLo %d  thHi %d  (%d runs)" % (thLo, thHi, nTh-1))
-                    tmpThreshRanges.append((ds,sub,thLo,thHi,nTh-1))
-                    thLo = runList[idx]
-                    prevTh = th
-                    nTh = 1
-
-                # check for HV change
-                if hv != prevHV:
-                    m1Chg, m2Chg = False, False
-                    for cpd in sorted(hv):
-                        if prevHV[cpd] != hv[cpd]:
-                            if verbose: print("  HV change, run %d, det %s (%s), %dV -> %dV.  nRuns: %d" % (run,cpd,det.getCPDChan(dsNum,cpd),prevHV[cpd],hv[cpd],nHV-1))
-                            if cpd[0]=='1': m1Chg = True
-                            if cpd[0]=='2': m2Chg = True
-                    hvReset = True
-                    hvHi = runList[idx-1]
-                    # print("  hvLo %d  hvHi %d  (%d runs)" % (hvLo, hvHi, nHV-1))
+            # thresh sub-ranges: (ds, sub, runLo, runHi, nRuns)
+            chg = thChg[(thChg > iLo) & (thChg < iHi)]
+            if len(chg) > 0:
+                edges = np.concatenate(([iLo], chg, [iHi]))
+                for lo, hi in zip(edges[:-1], edges[1:]):
+                    tmpThreshRanges.append((ds, sub, int(runs[lo]), int(runs[hi-1]), int(hi-lo)))
+
+                if verbose:
+                    print("  thresh sub-ranges:")
+                    for val in tmpThreshRanges:
+                        print(" ",val)
+
+            # HV sub-ranges: (ds, sub, runLo, runHi, nRuns, calIdx)
+            chg = hvChg[(hvChg > iLo) & (hvChg < iHi)]
+            if len(chg) > 0:
+                edges = np.concatenate(([iLo], chg, [iHi]))
+                for j in range(len(chg)):
+                    lo, hi, run = edges[j], edges[j+1], int(runs[chg[j]])
+                    cols = hvDiff[chg[j]-1]
+                    m1Chg, m2Chg = bool(np.any(cols & m1Col)), bool(np.any(cols & m2Col))
+                    if verbose:
+                        for c in np.flatnonzero(cols):
+                            cpd = cpdHV[c]
+                            print("  HV change, run %d, det %s (%s), %dV -> %dV.  nRuns: %d" % (run,cpd,det.getCPDChan(dsNum,cpd),hvMat[chg[j]-1,c],hvMat[chg[j],c],hi-lo))
 
                     # identify calIdx of this run
                     if ds not in ["5A","5B"]:
@@ -637,33 +707,16 @@ def getSubRanges():
                         m2Cal = cal.GetCalIdx("ds%d_m2" % dsNum, run)
                         calIdx = (m1Cal, m2Cal, m1Chg, m2Chg) # 4 vals, distinguish between modules.  ugh
 
-                    tmpCutTuneRanges.append((ds,sub,hvLo,hvHi,nHV-1,calIdx))
-
-                    hvLo = runList[idx]
-                    prevHV = hv
-                    nHV = 1
+                    tmpCutTuneRanges.append((ds,sub,int(runs[lo]),int(runs[hi-1]),int(hi-lo),calIdx))
 
-            # final cleanup and output
-            if hvReset:
-                hvHi = runList[-1]
-                # print("  hvLo %d  hvHi %d  (%d runs)" % (hvLo, hvHi, nHV))
-                tmpCutTuneRanges.append((ds, sub, hvLo,hvHi,nHV,calIdx))
+                # the last range gets the calIdx of the last change
+                tmpCutTuneRanges.append((ds,sub,int(runs[edges[-2]]),int(runs[iHi-1]),int(iHi-edges[-2]),calIdx))
 
                 if verbose:
                     print("  HV sub-ranges:")
                     for val in tmpCutTuneRanges:
                         print(" ",val)
 
-            if thReset:
-                thHi = runList[-1]
-                # print("  thLo %d  thHi %d  (%d runs)" % (thLo, thHi, nTh))
-                tmpThreshRanges.append((ds, sub,thLo,thHi,nTh))
-
-                if verbose:
-                    print("  thresh sub-ranges:")
-                    for val in tmpThreshRanges:
-                        print(" ",val)
-
             # extend master lists
             if len(tmpThreshRanges) > 0: thRanges.extend(tmpThreshRanges)
             if len(tmpCutTuneRanges) > 0: hvRanges.extend(tmpCutTuneRanges)
@@ -708,9 +761,8 @@ def fillThreshDB():
     # Do we actually want to write new values?  Or just print stuff out?
     fillDB = True
 
-    calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    pars = db.Query()
-    bkg = dsi.BkgInfo()
+    calDB = dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir)
+    bkg = dsi.getBkgInfo()
 
     # loop over datasets and bkgIdx
     for ds in [0,1,2,3,4,"5A","5B","5C",6]:
@@ -735,6 +787,7 @@ def fillThreshDB():
                     fname = "%s/threshDS%d_%d.root" % (dsi.threshDir, dsNum, bkgIdx)
                 if not os.path.isfile(fname):
                     print("Couldn't find file:",fname)
+                    calDB.commit()
                     return
                 tf = TFile(fname)
                 tt = tf.Get("threshTree")
@@ -745,6 +798,7 @@ def fillThreshDB():
                     continue
                 if (n!=1):
                     print("Hmm, %d thresh table entries? %s" % (n, fname))
+                    calDB.commit()
                     return
                 tt.GetEntry(0)
 
@@ -815,16 +869,18 @@ def fillThreshDB():
 
                 # fill the DB
                 if fillDB:
-                    dsi.setDBRecord({"key":key, "vals":vals}, forceUpdate=True, calDB=calDB, pars=pars)
+                    dsi.setDBRecord({"key":key, "vals":vals}, forceUpdate=True, calDB=calDB)
 
                 tf.Close()
                 # return
 
+    # write all the new records at once
+    calDB.commit()
+
 
 def getThreshDB():
-    calDB = db.TinyDB("%s/calDB-v2.json" % dsi.latSWDir)
-    pars = db.Query()
-    bkg = dsi.BkgInfo()
+    calDB = dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir)
+    bkg = dsi.getBkgInfo()
 
     # loop over datasets
     for ds in [0,1,2,3,4,5,6]:
@@ -1,14 +1,13 @@
 #!/usr/bin/env python
-import sys, os
+import sys, os, json, time
 sys.argv.append("-b")
 import tinydb as db
+from multiprocessing import Pool, TimeoutError as PoolTimeout
 import numpy as np
 
 import waveLibs as wl
 import dsi
-bkg = dsi.BkgInfo()
-cal = dsi.CalInfo()
-det = dsi.DetInfo()
+bkg, cal, det = dsi.bkg, dsi.cal, dsi.det # loaded on first use
 
 from ROOT import TFile, TTree, MGTWaveform
 
@@ -17,6 +16,9 @@ fLimit = None    # set to None to run over everything
 skipDS6Cal = True
 verbose = True
 testMode = False
+nProc = None     # size of the process pool (None: all cores)
+forceCheck = False # re-check files even if they haven't changed since the last check
+checkTimeout = 600 # sec.  A file that takes longer (or crashes its worker, ex. a ROOT segfault) is marked bad
 
 def main(argv):
     """ NOTE: don't use globs when getting files.
@@ -24,18 +26,23 @@ def main(argv):
     Can submit these commands as separate batch jobs:
         ./check-files.py -all
         ./check-files.py -c -all
+    Options [-n nProc], [-f] (re-check unchanged files) and [-to timeout (sec)] must come first.
     """
-    global checkCal
+    global checkCal, nProc, forceCheck, checkTimeout
     checkCal = False
     if checkCal: print("Skip DS6 cal?",skipDS6Cal)
     if testMode: print("Test mode active.")
 
     for i,opt in enumerate(argv):
         if opt == "-c": checkCal = True
+        if opt == "-n": nProc = int(argv[i+1])
+        if opt == "-f": forceCheck = True
+        if opt == "-to": checkTimeout = int(argv[i+1])
         if opt == "-s": checkSkim()
         if opt == "-w": checkWave()
         if opt == "-p": checkSplit()
         if opt == "-l": checkLAT()
+        if opt == "-r": reconcile()
         if opt == "-all":
             checkSkim()
             checkWave()
@@ -50,7 +57,7 @@ def checkSkim():
     print("Checking skims.  Cal?", checkCal)
 
     # make file list
-    fileList = []
+    fileList, missing = [], []
 
     # bkg
     if not checkCal:
@@ -62,6 +69,7 @@ def checkSkim():
                     fileList.append(fname)
                 else:
                     print("File not found:",fname)
+                    missing.append(fname)
                     continue
     # cal
     else:
@@ -76,6 +84,7 @@ def checkSkim():
                         fileList.append(fname)
                     else:
                         print("File not found:",fname)
+                        missing.append(fname)
                         continue
     if testMode:
         fileList = []
@@ -86,56 +95,14 @@ def checkSkim():
             fileList.append(fname)
 
 
-    # check first and last few entries of every file
-    for idx, fname in enumerate(fileList[:fLimit]):
-        f = TFile(fname)
-        t = f.Get("skimTree")
-        n = t.GetEntries()
-
-        if n==0:
-            print("No entries in file",fname)
-            continue
-
-        brSingle, brVector = [], []
-        for br in t.GetListOfBranches():
-            if "vector" in br.GetClassName():
-                brVector.append(br.GetName())
-            else:
-                brSingle.append(br.GetName())
-
-        if n < 20:
-            eList = np.arange(0,n,1)
-        else:
-            eList = np.arange(0,20,1)
-            eList = np.append(eList, np.arange(n-20,n,1))
-
-        for i in eList:
-            t.GetEntry(i)
-
-            # make sure individual entries are accessible (no segfaults)
-            for br in brSingle:
-                val = getattr(t,br)
-                # print(val)
-            for br in brVector:
-                try:
-                    nCh = getattr(t,br).size()
-                except AttributeError:
-                    print("Error:",br)
-                for j in range(nCh):
-                    val = getattr(t,br)[j]
-                    # print(br,nCh,val)
-
-        if verbose:
-            print("%d/%d  %s  nEnt %d" % (idx, len(fileList[:fLimit]), fname.split("/")[-1], t.GetEntries()))
-
-        f.Close()
+    runChecks("skim", fileList, missing)
 
 
 def checkWave():
     """ ./check-files.py [-c] -w """
     print("Checking waves.  Cal?", checkCal)
 
-    fileList = []
+    fileList, missing = [], []
 
     # bkg
     if not checkCal:
@@ -147,6 +114,7 @@ def checkWave():
                     fileList.append(fname)
                 else:
                     print("File not found:",fname)
+                    missing.append(fname)
                     continue
     # cal
     else:
@@ -161,6 +129,7 @@ def checkWave():
                         fileList.append(fname)
                     else:
                         print("File not found:",fname)
+                        missing.append(fname)
                         continue
     if testMode:
         fileList = []
@@ -171,15 +140,45 @@ def checkWave():
             fileList.append(fname)
 
 
-    # check first and last few entries of every file
-    for idx, fname in enumerate(fileList[:fLimit]):
+    runChecks("waves", fileList, missing)
+
+
+def checkFile(fname):
+    """ Verify one file: open it, and read every branch of the first and last 20 entries.
+    For wave and LAT files, also make sure the waveforms match their hits and can be processed.
+    Runs in a worker process of runChecks.  Returns [fname, record].
+    """
+    st = os.stat(fname)
+    rec = {"size":st.st_size, "mtime":st.st_mtime, "nEnt":0, "status":"ok", "errors":[], "checked":time.time()}
+
+    fName = os.path.basename(fname)
+    procWF = fName.startswith("waveSkim") or fName.startswith("latSkim")
+    m = dsi.catalogNames.match(fName)
+    ds = int(m.group(1)) if m is not None else -1
+    truncLo, truncHi = 0, 2
+    if ds==6 or ds==2: truncLo = 4
+
+    try:
         f = TFile(fname)
+        if f.IsZombie():
+            rec["status"] = "corrupt"
+            rec["errors"].append("can't open file")
+            return [fname, rec]
+        if f.TestBit(TFile.kRecovered):
+            rec["status"] = "corrupt"
+            rec["errors"].append("file wasn't closed properly (recovered keys)")
         t = f.Get("skimTree")
+        if not t:
+            rec["status"] = "corrupt"
+            rec["errors"].append("no skimTree")
+            f.Close()
+            return [fname, rec]
         n = t.GetEntries()
-
+        rec["nEnt"] = int(n)
         if n==0:
-            print("No entries in file",fname)
-            continue
+            rec["status"] = "empty"
+            f.Close()
+            return [fname, rec]
 
         brSingle, brVector = [], []
         for br in t.GetListOfBranches():
@@ -195,39 +194,118 @@ def checkWave():
             eList = np.append(eList, np.arange(n-20,n,1))
 
         for i in eList:
-            t.GetEntry(i)
+            if t.GetEntry(int(i)) <= 0:
+                rec["errors"].append("entry %d: couldn't read" % i)
+                continue
 
             # make sure individual entries are accessible (no segfaults)
             for br in brSingle:
                 val = getattr(t,br)
-                # print(val)
             for br in brVector:
                 try:
-                    nCh = getattr(t,br).size()
+                    vec = getattr(t,br)
+                    for j in range(vec.size()):
+                        val = vec[j]
                 except AttributeError:
-                    print("Error:",br)
-                for j in range(nCh):
-                    val = getattr(t,br)[j]
-                    # print(br,nCh,val)
+                    rec["errors"].append("entry %d: can't read branch %s" % (i, br))
+
+            if not procWF:
+                continue
 
             # make sure we can process waveforms
-            for j in range(nCh):
+            for j in range(t.channel.size()):
                 wf = t.MGTWaveforms.at(j)
                 ch = t.channel.at(j)
 
                 # be absolutely sure you're matching the right waveform to this hit
                 if wf.GetID() != ch:
-                    print("ERROR -- Vector matching failed. entry %d, file: %s" % (i, fname))
+                    rec["errors"].append("entry %d: vector matching failed" % i)
 
                 # run the LAT routine to convert into numpy arrays
-                truncLo, truncHi = 0, 2
-                if ds==6 or ds==2: truncLo = 4
                 signal = wl.processWaveform(wf, truncLo, truncHi)
 
-        if verbose:
-            print("%d/%d  %s  nEnt %d" % (idx, len(fileList[:fLimit]), fname.split("/")[-1], t.GetEntries()))
-
         f.Close()
+    except Exception as e:
+        rec["errors"].append("exception: %s" % str(e))
+
+    if len(rec["errors"]) > 0: rec["status"] = "corrupt"
+    return [fname, rec]
+
+
+def runChecks(stage, fileList, missing):
+    """ Check files in parallel, skipping ones that haven't changed since their last check.
+    Per-file records (size, mtime, nEnt, status) are kept in $LATDATADIR/checkFiles_[stage]_[bkg/cal].json.
+    Writes the bad and missing files to ./logs/checkReport_[stage]_[bkg/cal].json.
+    """
+    dType = "cal" if checkCal else "bkg"
+    recFile = "%s/checkFiles_%s_%s.json" % (dsi.dataDir, stage, dType)
+    records = {}
+    if os.path.isfile(recFile):
+        with open(recFile) as f:
+            records = json.load(f)
+
+    missing = list(missing)
+    for fname in fileList[:fLimit]:
+        if not os.path.isfile(fname) and fname not in missing:
+            missing.append(fname)
+    fileList = [f for f in fileList[:fLimit] if os.path.isfile(f)]
+    toCheck = []
+    for fname in fileList:
+        st = os.stat(fname)
+        rec = records.get(fname)
+        if forceCheck or rec is None or rec["size"]!=st.st_size or rec["mtime"]!=st.st_mtime:
+            toCheck.append(fname)
+    print("%d files: %d new or changed, %d already checked." % (len(fileList), len(toCheck), len(fileList)-len(toCheck)))
+
+    def saveRecords():
+        tmpFile = "%s.%d.tmp" % (recFile, os.getpid())
+        with open(tmpFile, "w") as f:
+            json.dump(records, f)
+        os.replace(tmpFile, recFile)
+
+    # one task per file, so a worker that crashes or hangs only costs that file: Pool replaces a dead
+    # worker, but never finishes its task, so we stop waiting after checkTimeout and mark the file bad.
+    # save the records every so often, so a killed job doesn't have to start over.
+    pool = Pool(nProc, maxtasksperchild=50)
+    results = [pool.apply_async(checkFile, (fname,)) for fname in toCheck]
+    nLost = 0
+    for idx, (fname, res) in enumerate(zip(toCheck, results)):
+        try:
+            fname, rec = res.get(checkTimeout)
+        except Exception as e: # PoolTimeout, or something checkFile didn't catch
+            nLost += 1
+            st = os.stat(fname)
+            why = "worker crashed or timed out (%d sec)" % checkTimeout if isinstance(e, PoolTimeout) else "exception: %s" % str(e)
+            rec = {"size":st.st_size, "mtime":st.st_mtime, "nEnt":0, "status":"corrupt", "errors":[why], "checked":time.time()}
+        records[fname] = rec
+        if verbose:
+            print("%d/%d  %s  nEnt %d  %s" % (idx, len(toCheck), fname.split("/")[-1], rec["nEnt"], rec["status"]))
+        for err in rec["errors"]:
+            print("   Error:",err)
+        if idx % 100 == 99: saveRecords()
+    if nLost > 0:
+        pool.terminate() # don't wait on hung workers
+    else:
+        pool.close()
+    pool.join()
+    saveRecords()
+
+    # pass the verified entry counts on to the file catalog
+    cat = dsi.getCatalog() # saved when we exit
+    for fname in fileList:
+        if records[fname]["status"] == "ok":
+            cat.setEntries(fname, records[fname]["nEnt"])
+
+    # machine-readable report
+    bad = [dict(path=f, **records[f]) for f in fileList if records[f]["status"] != "ok"]
+    report = {"stage":stage, "type":dType, "time":time.time(), "nFiles":len(fileList), "nChecked":len(toCheck),
+              "nOK":len(fileList)-len(bad), "bad":bad, "missing":missing}
+    repFile = "%s/logs/checkReport_%s_%s.json" % (dsi.latSWDir, stage, dType)
+    if not os.path.isdir(os.path.dirname(repFile)): os.makedirs(os.path.dirname(repFile))
+    with open(repFile, "w") as f:
+        json.dump(report, f, indent=2)
+    print("%s %s: %d ok, %d bad, %d missing.  Report: %s" % (stage, dType, report["nOK"], len(bad), len(missing), repFile))
+    return report
 
 
 def checkSplit():
@@ -335,7 +413,7 @@ def checkLAT():
     # repeat the checkWave checks
     print("Checking lats.  Cal?", checkCal)
 
-    fileList = []
+    fileList, missing = [], []
 
     # bkg
     if not checkCal:
@@ -347,6 +425,7 @@ def checkLAT():
                 latList = dsi.getSplitList("%s/latSkimDS%d_%d*" % (dsi.latDir, ds, sub), sub)
                 if len(sList) != len(latList):
                     print("Error: ds %d sub %d.  Found %d split files but %d lat files." % (ds,sub,len(sList),len(latList)))
+                    missing.extend(["%s/latSkimDS%d_%d_%d.root" % (dsi.latDir,ds,sub,i) for i in sList if i not in latList])
 
                 tmpList = [f for idx, f in sorted(latList.items())]
                 fileList.extend(tmpList)
@@ -364,6 +443,7 @@ def checkLAT():
                     latList = dsi.getSplitList("%s/latSkimDS%d_run%d*" % (dsi.calLatDir, ds, run), run)
                     if len(sList) != len(latList):
                         print("Error: ds %d  sub %d  run %d.  Found %d split files but %d lat files." % (ds,sub,run,len(sList),len(latList)))
+                        missing.extend(["%s/latSkimDS%d_run%d_%d.root" % (dsi.calLatDir,ds,run,i) for i in sList if i not in latList])
 
                     tmpList = [f for idx, f in sorted(latList.items())]
                     fileList.extend(tmpList)
@@ -384,63 +464,141 @@ def checkLAT():
                 fileList.extend([f for idx, f in sorted(latList.items())])
 
 
-    # loop over files, repeating the same checks in checkWave
-    for idx, fname in enumerate(fileList[:fLimit]):
-        f = TFile(fname)
-        t = f.Get("skimTree")
-        n = t.GetEntries()
+    runChecks("lat", fileList, missing)
 
-        if n==0:
-            print("No entries in file",fname)
-            continue
-
-        brSingle, brVector = [], []
-        for br in t.GetListOfBranches():
-            if "vector" in br.GetClassName():
-                brVector.append(br.GetName())
-            else:
-                brSingle.append(br.GetName())
-
-        if n < 20:
-            eList = np.arange(0,n,1)
-        else:
-            eList = np.arange(0,20,1)
-            eList = np.append(eList, np.arange(n-20,n,1))
-
-        for i in eList:
-            t.GetEntry(i)
-
-            # make sure individual entries are accessible (no segfaults)
-            for br in brSingle:
-                val = getattr(t,br)
-                # print(val)
-            for br in brVector:
-                try:
-                    nCh = getattr(t,br).size()
-                except AttributeError:
-                    print("Error:",br)
-                for j in range(nCh):
-                    val = getattr(t,br)[j]
-                    # print(br,nCh,val)
-
-            # make sure we can process waveforms
-            for j in range(nCh):
-                wf = t.MGTWaveforms.at(j)
-                ch = t.channel.at(j)
-
-                # be absolutely sure you're matching the right waveform to this hit
-                if wf.GetID() != ch:
-                    print("ERROR -- Vector matching failed. entry %d, file: %s" % (i, fname))
+def getPassCount(wFile, vFile, passCounts):
+    """ Number of waveSkim entries passing theCut, i.e. what should end up in the split and lat files.
+    Read from the virtual split file if it's newer than the waveSkim file, or from 'passCounts'
+    (a cache of {wFile:[size, mtime, nPass]}).  Otherwise builds theCut's entry list once and caches it.
+    Returns [nPass, {vIdx:nEvts} or None].
+    """
+    st = os.stat(wFile)
+    if os.path.isfile(vFile) and os.stat(vFile).st_mtime >= st.st_mtime:
+        f = np.load(vFile)
+        nEvts = f['arr_2']
+        return [int(nEvts.sum()), {i:int(n) for i, n in enumerate(nEvts)}]
+
+    rec = passCounts.get(wFile)
+    if rec is not None and rec[:2] == [st.st_size, st.st_mtime]:
+        return [rec[2], None]
+
+    f = TFile(wFile)
+    t = f.Get("skimTree")
+    nPass = len(dsi.getCutEntries(wFile, f.Get("theCut").GetTitle(), t)["evtList"])
+    f.Close()
+    passCounts[wFile] = [st.st_size, st.st_mtime, nPass]
+    return [nPass, None]
+
+
+def reconcileOne(ds, sub, run, passCounts):
+    """ Compare the entry counts of one waveSkim file w/ the sum over its split and lat files.
+    Uses only the tree headers (via the file catalog).  Returns a report row.
+    """
+    cat = dsi.getCatalog()
+    if run is None:
+        wFile = "%s/waveSkimDS%d_%d.root" % (dsi.waveDir, ds, sub)
+        vFile = "%s/vsplitDS%d_%d.npz" % (dsi.splitDir, ds, sub)
+    else:
+        wFile = "%s/waveSkimDS%d_run%d.root" % (dsi.calWaveDir, ds, run)
+        vFile = "%s/vsplitDS%d_run%d.npz" % (dsi.calSplitDir, ds, run)
+    sList = cat.getSplitList("split", ds, sub, run, checkCal)
+    latList = cat.getSplitList("lat", ds, sub, run, checkCal)
+
+    row = {"ds":ds, "sub":sub, "run":run, "nPass":None, "nSplit":None, "nLat":None, "errors":[]}
+    if not os.path.isfile(wFile):
+        row["errors"].append("missing wave file")
+        return row
+
+    nPass, vSplits = getPassCount(wFile, vFile, passCounts)
+    row["nPass"] = nPass
+    nSplit = {idx:cat.getEntries(f) for idx, f in sList.items()}
+    nLat = {idx:cat.getEntries(f) for idx, f in latList.items()}
+    row["nLat"] = sum(nLat.values())
+
+    # virtual splits: lat files come straight from the waveSkim file
+    if vSplits is not None and len(sList)==0:
+        for idx in sorted(vSplits):
+            if idx not in nLat:
+                row["errors"].append("split %d: missing lat file (%d entries)" % (idx, vSplits[idx]))
+            elif nLat[idx] != vSplits[idx]:
+                row["errors"].append("split %d: %d entries in range, %d in lat file" % (idx, vSplits[idx], nLat[idx]))
+        for idx in sorted(set(nLat) - set(vSplits)):
+            row["errors"].append("split %d: extra lat file" % idx)
+        return row
+
+    row["nSplit"] = sum(nSplit.values())
+    if len(sList)==0:
+        row["errors"].append("no split files")
+        return row
+    if row["nSplit"] != nPass:
+        row["errors"].append("wave->split: %d passing entries, %d in split files" % (nPass, row["nSplit"]))
+    for idx in range(max(sList)+1):
+        if idx not in sList:
+            row["errors"].append("split %d: missing split file" % idx)
+    for idx in sorted(nSplit):
+        if idx not in nLat:
+            row["errors"].append("split %d: missing lat file (%d entries)" % (idx, nSplit[idx]))
+        elif nLat[idx] != nSplit[idx]:
+            row["errors"].append("split %d: %d entries in split file, %d in lat file" % (idx, nSplit[idx], nLat[idx]))
+    for idx in sorted(set(nLat) - set(nSplit)):
+        row["errors"].append("split %d: lat file w/o a split file" % idx)
+    return row
+
+
+def reconcile():
+    """ ./check-files.py [-c] -r
+    Stage-to-stage entry count reconciliation, for every bkg subset or cal run:
+        waveSkim entries passing theCut == sum(split file entries) == sum(lat file entries),
+    and for each split index, split entries == lat entries.  Flags the run/split where entries
+    were lost.  Only reads tree headers, except for building theCut's entry list the first
+    time a waveSkim file is seen w/o virtual splits.
+    Writes ./logs/reconcile_[bkg/cal].json.
+    """
+    dType = "cal" if checkCal else "bkg"
+    print("Reconciling entry counts.  Cal?", checkCal)
 
-                # run the LAT routine to convert into numpy arrays
-                truncLo, truncHi = 0, 2
-                if ds==6 or ds==2: truncLo = 4
-                signal = wl.processWaveform(wf, truncLo, truncHi)
+    passFile = "%s/passCounts_%s.json" % (dsi.dataDir, dType)
+    passCounts = {}
+    if os.path.isfile(passFile):
+        with open(passFile) as f:
+            passCounts = json.load(f)
 
+    # make a list of (ds, sub, run)
+    jobList = []
+    if not checkCal:
+        dsMap = bkg.dsMap()
+        for ds in dsMap:
+            for sub in range(dsMap[ds]+1):
+                jobList.append((ds, sub, None))
+    else:
+        for key in cal.GetKeys():
+            ds = int(key[2])
+            if skipDS6Cal and ds==6: continue
+            for cIdx in range(cal.GetIdxs(key)):
+                for run in cal.GetCalList(key, cIdx):
+                    jobList.append((ds, None, run))
+
+    rows = []
+    for ds, sub, run in jobList[:fLimit]:
+        row = reconcileOne(ds, sub, run, passCounts)
+        rows.append(row)
+        name = "DS-%d-%d" % (ds, sub) if run is None else "DS-%d run %d" % (ds, run)
         if verbose:
-            print("%d/%d  %s  nEnt %d" % (idx, len(fileList[:fLimit]), fname.split("/")[-1], t.GetEntries()))
-
-        f.Close()
+            print("%-18s  nPass %-9s nSplit %-9s nLat %-9s" % (name, row["nPass"], row["nSplit"], row["nLat"]))
+        for err in row["errors"]:
+            print("   Error: %s: %s" % (name, err))
+
+    tmpFile = "%s.%d.tmp" % (passFile, os.getpid())
+    with open(tmpFile, "w") as f:
+        json.dump(passCounts, f)
+    os.replace(tmpFile, passFile)
+
+    bad = [r for r in rows if len(r["errors"]) > 0]
+    repFile = "%s/logs/reconcile_%s.json" % (dsi.latSWDir, dType)
+    if not os.path.isdir(os.path.dirname(repFile)): os.makedirs(os.path.dirname(repFile))
+    with open(repFile, "w") as f:
+        json.dump({"type":dType, "time":time.time(), "nChecked":len(rows), "nBad":len(bad), "bad":bad, "all":rows}, f, indent=2)
+    print("%d of %d %s sets have mismatched entries.  Report: %s" % (len(bad), len(rows), dType, repFile))
 
 
 def unpackFileName(splitList):
@@ -2,9 +2,8 @@
 """ 'dsi.py': DataSetInfo for LAT.
     C. Wiseman, 18 March 2018
 """
-import os, json, glob, re
+import os, sys, json, glob, re
 import numpy as np
-import tinydb as db
 
 latSWDir    = os.environ['LATDIR']
 dataDir     = os.environ['LATDATADIR']
@@ -15,10 +14,12 @@ skimDir     = bkgDir+"/skim"
 waveDir     = bkgDir+"/waves"
 splitDir    = bkgDir+"/split"
 latDir      = bkgDir+"/lat"
+mergeDir    = bkgDir+"/merge"
 calSkimDir  = calDir+"/skim"
 calWaveDir  = calDir+"/waves"
 calSplitDir = calDir+"/split"
 calLatDir   = calDir+"/lat"
+calMergeDir = calDir+"/merge"
 effDir      = calDir+"/eff"
 pandaDir    = dataDir+"/pandas"
 threshDir   = bkgDir+"/thresh"
@@ -28,6 +29,23 @@ class BkgInfo:
         with open("%s/data/runsBkg.json" % latSWDir) as f:
             self.master = scrubDict(json.load(f))
 
+        # Sorted run intervals [runLo, runHi] -> (ds, bkgIdx), for fast lookups (see GetBkgIdx)
+        tmp = []
+        for ds in self.master:
+            for sub in self.master[ds]:
+                runCov = self.master[ds][sub]
+                for i in range(0,len(runCov),2):
+                    tmp.append((runCov[i], runCov[i+1], ds, sub))
+        tmp = np.asarray(sorted(tmp), dtype=np.int64).reshape(-1,4)
+        self.runLo, self.runHi, self.runDS, self.runSub = tmp[:,0], tmp[:,1], tmp[:,2], tmp[:,3]
+
+        # same thing for the (non-overlapping) dataset ranges
+        dsRanges = self.dsRanges()
+        dsList = sorted(dsRanges, key=lambda ds: dsRanges[ds][0])
+        self.dsLo = np.asarray([dsRanges[ds][0] for ds in dsList])
+        self.dsHi = np.asarray([dsRanges[ds][1] for ds in dsList])
+        self.dsNums = np.asarray(dsList)
+
     def dsMap(self):
         """returns {ds:numSubDS}"""
         numSubDS = {}
@@ -80,24 +98,18 @@ class BkgInfo:
         return runList
 
     def GetDSNum(self,run):
-        ranges = self.dsRanges()
-        for ids in range(len(ranges)):
-            if ranges[ids][0] <= run <= ranges[ids][1]:
-                dsNum = ids
-        return dsNum
+        """ Finds the dsNum of a run (bkg or cal), using dsRanges.
+        'run' can be a number or an array of runs.  Returns -1 if not found.
+        """
+        return searchIntervals(self.dsLo, self.dsHi, self.dsNums, run)
 
     def GetBkgIdx(self, dsNum, runNum):
-        """ Finds the bkgIdx of a given run.  Must be IN the dataset! """
-        bkgRuns = self.master[dsNum]
-
-        for bkgIdx in bkgRuns:
-            runCov = bkgRuns[bkgIdx]
-            runList = []
-            for idx in range(0,len(runCov),2):
-                runList.extend(list(range(runCov[idx],runCov[idx+1]+1)))
-            if runNum in runList:
-                return bkgIdx
-        return -1
+        """ Finds the bkgIdx of a given run.  Must be IN the dataset!
+        'runNum' can be a number or an array of runs.  Returns -1 if not found.
+        """
+        bkgIdx = searchIntervals(self.runLo, self.runHi, self.runSub, runNum)
+        runDS = searchIntervals(self.runLo, self.runHi, self.runDS, runNum)
+        return np.where(runDS==dsNum, bkgIdx, -1) if np.ndim(runNum) > 0 else (bkgIdx if runDS==dsNum else -1)
 
     def GetSubRanges(self, ds=None, sub=None, opt="thr"):
         """ Return the sub-sub ranges defined by running the threshold finder,
@@ -135,13 +147,15 @@ class CalInfo:
         with open("%s/data/runsSpecial.json" % latSWDir) as f:
             self.special = scrubDict(json.load(f),'cal')
 
-        # Track all the 'hi' run coverage numbers for fast run range lookups
-        self.covIdx = {}
+        # Track all the 'lo' and 'hi' run coverage numbers for fast run range lookups
+        self.covIdx, self.covLo = {}, {}
         for key in self.master:
-            tmp = []
+            tmp, tmpLo = [], []
             for idx in self.master[key]:
                 tmp.append(self.master[key][idx][2])
+                tmpLo.append(self.master[key][idx][1])
             self.covIdx[key] = np.asarray(tmp)
+            self.covLo[key] = np.asarray(tmpLo)
 
     def GetMasterList(self):
         return self.master
@@ -163,11 +177,23 @@ class CalInfo:
             return thisDSList
 
     def GetCalIdx(self,key,run):
-        """ Look up the calibration index corresponding to a particular run. """
+        """ Look up the calibration index corresponding to a particular run.
+        'run' can also be an array of runs, then returns an array w/ -1 for runs not covered.
+        Cal ranges can overlap, and the hi's aren't always sorted (ex. ds5c), so the array lookup
+        does the same binary search as the scalar one, once per unique run.
+        """
         if key not in self.covIdx:
             print("Key %s not found in master list!" % key)
             return None
 
+        if np.ndim(run) > 0:
+            lo, hi = self.covLo[key], self.covIdx[key]
+            uRun, inv = np.unique(np.asarray(run), return_inverse=True)
+            idx = np.asarray([np.searchsorted(hi, r) for r in uRun], dtype=int)
+            idx0 = np.minimum(idx, len(hi)-1)
+            found = (idx < len(hi)) & (lo[idx0] <= uRun) & (uRun <= hi[idx0])
+            return np.where(found, idx0, -1)[inv].reshape(np.shape(run))
+
         idx = np.searchsorted(self.covIdx[key], run)
         if idx not in self.master[key]:
             print("Run %d out of range of key %s.  calIdx was %d" % (run, key, idx))
@@ -212,9 +238,10 @@ class CalInfo:
             return None
         return self.master[key][idx][1], self.master[key][idx][2]
 
-    def GetCalFiles(self, dsNum, calIdx=None, modNum=None, verbose=False, cDir=calDir):
+    def GetCalFiles(self, dsNum, calIdx=None, modNum=None, verbose=False, cDir=calDir, runLimit=10):
         """ Get a list of all files for a particular dsNum+calIdx.
             This will match the cut record entries in the DB.
+            runLimit=None gives every run (ex. for cuts tuned w/ lat3.py -sketch).
         """
         calKeys = self.GetKeys(dsNum)
 
@@ -228,18 +255,18 @@ class CalInfo:
             # get the runs in each calIdx
             runList = []
             if calIdx!=None:
-                runList = self.GetCalList(key, calIdx, 10)
+                runList = self.GetCalList(key, calIdx, runLimit)
                 if verbose: print(runList)
             else:
                 for idx in range(nIdx):
-                    tmp = self.GetCalList(key, idx, 10)
+                    tmp = self.GetCalList(key, idx, runLimit)
                     if verbose: print(tmp)
                     runList += tmp
 
             # make a list of the actual file paths
             for run in runList:
                 fPath = "%s/latSkimDS%d_run%d*.root" % (calDir, dsNum, run)
-                fList += glob.glob(fPath)
+                fList += globFiles(fPath)
 
         # for f in fList: print(f)
         return fList
@@ -315,6 +342,24 @@ class DetInfo:
         self.allDetIDs.update(self.detIDs["M1"])
         self.allDetIDs.update(self.detIDs["M2"])
 
+        # Active masses (g).  Matches DataSetInfo.cc::LoadActiveMasses (same for all DS's)
+        self.activeMass = {
+            1426981:510, 1425750:979, 1426612:811, 1425380:968,
+            28474:560, 1426640:723, 1426650:659, 1426622:689,
+            28480:551, 1426980:886, 1425381:949, 1425730:1024,
+            28455:558, 28470:564, 28463:567, 28465:545, 28469:557,
+            28477:553, 1425751:730, 1426610:632, 1425731:982,
+            1425742:732, 1426611:675, 1425740:701, 1426620:572.2,
+            28482:561, 1425741:710, 1426621:590.8, 1425370:964,
+            28459:556, 1426641:576, 1427481:903, 1427480:917,
+            28481:581, 28576:562, 28594:559, 28595:558, 28461:577,
+            1427490:872, 1427491:852, 1428530:996, 28607:558,
+            28456:579, 28621:565, 28466:566, 28473:562, 28487:557,
+            1426651:591, 1428531:1031, 1427120:802, 1235170:462.2,
+            1429091:775, 1429092:821, 1426652:778, 28619:566,
+            1427121:968, 1429090:562, 28717:567
+        }
+
         # -- Load outputs from LAT/chan-sel.py --
         # Generated with LAT/chan-sel.py::fillDetInfo
         # Used BKG ranges, DS0-6 in LAT/data/runsBkg.json
@@ -325,6 +370,13 @@ class DetInfo:
         self.detCH = f['arr_2'].item()
         self.pMons = f['arr_3'].item()
 
+        # sorted (runs, vals) arrays of each detector's settings history, built on first use
+        self.setIdx = {}
+
+        # channel/cpd/detID maps and per-channel arrays, built once per DS on first use
+        self.chanMaps = {}
+        self.chanTables = {}
+
     def getPMon(self,ds=None):
         """ {ds : [chan1, chan2 ...] }
         Analysis channel numbers of 'special' channels.
@@ -346,41 +398,62 @@ class DetInfo:
         else:
             return self.detHV[ds][cpd]
 
+    def getSettingIdx(self,ds,opt="hv"):
+        """ {cpd : (runs, vals)}, for detectors w/ at least one HV ("hv") or TRAP thresh ("th") value.
+        'runs' is sorted, and vals[i] is the setting for runs[i] <= run < runs[i+1].
+        The histories aren't always sorted by run (some DS5 lists are several lists
+        stuck together), so like the original loop over the list, the setting at a run is
+        the LAST entry in list order w/ r <= run, not the one w/ the largest r.
+        """
+        if (opt,ds) not in self.setIdx:
+            hist = self.detHV[ds] if opt=="hv" else self.detTH[ds]
+            self.setIdx[(opt,ds)] = {}
+            for cpd in hist:
+                if len(hist[cpd]) == 0: continue
+                runs = np.asarray([r for r,v in hist[cpd]])
+                vals = np.asarray([v for r,v in hist[cpd]])
+                order = np.argsort(runs, kind='stable')
+                last = np.maximum.accumulate(order) # latest list position w/ r <= runs[order][i]
+                self.setIdx[(opt,ds)][cpd] = (runs[order], vals[last])
+        return self.setIdx[(opt,ds)]
+
+    def getSettingAtRun(self,ds,run,opt="hv",keyOpt="cpd",default=0):
+        """ Used by getHVAtRun and getTrapThreshAtRun.  Returns the last setting at or before
+        each run, or 'default' if the run is before the first entry.
+        'run' can be a number or an array of runs (then the dict values are arrays).
+        """
+        out = {}
+        for cpd, (runs, vals) in sorted(self.getSettingIdx(ds,opt).items()):
+            idx = np.searchsorted(runs, run, side='right') - 1
+            val = np.where(idx >= 0, vals[np.maximum(idx,0)], default)
+            if np.ndim(val)==0: val = val.item()
+
+            if keyOpt == "cpd":
+                out[str(cpd)] = val
+            if keyOpt == "chan":
+                out[self.getCPDChan(ds,str(cpd))] = val
+        return out
+
+    def getSettingMatrix(self,ds,runs,opt="hv"):
+        """ Dense (run x detector) array of HV ("hv") or TRAP thresh ("th") settings.
+        Returns [cpdList, matrix], columns in the order of cpdList.  Same defaults as getSettingAtRun.
+        """
+        default = 0 if opt=="hv" else -1
+        vals = self.getSettingAtRun(ds, np.asarray(runs), opt, "cpd", default)
+        cpdList = sorted(vals)
+        if len(cpdList)==0:
+            return cpdList, np.full((len(runs),0), default)
+        return cpdList, np.column_stack([vals[cpd] for cpd in cpdList])
+
     def getHVAtRun(self,ds,run,opt="cpd"):
         """ {cpd : HV} or {chan : HV} depending on option.
         Sets detectors w/ no entry to 0V (which is true).
+        'run' can also be an array of runs.
 
         TODO: this needs to use the result from chan-sel::checkAllRunsHV
 
         """
-        hv = self.detHV[ds] # {cpd : [(run1,hv1),(run2,hv2),...] }
-        # for h in sorted(hv): print(h, hv[h])
-        # return
-
-        out = {}
-        for cpd in sorted(hv):
-
-            if len(hv[cpd]) == 0:
-                chanHV = 0
-            else:
-                hvInit = hv[cpd][0][1]
-                runInit = hv[cpd][0][0]
-                if run < runInit:
-                    # print("Run not covered in this DS! run:%d, runInit %d" % (run, runInit))
-                    chanHV = 0
-
-                # find the HV setting for this run
-                for r,h in hv[cpd]:
-                    if run < r: continue
-                    if run >= r: chanHV = h
-                    if r > run: break
-                # print("run:",run,"cpd:",cpd,"chanHV:",chanHV)
-
-                if opt == "cpd":
-                    out[str(cpd)] = chanHV
-                if opt == "chan":
-                    out[self.getCPDChan(ds,str(cpd))] = chanHV
-        return out
+        return self.getSettingAtRun(ds, run, "hv", opt, 0)
 
     def getTH(self,ds=None,cpd=None):
         """ {ds : {'det' : [(run1,val1),(run2,val2)...]} }
@@ -396,35 +469,9 @@ class DetInfo:
     def getTrapThreshAtRun(self,ds,run,opt="cpd"):
         """ {cpd : trap thresh} or {chan : trap thresh} depending on option.
         Sets detectors w/ no thresh value (not active in this DS) to -1.
+        'run' can also be an array of runs.
         """
-        th = self.detTH[ds] # {cpd : [(run1,trap1),(run2,trap2),...]}
-        # for t in sorted(th): print(t, th[t])
-        # return
-
-        out = {}
-        for cpd in sorted(th):
-
-            if len(th[cpd]) == 0:
-                chanTH = -1
-            else:
-                thInit = th[cpd][0][1]
-                runInit = th[cpd][0][0]
-                if run < runInit:
-                    # print("Run not covered in this DS! run:%d, runInit %d" % (run, runInit))
-                    chanTH = -1
-
-                # find the trap threshold setting for this run
-                for r,t in th[cpd]:
-                    if run < r: continue
-                    if run >= r: chanTH = t
-                    if r > run: break
-                # print("run:",run,"cpd:",cpd,"chanTH:",chanTH)
-
-                if opt == "cpd":
-                    out[str(cpd)] = chanTH
-                if opt == "chan":
-                    out[self.getCPDChan(ds,str(cpd))] = chanTH
-        return out
+        return self.getSettingAtRun(ds, run, "th", opt, -1)
 
     def getCH(self,ds=None,cpd=None):
         """ {ds : {'det' : [(run1,val1),(run2,val2)...]} }
@@ -442,37 +489,78 @@ class DetInfo:
         """In DS0-6, the channel number does NOT change in the DS."""
         return sorted([ch[0][1] for ch in self.detCH[ds].values() if len(ch)>0])
 
+    def getChanMaps(self,ds):
+        """ Channel <-> CPD <-> detID maps for the detectors active at some point in a DS.
+        {"chanCPD":{chan:cpd}, "cpdChan":{cpd:chan}, "chanDetID":{chan:detID}, "detIDChan":{detID:chan}}
+        Built once per DS.
+        """
+        if ds not in self.chanMaps:
+            cpdChan = {cpd:val[0][1] for cpd, val in self.detCH[ds].items() if len(val)>0}
+            chanCPD = {chan:cpd for cpd, chan in cpdChan.items()}
+            chanDetID = {chan:self.allDetIDs[cpd] for chan, cpd in chanCPD.items()}
+            detIDChan = {detID:chan for chan, detID in chanDetID.items()}
+            self.chanMaps[ds] = {"chanCPD":chanCPD, "cpdChan":cpdChan, "chanDetID":chanDetID, "detIDChan":detIDChan}
+        return self.chanMaps[ds]
+
+    def getChanTable(self,ds):
+        """ Per-channel arrays for a DS, indexed by channel number, so a whole channel column
+        can be looked up at once, e.g. tbl['isGood'][chans].  See getChanProp for a safe version.
+        Keys: module, cpd, detID, isEnr, isNat, aMass (g), isGood, isBad, isVeto, isPulser.
+        Channels that aren't detector HG channels have module/cpd/detID = 0 and aMass = 0.
+        """
+        if ds not in self.chanTables:
+            maps = self.getChanMaps(ds)
+            pMons = set(self.pMons[ds])
+            badIDs, vetoIDs = set(self.getBadDetIDList(ds)), set(self.getVetoDetIDList(ds))
+            nCh = max(list(maps["chanCPD"]) + list(pMons)) + 2 # leave room for the LG channel
+
+            tbl = {key:np.zeros(nCh, dtype=int) for key in ["module","cpd","detID"]}
+            tbl["aMass"] = np.zeros(nCh)
+            for key in ["isEnr","isNat","isGood","isBad","isVeto","isPulser"]:
+                tbl[key] = np.zeros(nCh, dtype=bool)
+
+            for chan, cpd in maps["chanCPD"].items():
+                detID = maps["chanDetID"][chan]
+                tbl["module"][chan] = int(cpd[0])
+                tbl["cpd"][chan] = int(cpd)
+                tbl["detID"][chan] = detID
+                tbl["aMass"][chan] = self.activeMass[detID]
+                tbl["isEnr"][chan] = detID > 1000000
+                tbl["isNat"][chan] = detID < 1000000
+                tbl["isBad"][chan] = detID in badIDs
+                tbl["isVeto"][chan] = detID in vetoIDs
+            for chan in pMons:
+                tbl["isPulser"][chan] = True
+            tbl["isGood"] = (tbl["detID"] > 0) & ~tbl["isBad"] & ~tbl["isVeto"] & ~tbl["isPulser"]
+            self.chanTables[ds] = tbl
+        return self.chanTables[ds]
+
+    def getChanProp(self,ds,prop,chans):
+        """ Look up a getChanTable property for an array of channels.
+        Out-of-range channels get 0/False.
+        """
+        arr = self.getChanTable(ds)[prop]
+        chans = np.asarray(chans, dtype=int)
+        inRange = (chans >= 0) & (chans < len(arr))
+        return np.where(inRange, arr[np.where(inRange, chans, 0)], 0).astype(arr.dtype)
+
     def getChanCPD(self,ds,chan):
         """ Get the CPD of a channel """
-        cpd = {val[0][1]:cpd for cpd, val in self.detCH[ds].items() if len(val)>0}
-        if chan in cpd.keys():
-            return cpd[chan]
-        else:
-            return None
+        return self.getChanMaps(ds)["chanCPD"].get(chan)
 
     def getCPDChan(self,ds,cpd):
         """ Get the channel of a cpd """
-        chan = {cpd:val[0][1] for cpd, val in self.detCH[ds].items() if len(val)>0}
-        if cpd in chan.keys():
-            return chan[cpd]
-        else:
-            return None
+        return self.getChanMaps(ds)["cpdChan"].get(cpd)
 
     def getChanDetID(self,ds,detID):
         """ Given a detID (ex. 1426641), get its channel.
         Returns nothing if the detector isn't enabled in this DS.
         """
-        cpdToChan = {cpd:chan[0][1] for cpd, chan in self.detCH[ds].items() if len(chan)>0}
-        detIDtoCPD = {id:cpd for cpd, id in self.allDetIDs.items()}
-
-        if detIDtoCPD[detID] in cpdToChan.keys(): # i.e. it's active at some point in the DS
-            return cpdToChan[detIDtoCPD[detID]]
-        else:
-            return None
+        return self.getChanMaps(ds)["detIDChan"].get(detID)
 
     def getDetIDChan(self,ds,chan):
         """ Given a channel, return a detID. """
-        return self.allDetIDs[getChanCPD(ds,chan)]
+        return self.getChanMaps(ds)["chanDetID"].get(chan)
 
     def getBadDetIDList(self, ds):
         """ Matches DataSetInfo.cc::LoadBadDetectorMap, 4 Apr 2018, CGW """
@@ -498,22 +586,24 @@ class DetInfo:
 
     def getBadChanList(self, ds):
         """ Return a list of bad and veto-only HG channels for a DS """
+        detIDChan = self.getChanMaps(ds)["detIDChan"]
         badIDs = self.getBadDetIDList(ds) + self.getVetoDetIDList(ds)
-        badChans = [self.getChanDetID(ds, id) for id in badIDs if self.getChanDetID(ds,id) is not None]
+        badChans = [detIDChan[id] for id in badIDs if id in detIDChan]
         return badChans
 
     def getGoodChanList(self, ds, detType=None):
         """ Return a list of good HG channels for a DS.  No bad, no veto-only, no pulser monitors. """
         chList = self.getChanList(ds)
-        badList = self.getBadChanList(ds)
-        goodList = [ch for ch in chList if ch not in badList and ch not in self.pMons[ds]]
+        badList = set(self.getBadChanList(ds)) | set(self.pMons[ds])
+        goodList = [ch for ch in chList if ch not in badList]
+        chanDetID = self.getChanMaps(ds)["chanDetID"]
 
         if detType is None:
             return goodList
         elif detType == "Enr":
-            return [ch for ch in goodList if self.getDetIDChan(ds,ch) > 1000000]
+            return [ch for ch in goodList if chanDetID[ch] > 1000000]
         elif detType == "Nat":
-            return [ch for ch in goodList if self.getDetIDChan(ds,ch) < 1000000]
+            return [ch for ch in goodList if chanDetID[ch] < 1000000]
         else:
             print("IDK what that detType is.")
             return None
@@ -585,6 +675,397 @@ class SimInfo:
         return self.dtCutoffs[module][iD]
 
 
+# =============================================================
+# Cached, lazy-loaded metadata objects.
+# Batch scripts should use getBkgInfo/getCalInfo/getDetInfo (or the proxies 'bkg', 'cal', 'det')
+# instead of creating new objects: each one is only loaded the first time it's used,
+# and is unpickled from a cache file unless its source files (or this file) have changed.
+
+cacheVersion = 1
+cacheDir = "%s/data/cache" % latSWDir
+infoSources = {
+    "BkgInfo": ["data/runsBkg.json"],
+    "CalInfo": ["data/runsCal.json", "data/runsSpecial.json"],
+    "DetInfo": ["data/runSettings-v2.npz"]
+    }
+infoObjs = {}  # {className : object}
+loadTimes = {} # {className : (seconds, "cache" or "source")}
+
+def getFileStamp(fileList):
+    """ (path, mtime, size) of each file.  Used to invalidate the cache. """
+    stamp = []
+    for f in fileList:
+        st = os.stat(f)
+        stamp.append((f, st.st_mtime, st.st_size))
+    return stamp
+
+
+def loadInfo(cls, useCache=True):
+    """ Return the (memoized) object of class 'cls', from the cache if it's still valid. """
+    import pickle, time
+
+    name = cls.__name__
+    if name in infoObjs:
+        return infoObjs[name]
+
+    start = time.time()
+    srcFiles = ["%s/%s" % (latSWDir, f) for f in infoSources[name]] + [os.path.abspath(__file__)]
+    stamp = [cacheVersion] + getFileStamp(srcFiles)
+    cacheFile = "%s/%s-v%d.pkl" % (cacheDir, name, cacheVersion)
+
+    obj, src = None, "source"
+    if useCache and os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile, "rb") as f:
+                cached = pickle.load(f)
+            if cached["stamp"] == stamp:
+                obj = cls.__new__(cls)
+                obj.__dict__.update(cached["dict"])
+                src = "cache"
+        except Exception as e:
+            print("loadInfo: couldn't read %s (%s).  Rebuilding ..." % (cacheFile, str(e)))
+            obj = None
+
+    if obj is None:
+        obj = cls()
+        if useCache:
+            try:
+                if not os.path.isdir(cacheDir): os.makedirs(cacheDir)
+                tmpFile = "%s.%d.tmp" % (cacheFile, os.getpid())
+                with open(tmpFile, "wb") as f:
+                    pickle.dump({"stamp":stamp, "dict":obj.__dict__}, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpFile, cacheFile)
+            except (OSError, IOError) as e:
+                print("loadInfo: couldn't write %s (%s)" % (cacheFile, str(e)))
+
+    infoObjs[name] = obj
+    loadTimes[name] = (time.time() - start, src)
+    return obj
+
+
+def getBkgInfo(): return loadInfo(BkgInfo)
+def getCalInfo(): return loadInfo(CalInfo)
+def getDetInfo(): return loadInfo(DetInfo)
+
+
+class LazyInfo:
+    """ Stand-in for a BkgInfo/CalInfo/DetInfo object that's loaded the first time an attribute is used.
+    Ex. at the top of a script:  bkg, cal, det = dsi.bkg, dsi.cal, dsi.det
+    """
+    def __init__(self, getter):
+        self.__dict__["getter"] = getter
+
+    def __getattr__(self, name):
+        if name == "getter": raise AttributeError(name) # not initialized yet (ex. unpickling)
+        return getattr(self.getter(), name)
+
+bkg = LazyInfo(getBkgInfo)
+cal = LazyInfo(getCalInfo)
+det = LazyInfo(getDetInfo)
+
+
+def timeLoad():
+    """ ./dsi.py -time
+    Report the import and load cost of the metadata objects, with and without the cache.
+    """
+    import subprocess as sp
+    cmd = "import time; t0=time.time(); import dsi; t1=time.time(); dsi.getBkgInfo(); dsi.getCalInfo(); dsi.getDetInfo(); "
+    cmd += "print('  import dsi: %.4f sec' % (t1-t0)); "
+    cmd += "[print('  %-8s %.4f sec (%s)' % (k, dsi.loadTimes[k][0], dsi.loadTimes[k][1])) for k in sorted(dsi.loadTimes)]"
+    for f in glob.glob("%s/*-v%d.pkl" % (cacheDir, cacheVersion)):
+        os.remove(f)
+    print("Cold start (no cache):")
+    sp.call([sys.executable, "-c", cmd], cwd=os.path.dirname(os.path.abspath(__file__)))
+    print("Warm start (cache):")
+    sp.call([sys.executable, "-c", cmd], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+# =============================================================
+# File catalog.  One in-memory listing of the skim/waves/split/lat/thresh directories,
+# persisted in catalogFile, so every query doesn't have to glob the (big, networked) data dirs.
+# A directory is only re-listed when its mtime changes, i.e. a file was added, removed or renamed,
+# or if it was listed within catalogRacyNs of its last change (the mtime may not have ticked since).
+# Overwriting a file in place doesn't change the directory mtime, so getEntries re-stats the file
+# before trusting a saved entry count.  Use refresh(force=True) (./dsi.py -cat -force) to re-stat everything.
+# The catalog is written by ./dsi.py -cat, and when a process that used it exits.
+
+catalogVersion = 2
+catalogRacyNs = 2e9 # coarse (ex. 1-2 sec) directory mtimes on some network filesystems
+catalogFile = "%s/fileCatalog-v%d.json" % (dataDir, catalogVersion)
+catalogDirs = {
+    # dir : (stage, cal)
+    skimDir:     ("skim", False),  calSkimDir:  ("skim", True),
+    waveDir:     ("waves", False), calWaveDir:  ("waves", True),
+    splitDir:    ("split", False), calSplitDir: ("split", True),
+    latDir:      ("lat", False),   calLatDir:   ("lat", True),
+    threshDir:   ("thresh", False)
+    }
+catalogNames = re.compile(r"^(?:skim|waveSkim|splitSkim|latSkim|thresh)DS(\d+)_(run)?(\d+)((?:_\d+)*)(?:_low)?\.root$")
+
+class FileCatalog:
+    """ {dir: {"mtime":dirMTime, "listed":listTime, "files":{name:[size, mtime, nEnt]}, "other":[names]}}.
+    Only .root files are stat'ed, "other" is the names of everything else (so glob can tell when it
+    has to fall back to glob.glob).  nEnt (skimTree entries) is None until someone asks for it (see getEntries).
+    Ex:  cat = dsi.getCatalog()
+         cat.query("split", 1, sub=5) -> [record], sorted by split index
+         cat.glob("%s/splitSkimDS1_5*" % dsi.splitDir) -> same as glob.glob
+    """
+    def __init__(self, catFile=catalogFile):
+        self.catFile = catFile
+        self.dirs = {}
+        self.dirty = False
+        if os.path.isfile(catFile):
+            try:
+                with open(catFile) as f:
+                    tmp = json.load(f)
+                if tmp.get("version") == catalogVersion:
+                    self.dirs = tmp["dirs"]
+            except ValueError:
+                print("FileCatalog: couldn't read %s.  Rebuilding ..." % catFile)
+
+    def refreshDir(self, d, force=False):
+        """ Re-list directory 'd' if its mtime changed (or might have changed w/o ticking).
+        Keeps nEnt for files that didn't change. """
+        import time
+        try:
+            dTime = os.stat(d).st_mtime_ns
+        except OSError:
+            if d in self.dirs:
+                del self.dirs[d]
+                self.dirty = True
+            return
+        old = self.dirs.get(d)
+        if old is not None and old["mtime"] == dTime and old["listed"] - dTime > catalogRacyNs and not force:
+            return
+        oldFiles = old["files"] if old is not None else {}
+        files, other = {}, []
+        listed = int(time.time() * 1e9) # before the scan, so anything created during it gets re-listed
+        for ent in os.scandir(d):
+            if not ent.name.endswith(".root") or not ent.is_file():
+                other.append(ent.name)
+                continue
+            st = ent.stat()
+            rec = [st.st_size, st.st_mtime_ns, None]
+            prev = oldFiles.get(ent.name)
+            if prev is not None and prev[:2] == rec[:2]:
+                rec[2] = prev[2]
+            files[ent.name] = rec
+        self.dirs[d] = {"mtime":dTime, "listed":listed, "files":files, "other":sorted(other)}
+        self.dirty = True
+
+    def refresh(self, force=False):
+        for d in catalogDirs:
+            self.refreshDir(d, force)
+        self.save()
+
+    def save(self):
+        """ Atomic write, so parallel jobs never see a partial file.  Last writer wins. """
+        if not self.dirty: return
+        try:
+            tmpFile = "%s.%d.tmp" % (self.catFile, os.getpid())
+            with open(tmpFile, "w") as f:
+                json.dump({"version":catalogVersion, "dirs":self.dirs}, f)
+            os.replace(tmpFile, self.catFile)
+            self.dirty = False
+        except (OSError, IOError) as e:
+            print("FileCatalog: couldn't write %s (%s)" % (self.catFile, str(e)))
+
+    def glob(self, pattern):
+        """ Drop-in for glob.glob on the catalog dirs.  Falls back to a real glob for other paths,
+        and when the pattern matches something that isn't a .root file. """
+        import fnmatch
+        d, namePattern = os.path.split(pattern)
+        if d not in catalogDirs or glob.has_magic(d):
+            return glob.glob(pattern)
+        self.refreshDir(d)
+        if d not in self.dirs: return []
+        if len(fnmatch.filter(self.dirs[d]["other"], namePattern)) > 0:
+            return glob.glob(pattern)
+        names = fnmatch.filter(self.dirs[d]["files"], namePattern)
+        if not namePattern.startswith("."):
+            names = [name for name in names if not name.startswith(".")] # like glob.glob
+        return ["%s/%s" % (d, name) for name in names]
+
+    def query(self, stage, ds, sub=None, run=None, cal=False):
+        """ Records {stage, cal, ds, sub, run, idx, path, size, mtime, nEnt} of one bkg subset or cal run.
+        idx is the split index (0 for unsplit files).  For thresh files w/ sub-ranges it's the first run.
+        """
+        recs = []
+        for d, (dStage, dCal) in catalogDirs.items():
+            if dStage != stage or dCal != cal: continue
+            self.refreshDir(d)
+            if d not in self.dirs: continue
+            for name, (size, mtime, nEnt) in self.dirs[d]["files"].items():
+                m = catalogNames.match(name)
+                if m is None or int(m.group(1)) != ds: continue
+                isRun, num = m.group(2) is not None, int(m.group(3))
+                if (run is not None and (not isRun or num != run)) or (sub is not None and (isRun or num != sub)):
+                    continue
+                tail = [int(i) for i in m.group(4).split("_")[1:]]
+                recs.append({"stage":stage, "cal":cal, "ds":ds, "sub":None if isRun else num, "run":num if isRun else None,
+                    "idx":tail[0] if tail else 0, "path":"%s/%s" % (d, name), "size":size, "mtime":mtime, "nEnt":nEnt})
+        return sorted(recs, key=lambda r: (r["sub"] if r["sub"] is not None else r["run"], r["idx"]))
+
+    def getSplitList(self, stage, ds, sub=None, run=None, cal=False):
+        """ {splitIdx:filePath}, like dsi.getSplitList """
+        return {r["idx"]:r["path"] for r in self.query(stage, ds, sub, run, cal)}
+
+    def getEntries(self, path, tree="skimTree"):
+        """ Number of entries in 'tree', opening the file only if it changed since it was last counted.
+        The file is always re-stat'ed: a file rewritten in place doesn't change the directory mtime.
+        """
+        d, name = os.path.split(path)
+        if d in catalogDirs:
+            self.refreshDir(d)
+        rec = self.dirs.get(d, {}).get("files", {}).get(name)
+        if rec is not None:
+            try:
+                st = os.stat(path)
+                if [st.st_size, st.st_mtime_ns] != rec[:2]:
+                    rec[:] = [st.st_size, st.st_mtime_ns, None]
+                    self.dirty = True
+            except OSError:
+                rec = None
+        if rec is not None and rec[2] is not None:
+            return rec[2]
+        from ROOT import TFile
+        tf = TFile(path)
+        tt = tf.Get(tree)
+        nEnt = tt.GetEntries() if tt else 0
+        tf.Close()
+        if rec is not None:
+            rec[2] = int(nEnt)
+            self.dirty = True
+        return int(nEnt)
+
+    def setEntries(self, path, nEnt):
+        """ Record an entry count found elsewhere (ex. by check-files.py). """
+        d, name = os.path.split(path)
+        rec = self.dirs.get(d, {}).get("files", {}).get(name)
+        if rec is not None and rec[2] != nEnt:
+            rec[2] = int(nEnt)
+            self.dirty = True
+
+catalog = None
+
+def getCatalog():
+    """ The (memoized) catalog of this process.  Directories are re-checked on every query.
+    Changes are saved once, when the process exits. """
+    global catalog
+    if catalog is None:
+        import atexit
+        catalog = FileCatalog()
+        atexit.register(catalog.save)
+    return catalog
+
+
+def globFiles(pattern):
+    """ glob.glob, answered from the file catalog for the standard data directories. """
+    return getCatalog().glob(pattern)
+
+
+def buildCatalog(force=False, countEntries=False):
+    """ ./dsi.py -cat [-force] [-ent]
+    Build/update the file catalog, and optionally count the entries of every file.
+    """
+    import time
+    start = time.time()
+    cat = getCatalog()
+    cat.refresh(force)
+    print("Refreshed catalog in %.2f sec: %s" % (time.time()-start, cat.catFile))
+    for d in sorted(cat.dirs):
+        files = cat.dirs[d]["files"]
+        if countEntries:
+            for name in sorted(files):
+                cat.getEntries("%s/%s" % (d, name))
+            cat.save()
+        nCounted = sum(1 for f in files.values() if f[2] is not None)
+        gb = sum(f[0] for f in files.values()) / 1e9
+        print("  %-60s  %6d files  %8.2f GB  %6d counted" % (d, len(files), gb, nCounted))
+
+
+# =============================================================
+# Entry list cache.  theCut (the data cleaning cut) is interpreted once per file, and the passing
+# entries are saved in elistDir, keyed by the file path, its (mtime, size), and a hash of the cut string.
+# Used instead of tree.Draw(">>elist", theCut, "entrylist") by lat.py, job-panda.py, check-files.py and lat3.py.
+# Works in python 2 and 3 (lat3 is still python 2).
+
+elistVersion = 1
+elistDir = dataDir+"/elist"
+
+def getElistPath(fName, theCut):
+    import hashlib
+    key = "%s\n%s" % (os.path.abspath(fName), theCut)
+    return "%s/%s_%s.npz" % (elistDir, os.path.basename(fName).rsplit(".",1)[0], hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+
+def getCutEntries(fName, theCut, tree=None, treeName="skimTree", refresh=False):
+    """ Entries of 'fName' passing 'theCut', from the cache if it's still valid.  Returns a dict:
+    "evtList": sorted entries w/ at least one passing hit,
+    "hitEnt", "hitIdx": entry and vector index (Entry$, Iteration$) of each passing hit.
+    If theCut doesn't use any vector branches, there's one "hit" (hitIdx 0) per passing entry.
+    'tree' can be passed if the file is already open.
+    """
+    ePath = getElistPath(fName, theCut)
+    stamp = [elistVersion] + list(getFileStamp([fName])[0][1:])
+    if not refresh and os.path.isfile(ePath):
+        try:
+            f = np.load(ePath)
+            if list(f["stamp"]) == stamp and str(f["theCut"]) == theCut:
+                return {"evtList":f["evtList"], "hitEnt":f["hitEnt"], "hitIdx":f["hitIdx"]}
+        except Exception as e:
+            print("getCutEntries: couldn't read %s (%s).  Rebuilding ..." % (ePath, str(e)))
+
+    import waveLibs as wl
+    tFile = None
+    if tree is None:
+        from ROOT import TFile
+        tFile = TFile(fName)
+        tree = tFile.Get(treeName)
+    hitEnt, hitIdx = wl.GetDrawArrays(tree, ["Entry$","Iteration$"], theCut)
+    hitEnt, hitIdx = hitEnt.astype(np.int64), hitIdx.astype(np.int32)
+    evtList = np.unique(hitEnt)
+    if tFile is not None: tFile.Close()
+
+    try:
+        if not os.path.isdir(elistDir): os.makedirs(elistDir)
+        tmpFile = "%s.%d.tmp.npz" % (ePath, os.getpid())
+        np.savez(tmpFile, stamp=np.asarray(stamp, dtype=np.float64), theCut=np.asarray(theCut), path=np.asarray(os.path.abspath(fName)),
+                 evtList=evtList, hitEnt=hitEnt, hitIdx=hitIdx)
+        os.rename(tmpFile, ePath)
+    except (OSError, IOError) as e:
+        print("getCutEntries: couldn't write %s (%s)" % (ePath, str(e)))
+    return {"evtList":evtList, "hitEnt":hitEnt, "hitIdx":hitIdx}
+
+
+def getEntryList(fName, theCut, tree, name="elist", entryLo=0, entryHi=-1):
+    """ Cached replacement for tree.Draw(">>elist", theCut, "entrylist").  Returns a TEntryList for
+    'tree' (from file 'fName') w/ the passing entries in [entryLo, entryHi) (entryHi=-1: to the end).
+    """
+    from ROOT import TEntryList
+    evtList = getCutEntries(fName, theCut, tree)["evtList"]
+    if entryLo > 0 or entryHi >= 0:
+        hi = entryHi if entryHi >= 0 else np.iinfo(np.int64).max
+        evtList = evtList[(evtList >= entryLo) & (evtList < hi)]
+    elist = TEntryList(name, name, tree)
+    for iEnt in evtList: elist.Enter(int(iEnt))
+    return elist
+
+
+def searchIntervals(lo, hi, vals, run, default=-1):
+    """ Find the value of the sorted, non-overlapping interval [lo, hi] containing each run.
+    O(log n) per run.  'run' can be a number or an array.  Returns 'default' if not found.
+    Raises ValueError if the intervals aren't sorted and non-overlapping.
+    """
+    if np.any(lo[1:] <= hi[:-1]) or np.any(lo > hi):
+        raise ValueError("searchIntervals: intervals must be sorted and non-overlapping")
+    idx = np.searchsorted(lo, run, side='right') - 1
+    idx0 = np.maximum(idx, 0)
+    found = (idx >= 0) & (run <= hi[idx0])
+    out = np.where(found, vals[idx0], default)
+    return out.item() if np.ndim(out)==0 else out
+
+
 def scrubDict(myDict,opt=''):
     """ Create appropriate python dicts from our run list json files. """
     for key in list(myDict):
@@ -606,10 +1087,10 @@ def scrubDict(myDict,opt=''):
 def getSplitList(filePathRegexString, subNum, uniqueKey=False, dsNum=None):
     """ Creates a dict of files w/ the format {'DSX_X_X':filePath.}
         Used to combine and split apart files during the LAT processing.
-        Used in place of sorted(glob.glob(myPath)).
+        Used in place of sorted(glob.glob(myPath)).  Answered from the file catalog.
     """
     files = {}
-    for fl in glob.glob(filePathRegexString):
+    for fl in globFiles(filePathRegexString):
         int(re.search(r'\d+',fl).group())
         ints = list(map(int, re.findall(r'\d+',fl)))
         if (ints[1]==subNum):
@@ -622,6 +1103,62 @@ def getSplitList(filePathRegexString, subNum, uniqueKey=False, dsNum=None):
     return files
 
 
+def getVirtualSplits(dsNum, subNum=None, runNum=None, cal=False):
+    """ Load the "virtual splits" of a waveSkim file written by job-panda.py -vsplit.
+        Returns a dict w/ the format {splitIdx:[firstEntry, lastEntry, nHits, nEvts]},
+        where [firstEntry, lastEntry) is a range of the ORIGINAL waveSkim tree
+        and nHits/nEvts are the number of hits/entries in it passing theCut.
+        Used in place of getSplitList when the physical split files aren't made.
+    """
+    sDir = calSplitDir if cal else splitDir
+    if runNum is None:
+        fName = "%s/vsplitDS%d_%d.npz" % (sDir, dsNum, subNum)
+    else:
+        fName = "%s/vsplitDS%d_run%d.npz" % (sDir, dsNum, runNum)
+    if not os.path.isfile(fName):
+        print("getVirtualSplits: file not found:",fName)
+        return {}
+    f = np.load(fName)
+    edges, nHits, nEvts = f['arr_0'], f['arr_1'], f['arr_2']
+    splits = {}
+    for idx in range(len(edges)-1):
+        splits[idx] = [int(edges[idx]), int(edges[idx+1]), int(nHits[idx]), int(nEvts[idx])]
+    return splits
+
+
+def getMergeIndex(mergePath):
+    """ Load the entry-offset index written by job-panda.py -mergef next to a merged LAT file.
+        Returns a dict of arrays, one element per split file, in merge order:
+          'files', 'splitIdx' : original latSkim file and its split index
+          'offset', 'nEnt'    : first merged entry and number of entries from that file
+          'runEvt'            : [run, iEvent] of the first and last entry, shape (nFiles, 4)
+        Use findMergedSplit to map a merged entry or (run, iEvent) back to its file.
+    """
+    idxPath = mergePath.replace(".root","_idx.npz")
+    if not os.path.isfile(idxPath):
+        print("getMergeIndex: file not found:",idxPath)
+        return None
+    f = np.load(idxPath)
+    keys = ['files','splitIdx','offset','nEnt','runEvt']
+    return {key:f['arr_%d' % i] for i, key in enumerate(keys)}
+
+
+def findMergedSplit(mIdx, entry=None, run=None, iEvent=None):
+    """ Returns (file index in mIdx, local entry or None), or (-1, None) if not found.
+        Use either the merged tree 'entry', or the (run, iEvent) of an event.
+    """
+    if entry is not None:
+        i = np.searchsorted(mIdx['offset'], entry, side='right') - 1
+        if i < 0 or entry >= mIdx['offset'][i] + mIdx['nEnt'][i]:
+            return -1, None
+        return int(i), int(entry - mIdx['offset'][i])
+    rEvt = mIdx['runEvt']
+    for i in range(len(rEvt)):
+        if (rEvt[i][0], rEvt[i][1]) <= (run, iEvent) <= (rEvt[i][2], rEvt[i][3]):
+            return i, None
+    return -1, None
+
+
 def GetExposureDict(dsNum, modNum, dPath="%s/data" % latSWDir, verbose=False):
     """ Parse granular exposure output from ds_livetime.cc """
 
@@ -699,20 +1236,111 @@ def GetExposureDict(dsNum, modNum, dPath="%s/data" % latSWDir, verbose=False):
     return expDict
 
 
+class CalDB:
+    """ In-memory hash index over a TinyDB json file (like calDB-v2.json),
+    usable as the 'calDB' argument of getDBRecord and setDBRecord.
+    Lookups are dict lookups (the file is parsed once), records are decoded
+    to integer keys once, and writes are kept in memory until commit().
+
+    Usage:
+        calDB = dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir)
+        rec = dsi.getDBRecord("fitSlo_ds1_idx0_m1_Peak", calDB=calDB)
+        with dsi.CalDB("%s/calDB-v2.json" % dsi.latSWDir) as calDB: # commits on exit
+            dsi.setDBRecord({"key":key, "vals":vals}, forceUpdate=True, calDB=calDB)
+
+    The file is written in the TinyDB format, so TinyDB can still read it.
+    Use export() to write a copy somewhere else.
+    """
+    def __init__(self, dbFile="calDB.json"):
+        self.dbFile = dbFile
+        self.docs = {}      # {docID: {"key":key, "vals":vals}}, exactly as in the json
+        self.index = {}     # {key: [docID1, docID2 ...]}
+        self.decoded = {}   # {key: {int(k):v}}
+        self.dirty = False
+        if os.path.isfile(dbFile):
+            with open(dbFile) as f:
+                self.docs = json.load(f).get("_default", {})
+        for docID in sorted(self.docs, key=int):
+            self.index.setdefault(self.docs[docID]["key"], []).append(docID)
+        self.nextID = max([int(d) for d in self.docs] + [0]) + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def search(self, key):
+        """ Returns a list of matching records, like TinyDB's search(pars.key==key). """
+        return [self.docs[docID] for docID in self.index.get(key, [])]
+
+    def get(self, key):
+        """ Returns the decoded 'vals' of a record ({int:val}), or None. Don't modify it. """
+        if key not in self.decoded:
+            recList = self.search(key)
+            if len(recList) != 1:
+                return None
+            rec = recList[0]['vals']
+            self.decoded[key] = {int(k):rec[k] for k in sorted(rec, key=int)}
+        return self.decoded[key]
+
+    def insert(self, entry):
+        docID = str(self.nextID)
+        self.nextID += 1
+        self.docs[docID] = json.loads(json.dumps(entry)) # store what TinyDB would read back
+        self.index.setdefault(entry["key"], []).append(docID)
+        self.decoded.pop(entry["key"], None)
+        self.dirty = True
+
+    def update(self, entry):
+        for docID in self.index.get(entry["key"], []):
+            self.docs[docID] = json.loads(json.dumps(entry))
+        self.decoded.pop(entry["key"], None)
+        self.dirty = True
+
+    def commit(self):
+        """ Write all the changes made since the last commit. """
+        if not self.dirty:
+            return
+        self.export(self.dbFile)
+        self.dirty = False
+
+    def export(self, outFile):
+        """ Write the DB in the TinyDB json format. """
+        tmpFile = "%s.%d.tmp" % (outFile, os.getpid())
+        with open(tmpFile, "w") as f:
+            json.dump({"_default": self.docs}, f)
+        os.replace(tmpFile, outFile)
+
+
 def getDBRecord(key, verbose=False, calDB=None, pars=None):
-    """ View a particular database record. """
+    """ View a particular database record.
+    'calDB' can be a TinyDB or a CalDB object (much faster for many lookups).
+    """
     import tinydb as db
 
     if calDB is None: calDB = db.TinyDB('calDB.json')
-    if pars is None: pars = db.Query()
+    if isinstance(calDB, CalDB):
+        recList = calDB.search(key)
+    else:
+        if pars is None: pars = db.Query()
+        recList = calDB.search(pars.key == key)
 
-    recList = calDB.search(pars.key == key)
     nRec = len(recList)
     if nRec == 0:
         if verbose: print("Record %s doesn't exist" % key)
         return 0
     elif nRec == 1:
         if verbose: print("Found record:\n%s" % key)
+
+        # CalDB has already sorted the string keys and converted them to int
+        if isinstance(calDB, CalDB):
+            result = dict(calDB.get(key))
+            if verbose:
+                for k in result: print(k, result[k])
+            return result
+
         rec = recList[0]['vals']  # whole record
 
         # sort the TinyDB string keys numerically (obvs only works for integer keys)
@@ -733,14 +1361,16 @@ def setDBRecord(entry, forceUpdate=False, dbFile="calDB.json", calDB=None, pars=
     """ Adds entries to the DB. Checks for duplicate records.
     The format of 'entry' should be a nested dict:
     myEntry = {"key":key, "vals":vals}
+    If 'calDB' is a CalDB object, nothing is written until calDB.commit().
     """
     import tinydb as db
     if calDB is None:
         calDB = db.TinyDB(dbFile)
         pars = db.Query()
+    isCalDB = isinstance(calDB, CalDB)
 
     key, vals = entry["key"], entry["vals"]
-    recList = calDB.search(pars.key==key)
+    recList = calDB.search(key) if isCalDB else calDB.search(pars.key==key)
     nRec = len(recList)
     if nRec == 0:
         if verbose: print("Record '%s' doesn't exist in the DB  Adding it ..." % key)
@@ -753,7 +1383,8 @@ def setDBRecord(entry, forceUpdate=False, dbFile="calDB.json", calDB=None, pars=
             if forceUpdate:
                 if verbose:
                     print("Updating record: ",key)
-                calDB.update(entry, pars.key==key)
+                if isCalDB: calDB.update(entry)
+                else: calDB.update(entry, pars.key==key)
     else:
         print("WARNING: Multiple records found for key '%s'.  Need to do some cleanup!!")
 
@@ -828,4 +1459,6 @@ def test():
 
 
 if __name__=="__main__":
-    test()
\ No newline at end of file
+    if "-time" in sys.argv: timeLoad()
+    elif "-cat" in sys.argv: buildCatalog("-force" in sys.argv, "-ent" in sys.argv)
+    else: test()
\ No newline at end of file
@@ -16,12 +16,13 @@ jobQueue = dsi.latSWDir+"/job.q"
 def main(argv):
 
     # defaults
-    global jobStr, useJobQueue
+    global jobStr, useJobQueue, groupLAT, stageLAT
     # jobStr = "sbatch slurm-job.sh" # SLURM mode
     jobStr = "sbatch pdsf.slr" # SLURM + Shifter mode
 
     dsNum, subNum, runNum, modNum = None, None, None, None
-    argString, calList, useJobQueue = None, [], False
+    argString, calList, useJobQueue, dropWF, groupLAT = None, [], False, False, False
+    stageLAT = ""
 
     # loop over user args
     for i,opt in enumerate(argv):
@@ -37,6 +38,9 @@ def main(argv):
         if opt == "-run": dsNum, runNum = int(argv[i+1]), int(argv[i+2])
         if opt == "-mod": modNum = int(argv[i+1])
         if opt == "-cal": calList = getCalRunList(dsNum,subNum,runNum)
+        if opt == "-nowf": dropWF = True
+        if opt == "-group": groupLAT = True
+        if opt == "-stage": stageLAT = " -stage %d %s" % (int(argv[i+1]), argv[i+2])
 
         # main skim routines
         if opt == "-skim":      runSkimmer(dsNum, subNum, runNum, calList=calList)
@@ -45,7 +49,11 @@ def main(argv):
         if opt == "-batchSplit": batchSplit(dsNum, subNum, runNum, calList=calList)
         if opt == "-writeCut":  writeCut(dsNum, subNum, runNum, calList=calList)
         if opt == "-lat":       runLAT(dsNum, subNum, runNum, calList=calList)
+        if opt == "-vsplit":    virtualSplit(dsNum, subNum, runNum, calList=calList)
+        if opt == "-vlat":      runLAT(dsNum, subNum, runNum, calList=calList, virtual=True)
         if opt == "-pandify":   pandifySkim(dsNum, subNum, runNum, calList=calList)
+        if opt == "-mergeLAT":  mergeLAT(dsNum, subNum, calList=calList, dropWF=dropWF)
+        if opt == "-mergef":    mergeFiles(argv[i+1], int(argv[i+2]), int(argv[i+3]), dropWF)
 
         # mega modes
         if opt == "-mskim":  [runSkimmer(i) for i in range(0,6+1)]
@@ -227,6 +235,11 @@ def runBatch():
     # sh("%s slurm.slr 'eval ./job-pump.sh jobs/test/test_${SLURM_ARRAY_TASK_ID}.ls python3 %d %d'" % getSBatch("edison-arr",nArr=2))
     # sh("%s slurm.slr 'eval ./job-pump.sh jobs/test/test_${SLURM_ARRAY_TASK_ID}.ls python3 %d %d'" % getSBatch("pdsf-arr",nArr=2))
 
+    # EX. 5b: Shared LAT work queue.  Fill it w/ './job-panda.py -q -lat' and './latq.py -q [dataDir]/latq -add job.q',
+    # then each array task starts a worker on its own node, which takes the next file whenever it has a free core.
+    # sbStr, nCores, peakLoad = getSBatch("edison-arr", nArr=9)
+    # sh("%s slurm.slr './latq.py -q %s/latq -work %d'" % (sbStr, dsi.dataDir, nCores))
+
     # EX. 5: Long calibration
     # sh("%s slurm.slr './job-pump.sh jobs/longSkim.ls skim_mjd_data %d %d'" % getSBatch("edison"))
     # sh("%s slurm.slr './job-pump.sh jobs/longWave.ls wave-skim %d %d'" % getSBatch("edison"))
@@ -291,7 +304,7 @@ def getCalRunList(dsNum=None,subNum=None,runNum=None):
     """
     runLimit = None # need all the stats we can get ...
     calList = []
-    calInfo = dsi.CalInfo()
+    calInfo = dsi.getCalInfo()
     calKeys = calInfo.GetKeys(dsNum)
 
     # single-run mode
@@ -336,7 +349,7 @@ def runSkimmer(dsNum, subNum=None, runNum=None, calList=[]):
     """ ./job-panda.py [-q] -skim (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
         Submit skim_mjd_data jobs.
     """
-    bkg = dsi.BkgInfo()
+    bkg = dsi.getBkgInfo()
 
     # bkg
     if not calList:
@@ -374,7 +387,7 @@ def runWaveSkim(dsNum, subNum=None, runNum=None, calList=[]):
     """ ./job-panda.py [-q] -wave (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
         Submit wave-skim jobs.
     """
-    bkg = dsi.BkgInfo()
+    bkg = dsi.getBkgInfo()
 
     # bkg
     if not calList:
@@ -412,7 +425,7 @@ def runAutoThresh(ds=None):
     """./job-panda.py [-q] [-ds dsNum] -thresh
     Generates auto-thresh jobs.  Default is to do it for all datasets.
     """
-    bkg = dsi.BkgInfo()
+    bkg = dsi.getBkgInfo()
     dsList = [ds] if ds is not None else [0,1,2,3,4,"5A","5B","5C",6]
     for ds in dsList:
         dsNum = ds if isinstance(ds, int) else 5
@@ -440,7 +453,7 @@ def splitTree(dsNum, subNum=None, runNum=None):
               (I couldn't get it to work within this function -- kept getting "file not closed" errors.)
               To clean up, do that with the 'writeCut' function below, potentially AFTER a big parallel job.
     """
-    from ROOT import TFile, TTree, gDirectory, TEntryList, TNamed, TObject, gROOT
+    from ROOT import TFile, TTree, TEntryList, TNamed, TObject, gROOT
 
     print("Splitting tree.  dsNum:",dsNum,"subNum:",subNum,"runNum:",runNum)
 
@@ -463,8 +476,7 @@ def splitTree(dsNum, subNum=None, runNum=None):
     inFile = TFile(inPath)
     bigTree = inFile.Get("skimTree")
     theCut = inFile.Get("theCut").GetTitle()
-    bigTree.Draw(">>elist",theCut,"entrylist")
-    elist = gDirectory.Get("elist")
+    elist = dsi.getEntryList(inPath, theCut, bigTree)
     bigTree.SetEntryList(elist)
     nList = elist.GetN()
 
@@ -483,7 +495,7 @@ def batchSplit(dsNum, subNum=None, runNum=None, calList=[]):
         NOTE: The data cleaning cut is NOT written into the output files and the
               function 'writeCut' must be called after these jobs are done.
     """
-    bkg = dsi.BkgInfo()
+    bkg = dsi.getBkgInfo()
 
     # bg
     if not calList:
@@ -539,6 +551,86 @@ def batchSplit(dsNum, subNum=None, runNum=None, calList=[]):
                 else: sh("""%s '%s'""" % (jobStr, job))
 
 
+def virtualSplit(dsNum, subNum=None, runNum=None, calList=[], nHitsPerSplit=20000):
+    """ ./job-panda.py -vsplit (-ds dsNum) (-sub dsNum subNum) (-run dsNum runNum) [-cal]
+
+        Alternative to splitTree/batchSplit/writeCut.  Instead of copying every waveSkim
+        file into ~50MB chunks, divide it into [firstEntry, lastEntry) ranges with about
+        'nHitsPerSplit' hits passing theCut in each, and save the ranges next to where the
+        split files would go (vsplitDS*.npz, read back with dsi.getVirtualSplits).
+        LAT then runs directly on the waveSkim file w/ './lat.py -e [lo] [hi]' (see runLAT).
+        Only reads the branches in theCut, so it's fast enough to run interactively.
+    """
+    bkg = dsi.getBkgInfo()
+
+    # make a list of [inPath, outPath] pairs
+    fileList = []
+    if not calList:
+        dsMap = bkg.dsMap()
+        # -ds
+        if subNum==None and runNum==None:
+            for i in range(dsMap[dsNum]+1):
+                fileList.append(["%s/waveSkimDS%d_%d.root" % (dsi.waveDir,dsNum,i),
+                                 "%s/vsplitDS%d_%d.npz" % (dsi.splitDir,dsNum,i)])
+        # -sub
+        elif runNum==None:
+            fileList.append(["%s/waveSkimDS%d_%d.root" % (dsi.waveDir,dsNum,subNum),
+                             "%s/vsplitDS%d_%d.npz" % (dsi.splitDir,dsNum,subNum)])
+        # -run
+        elif subNum==None:
+            fileList.append(["%s/waveSkimDS%d_run%d.root" % (dsi.waveDir,dsNum,runNum),
+                             "%s/vsplitDS%d_run%d.npz" % (dsi.splitDir,dsNum,runNum)])
+    # cal
+    else:
+        for run in calList:
+            dsNum = bkg.GetDSNum(run)
+            fileList.append(["%s/waveSkimDS%d_run%d.root" % (dsi.calWaveDir,dsNum,run),
+                             "%s/vsplitDS%d_run%d.npz" % (dsi.calSplitDir,dsNum,run)])
+
+    for inPath, outPath in fileList:
+        if not os.path.isfile(inPath):
+            print("File",inPath,"not found. Continuing ...")
+            continue
+        virtualSplitFile(inPath, outPath, nHitsPerSplit)
+
+
+def virtualSplitFile(inPath, outPath, nHitsPerSplit=20000):
+    """ Used by virtualSplit.  Balances the ranges by number of passing HITS,
+        since the LAT processing time is ~linear in the number of hits.
+        Saves: np.savez(outPath, edges, nHits, nEvts), where split i is [edges[i], edges[i+1]).
+    """
+    from ROOT import TFile
+    import numpy as np
+
+    inFile = TFile(inPath)
+    bigTree = inFile.Get("skimTree")
+    theCut = inFile.Get("theCut").GetTitle()
+    nEnt = bigTree.GetEntries()
+
+    # one row per hit passing the cut.  make sure the Draw buffer holds all of them
+    nHit = bigTree.Draw("Entry$",theCut,"goff")
+    if nHit > bigTree.GetEstimate():
+        bigTree.SetEstimate(nHit+1)
+        nHit = bigTree.Draw("Entry$",theCut,"goff")
+    hitEnt = bigTree.GetV1()
+    hitEnt = np.asarray([hitEnt[i] for i in range(nHit)], dtype=np.int64)
+
+    hitsPerEnt = np.bincount(hitEnt, minlength=nEnt)
+    cumHits = np.cumsum(hitsPerEnt)
+
+    # cut where the cumulative number of passing hits crosses each multiple of the target size
+    nSplit = max(1, int(np.ceil(nHit / float(nHitsPerSplit))))
+    target = nHit * np.arange(1, nSplit) / float(nSplit)
+    bounds = np.searchsorted(cumHits, target, side='left') + 1
+    edges = np.unique(np.concatenate(([0], bounds, [nEnt])))
+
+    nHits = np.array([hitsPerEnt[lo:hi].sum() for lo, hi in zip(edges[:-1], edges[1:])])
+    nEvts = np.array([np.count_nonzero(hitsPerEnt[lo:hi]) for lo, hi in zip(edges[:-1], edges[1:])])
+
+    np.savez(outPath, edges, nHits, nEvts)
+    print("%s: %d entries, %d passing hits, %d virtual splits -> %s" % (inPath.split("/")[-1], nEnt, nHit, len(edges)-1, outPath))
+
+
 def writeCut(dsNum, subNum=None, runNum=None, calList=[]):
     """ ./job-panda.py -writeCut (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
         Assumes the cut used in the FIRST file (even in the whole DS) should be applied
@@ -546,7 +638,7 @@ def writeCut(dsNum, subNum=None, runNum=None, calList=[]):
     """
     from ROOT import TFile, TNamed, TObject
     fileList = []
-    bkg = dsi.BkgInfo()
+    bkg = dsi.getBkgInfo()
 
     # bg
     if not calList:
@@ -555,15 +647,15 @@ def writeCut(dsNum, subNum=None, runNum=None, calList=[]):
         if subNum==None and runNum==None:
             for i in range(dsMap[dsNum]+1):
                 inPath = "%s/splitSkimDS%d_%d*" % (dsi.splitDir,dsNum,i)
-                fileList.extend(sorted(glob.glob(inPath)))
+                fileList.extend(sorted(dsi.globFiles(inPath)))
         # -sub
         elif runNum==None:
             inPath = "%s/splitSkimDS%d_%d*" % (dsi.splitDir,dsNum,subNum)
-            fileList.extend(sorted(glob.glob(inPath)))
+            fileList.extend(sorted(dsi.globFiles(inPath)))
         # -run
         elif subNum==None:
             inPath = "%s/splitSkimDS%d_run%d*" % (dsi.splitDir,dsNum,runNum)
-            fileList.extend(sorted(glob.glob(inPath)))
+            fileList.extend(sorted(dsi.globFiles(inPath)))
     # cal
     else:
         dsRanges = bkg.dsRanges()
@@ -572,7 +664,7 @@ def writeCut(dsNum, subNum=None, runNum=None, calList=[]):
                 if dsRanges[key][0] <= run <= dsRanges[key][1]:
                     dsNum=key
             inPath = "%s/splitSkimDS%d_run%d*" % (dsi.calSplitDir,dsNum,run)
-            fileList.extend(sorted(glob.glob(inPath)))
+            fileList.extend(sorted(dsi.globFiles(inPath)))
 
     # Pull the cut off the FIRST file and add it to the sub-files
     if len(fileList) <= 1:
@@ -589,11 +681,37 @@ def writeCut(dsNum, subNum=None, runNum=None, calList=[]):
         thisCut.Write("",TObject.kOverwrite)
 
 
-def runLAT(dsNum, subNum=None, runNum=None, calList=[]):
-    """ ./job-panda.py [-q] -lat (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
+def getLATInputs(dsNum, subNum=None, runNum=None, cal=False, virtual=False):
+    """ Used by runLAT.  Returns {splitIdx:[inFile, entryArgs]} for one bkg subset or run.
+        With 'virtual', every split points at the waveSkim file, and entryArgs
+        is the '-e [firstEntry] [lastEntry]' option for lat.py (see virtualSplit).
+    """
+    if not virtual:
+        sDir = dsi.calSplitDir if cal else dsi.splitDir
+        if runNum==None:
+            files = dsi.getSplitList("%s/splitSkimDS%d_%d*" % (sDir,dsNum,subNum),subNum)
+        else:
+            files = dsi.getSplitList("%s/splitSkimDS%d_run%d*" % (sDir,dsNum,runNum),runNum)
+        return {idx:[inFile, ""] for idx, inFile in files.items()}
+
+    wDir = dsi.calWaveDir if cal else dsi.waveDir
+    if runNum==None:
+        inFile = "%s/waveSkimDS%d_%d.root" % (wDir,dsNum,subNum)
+    else:
+        inFile = "%s/waveSkimDS%d_run%d.root" % (wDir,dsNum,runNum)
+    splits = dsi.getVirtualSplits(dsNum, subNum, runNum, cal)
+    return {idx:[inFile, " -e %d %d" % (lo, hi)] for idx, (lo, hi, nHits, nEvts) in splits.items()}
+
+
+def runLAT(dsNum, subNum=None, runNum=None, calList=[], virtual=False):
+    """ ./job-panda.py [-q] [-group] -lat (-ds dsNum) (-sub dsNum subNum) (-run dsNum subNum) [-cal]
+        ./job-panda.py [-q] [-group] -vlat (...) -- use virtual splits (run -vsplit first)
         Runs LAT on splitSkim output.  Does not combine output files back together.
+        With '-group' (must come BEFORE -lat/-vlat), each bkg subset or cal run is ONE job:
+        its inputs are written to ./jobs/lat/ and processed by a single 'lat.py -l' process.
+        Add '-stage [nAhead] [budgetGB]' to have that process read ahead from node-local scratch ($TMPDIR).
     """
-    bkg = dsi.BkgInfo()
+    bkg = dsi.getBkgInfo()
 
     # bg
     if not calList:
@@ -601,32 +719,32 @@ def runLAT(dsNum, subNum=None, runNum=None, calList=[]):
         # -ds
         if subNum==None and runNum==None:
             for subNum in range(dsMap[dsNum]+1):
-                files = dsi.getSplitList("%s/splitSkimDS%d_%d*" % (dsi.splitDir,dsNum,subNum),subNum)
-                for idx, inFile in sorted(files.items()):
+                files = getLATInputs(dsNum, subNum, virtual=virtual)
+                jobs = []
+                for idx, (inFile, eArgs) in sorted(files.items()):
                     outFile = "%s/latSkimDS%d_%d_%d.root" % (dsi.latDir,dsNum,subNum,idx)
-                    job = "./lat.py -b -r %d %d -p %s %s" % (dsNum,subNum,inFile,outFile)
+                    jobs.append([idx, inFile, outFile, eArgs, "./lat.py -b -r %d %d -p %s %s%s" % (dsNum,subNum,inFile,outFile,eArgs)])
 
                     # jspl = job.split() # make SUPER sure stuff is matched
                     # print(jspl[3],jspl[4],jspl[6].split("/")[-1],jspl[7].split("/")[-1])
 
-                    if useJobQueue: sh("%s >& ./logs/lat-ds%d-%d-%d.txt" % (job, dsNum, subNum, idx))
-                    else: sh("""%s '%s'""" % (jobStr, job))
+                submitLAT(dsNum, jobs, "ds%d-%d" % (dsNum, subNum))
         # -sub
         elif runNum==None:
-            files = dsi.getSplitList("%s/splitSkimDS%d_%d*" % (dsi.splitDir,dsNum,subNum),subNum)
-            for idx, inFile in sorted(files.items()):
+            files = getLATInputs(dsNum, subNum, virtual=virtual)
+            jobs = []
+            for idx, (inFile, eArgs) in sorted(files.items()):
                 outFile = "%s/latSkimDS%d_%d_%d.root" % (dsi.latDir,dsNum,subNum,idx)
-                job = "./lat.py -b -r %d %d -p %s %s" % (dsNum,subNum,inFile,outFile)
-                if useJobQueue: sh("%s >& ./logs/lat-ds%d-run%d-%d.txt" % (job, dsNum, subNum, idx))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                jobs.append([idx, inFile, outFile, eArgs, "./lat.py -b -r %d %d -p %s %s%s" % (dsNum,subNum,inFile,outFile,eArgs)])
+            submitLAT(dsNum, jobs, "ds%d-run%d" % (dsNum, subNum))
         # -run
         elif subNum==None:
-            files = dsi.getSplitList("%s/splitSkimDS%d_run%d*" % (dsi.splitDir,dsNum,runNum),runNum)
-            for idx, inFile in sorted(files.items()):
+            files = getLATInputs(dsNum, runNum=runNum, virtual=virtual)
+            jobs = []
+            for idx, (inFile, eArgs) in sorted(files.items()):
                 outFile = "%s/latSkimDS%d_run%d_%d.root" % (dsi.latDir,dsNum,runNum,idx)
-                job = "./lat.py -b -r %d %d -p %s %s" % (dsNum,runNum,inFile,outFile)
-                if useJobQueue: sh("%s >& ./logs/lat-ds%d-run%d-%d.txt" % (job, dsNum, runNum, idx))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                jobs.append([idx, inFile, outFile, eArgs, "./lat.py -b -r %d %d -p %s %s%s" % (dsNum,runNum,inFile,outFile,eArgs)])
+            submitLAT(dsNum, jobs, "ds%d-run%d" % (dsNum, runNum))
     # cal
     else:
         dsRanges = bkg.dsRanges()
@@ -634,20 +752,159 @@ def runLAT(dsNum, subNum=None, runNum=None, calList=[]):
             for key in dsRanges:
                 if dsRanges[key][0] <= run <= dsRanges[key][1]:
                     dsNum=key
-            files = dsi.getSplitList("%s/splitSkimDS%d_run%d*" % (dsi.calSplitDir,dsNum,run),run)
-            for idx, inFile in sorted(files.items()):
+            files = getLATInputs(dsNum, runNum=run, cal=True, virtual=virtual)
+            jobs = []
+            for idx, (inFile, eArgs) in sorted(files.items()):
                 outFile = "%s/latSkimDS%d_run%d_%d.root" % (dsi.calLatDir,dsNum,run,idx)
-                job = "./lat.py -b -f %d %d -p %s %s" % (dsNum,run,inFile,outFile)
-                if useJobQueue: sh("%s >& ./logs/lat-ds%d-run%d-%d.txt" % (job, dsNum, run, idx))
-                else: sh("""%s '%s'""" % (jobStr, job))
+                jobs.append([idx, inFile, outFile, eArgs, "./lat.py -b -f %d %d -p %s %s%s" % (dsNum,run,inFile,outFile,eArgs)])
+            submitLAT(dsNum, jobs, "ds%d-run%d" % (dsNum, run))
 
 
-def mergeLAT():
-    """ It seems like a good idea, right?
-        Merging all the LAT files back together after splitting?
-        Ehhh, maybe they're too large to handle.
+def submitLAT(dsNum, jobs, tag):
+    """ Used by runLAT.  'jobs' is a list of [idx, inFile, outFile, eArgs, lat.py command] for one subset or run.
+        Submits each command (log: ./logs/lat-[tag]-[idx].txt), or in '-group' mode,
+        writes the list to ./jobs/lat/latList-[tag].txt and submits one 'lat.py -l' job for all of them.
+    """
+    if not groupLAT:
+        for idx, inFile, outFile, eArgs, job in jobs:
+            if useJobQueue: sh("%s >& ./logs/lat-%s-%d.txt" % (job, tag, idx))
+            else: sh("""%s '%s'""" % (jobStr, job))
+        return
+    if len(jobs)==0: return
+
+    listFile = "./jobs/lat/latList-%s.txt" % tag
+    if not os.path.isdir(os.path.dirname(listFile)): os.makedirs(os.path.dirname(listFile))
+    with open(listFile, "w") as f:
+        for idx, inFile, outFile, eArgs, job in jobs:
+            f.write("%s %s%s\n" % (inFile, outFile, eArgs.replace(" -e", "")))
+    job = "./lat.py -b -l %d %s%s" % (dsNum, listFile, stageLAT)
+    if useJobQueue: sh("%s >& ./logs/lat-%s.txt" % (job, tag))
+    else: sh("""%s '%s'""" % (jobStr, job))
+
+
+def mergeLAT(dsNum=None, subNum=None, calList=[], dropWF=False):
+    """ ./job-panda.py [-q] -mergeLAT [-nowf] (-ds dsNum) (-sub dsNum subNum) [-cal]
+        Merge the split LAT output back together, into one file per bkgIdx
+        (latMergeDS*_*.root) or calIdx (latMerge_[key]_c*.root).
+        Submits one mergeFiles job per subset, so the subsets are merged in parallel.
+        The '-nowf' option (must come BEFORE -mergeLAT) drops the MGTWaveforms branch,
+        which is most of the file size and isn't used after LAT.
+        With -cal, the -sub option means a calibration range idx (like getCalRunList).
     """
-    print("hey")
+    wf = " -nowf" if dropWF else ""
+    jobList = []
+
+    # bg
+    if not calList:
+        bkg = dsi.getBkgInfo()
+        dsMap = bkg.dsMap()
+        subList = range(dsMap[dsNum]+1) if subNum==None else [subNum]
+        for sub in subList:
+            job = "./job-panda.py%s -mergef bkg %d %d" % (wf, dsNum, sub)
+            jobList.append([job, "merge-ds%d-%d" % (dsNum, sub)])
+    # cal
+    else:
+        cal = dsi.getCalInfo()
+        for key in cal.GetKeys(dsNum):
+            idxList = range(cal.GetIdxs(key)) if subNum==None else [subNum]
+            for idx in idxList:
+                job = "./job-panda.py%s -mergef %s %d %d" % (wf, key, int(key[2]), idx)
+                jobList.append([job, "merge-%s-c%d" % (key, idx)])
+
+    for job, logName in jobList:
+        if useJobQueue: sh("%s >& ./logs/%s.txt" % (job, logName))
+        else: sh("""%s '%s'""" % (jobStr, job))
+
+
+def getMergeFiles(key, dsNum, idx):
+    """ Used by mergeFiles.  Returns [inFiles, outPath], w/ the split files in order:
+        bkg ('key' is "bkg"): all latSkimDS[dsNum]_[idx]_*.root files,
+        cal ('key' is a cal key, e.g. "ds1_m1"): the latSkim files of every run in the calIdx.
+    """
+    if key == "bkg":
+        files = dsi.getSplitList("%s/latSkimDS%d_%d_*" % (dsi.latDir, dsNum, idx), idx)
+        inFiles = [f for _, f in sorted(files.items())]
+        outPath = "%s/latMergeDS%d_%d.root" % (dsi.mergeDir, dsNum, idx)
+    else:
+        cal = dsi.getCalInfo()
+        inFiles = []
+        for run in cal.GetCalList(key, idx):
+            files = dsi.getSplitList("%s/latSkimDS%d_run%d_*" % (dsi.calLatDir, dsNum, run), run)
+            inFiles.extend([f for _, f in sorted(files.items())])
+        outPath = "%s/latMerge_%s_c%d.root" % (dsi.calMergeDir, key, idx)
+    return inFiles, outPath
+
+
+def mergeFiles(key, dsNum, idx, dropWF=False):
+    """ ./job-panda.py [-nowf] -mergef [bkg or calKey] [dsNum] [bkgIdx or calIdx]
+        Merge one subset (see mergeLAT).  The baskets are copied w/o decompression
+        ("fast" clone), one file at a time, so this is I/O bound and needs little memory.
+        Writes theCut (all the files must have the same one, or nothing is merged), and an
+        entry-offset index next to the output (see dsi.getMergeIndex) so merged entries
+        can be mapped back to the split files.
+    """
+    from ROOT import TFile, TChain, TNamed, TObject
+    import numpy as np
+
+    inFiles, outPath = getMergeFiles(key, dsNum, idx)
+    if len(inFiles)==0:
+        print("No files found for %s DS-%d idx %d.  Exiting..." % (key, dsNum, idx))
+        return
+    print("Merging %d files into %s" % (len(inFiles), outPath))
+
+    # take the cut from the first file, and make sure the rest match
+    tf = TFile(inFiles[0])
+    theCut = tf.Get("theCut").GetTitle()
+    tf.Close()
+    badCut = []
+    for f in inFiles:
+        tf = TFile(f)
+        if tf.Get("theCut").GetTitle() != theCut: badCut.append(f)
+        tf.Close()
+    if len(badCut) > 0:
+        print("Error: cut in %d files doesn't match %s:" % (len(badCut), inFiles[0]))
+        for f in badCut: print("  ", f)
+        print("Re-run LAT on them, then merge again.  Exiting...")
+        return
+
+    # make the offset index
+    splitIdx, nEnt, runEvt = [], [], []
+    for f in inFiles:
+        tf = TFile(f)
+        tt = tf.Get("skimTree")
+        n = tt.GetEntries()
+        tt.SetBranchStatus("*",0)
+        tt.SetBranchStatus("run",1)
+        tt.SetBranchStatus("iEvent",1)
+        lo, hi = [-1,-1], [-1,-1]
+        if n > 0:
+            tt.GetEntry(0)
+            lo = [int(tt.run), int(tt.iEvent)]
+            tt.GetEntry(n-1)
+            hi = [int(tt.run), int(tt.iEvent)]
+        ints = list(map(int, re.findall(r'\d+', f.split("/")[-1])))
+        splitIdx.append(ints[2] if len(ints) > 2 else 0)
+        nEnt.append(n)
+        runEvt.append(lo + hi)
+        tf.Close()
+
+    nEnt = np.array(nEnt)
+    offsets = np.concatenate(([0], np.cumsum(nEnt)[:-1]))
+    if not os.path.isdir(os.path.dirname(outPath)): os.makedirs(os.path.dirname(outPath))
+    np.savez(outPath.replace(".root","_idx.npz"), np.array(inFiles), np.array(splitIdx), offsets, nEnt, np.array(runEvt))
+
+    # stream the trees into the output file
+    ch = TChain("skimTree")
+    for f in inFiles: ch.Add(f)
+    if dropWF:
+        ch.SetBranchStatus("MGTWaveforms",0)
+    outFile = TFile(outPath, "RECREATE")
+    out = ch.CloneTree(-1,"fast")
+    out.Write("",TObject.kOverwrite)
+    thisCut = TNamed("theCut",theCut)
+    thisCut.Write("",TObject.kOverwrite)
+    print("Wrote %d entries (expected %d)." % (out.GetEntries(), np.sum(nEnt)))
+    outFile.Close()
 
 
 def pandifySkim(dsNum, subNum=None, runNum=None, calList=[]):
@@ -656,7 +913,7 @@ def pandifySkim(dsNum, subNum=None, runNum=None, calList=[]):
     """
     # bg
     if not calList:
-        bkg = dsi.BkgInfo()
+        bkg = dsi.getBkgInfo()
         dsMap = bkg.dsMap()
         # -ds
         if subNum==None and runNum==None:
@@ -687,7 +944,7 @@ def tuneCuts(argString, dsNum=None):
     Options for argString:
         -all, -bcMax, -noiseWeight, -bcTime, -tailSlope, -fitSlo, -riseNoise
     """
-    calInfo = dsi.CalInfo()
+    calInfo = dsi.getCalInfo()
     if dsNum==None:
         for i in dsi.dsMap.keys():
             if i == 6: continue
@@ -763,7 +1020,7 @@ def shifterTest():
 
 def specialSkim():
     """ ./job-panda.py [-q (use job queue)] -sskim """
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
     # runList = cal.GetSpecialRuns("extPulser")
     # runList = cal.GetSpecialRuns("delayedTrigger")
     # runList = cal.GetSpecialRuns("longCal",5)
@@ -778,7 +1035,7 @@ def specialSkim():
 
 def specialWave():
     """ ./job-panda.py [-q (use queue)] -swave """
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
     # runList = cal.GetSpecialRuns("extPulser")
     # runList = cal.GetSpecialRuns("longCal",5)
     runList = cal.GetSpecialRuns("forcedAcq",8)
@@ -795,7 +1052,7 @@ def specialSplit():
     External pulser runs have no data cleaning cut.
     Has a memory leak (can't close both TFiles, damn you, ROOT); submit each run as a batch job.
     """
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
     # runList = cal.GetSpecialRuns("extPulser")
     # runList = cal.GetSpecialRuns("longCal",5)
     runList = cal.GetSpecialRuns("forcedAcq",8)
@@ -835,7 +1092,7 @@ def specialWrite():
     Write TCuts from waveSkim files into splitSkim files.
     """
     from ROOT import TFile, TNamed, TObject
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
     runList = cal.GetSpecialRuns("longCal",5)
 
     for run in runList:
@@ -911,7 +1168,7 @@ def specialDelete():
 
 def specialLAT():
     """ ./job-panda.py [-q (use job queue)] -slat"""
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
     # runList = cal.GetSpecialRuns("extPulser")
     # runList = cal.GetSpecialRuns("longCal",5)
     runList = cal.GetSpecialRuns("forcedAcq",8)
@@ -955,7 +1212,7 @@ def specialCheck():
     A next step could be to 'hadd' split files back together, but we'll wait for now.
     """
     from ROOT import TFile, TTree
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
     runList = cal.GetSpecialRuns("extPulser")
     for run in runList:
         fileList = glob.glob("%s/lat/latSkimDS%d_run%d_*.root" % (dsi.specialDir, dsi.GetDSNum(run), run))
@@ -981,7 +1238,7 @@ def specialBuild():
     auto-thresh 5942
     process_mjd_gat OR_*.root
     """
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
     rawDir = "/global/project/projectdirs/majorana/data/mjd/surfmjd/data/raw/P3JDY/Data"
     buildDir = dsi.dataDir + "/mjddatadir"
     os.chdir(buildDir)
@@ -1068,7 +1325,7 @@ def scanLAT2(dsIn=None, subIn=None, modIn=None):
     """ ./job-panda.py [-q] -lat2 """
 
     skipDS6Cal = True
-    cal = dsi.CalInfo()
+    cal = dsi.getCalInfo()
 
     # loop over datasets, skipping DS6 cal runs till they're processed
     for ds in [0,1,2,3,4,5,6]:
@@ -7,7 +7,7 @@ C. Wiseman, USC
 v1. 17 Apr 2018
 ======================
 """
-import sys, time
+import sys, os, time
 import numpy as np
 import tinydb as db
 
@@ -20,9 +20,7 @@ from matplotlib.colors import LogNorm, Normalize
 
 import waveLibs as wl
 import dsi
-bkg = dsi.BkgInfo()
-cal = dsi.CalInfo()
-det = dsi.DetInfo()
+bkg, cal, det = dsi.bkg, dsi.cal, dsi.det # loaded on first use
 skipDS6Cal = True # ignore DS6 cal runs until they're processed
 
 
@@ -95,7 +93,7 @@ def scanRuns(ds, key, mod, cIdx):
     chList = det.getGoodChanList(ds)
 
     print("Scanning DS:%d  calIdx %d  mod %d  key %s  nFiles:%d" % (ds, cIdx, mod, key, len(fileList)), time.strftime('%X %x %Z'))
-    outFile = "%s/eff_%s_c%d.npz" % (dsi.effDir, key, cIdx)
+    outFile = "%s/eff_%s_c%d" % (dsi.effDir, key, cIdx)
     print("Saving output in:",outFile)
 
     # declare the output stuff
@@ -104,51 +102,44 @@ def scanRuns(ds, key, mod, cIdx):
     fLo, fHi, fpb = -200, 400, 1
     nbf = int((fHi-fLo)/fpb)+1
     fSloSpec = {ch:[np.zeros(nbf) for i in range(3)] for ch in chList} # 0-10, 10-200, 236-240
+    x = np.linspace(fLo, fHi, nbf) - fpb/2. # bin centers, same as wl.GetHisto
+    chSorted = np.asarray(sorted(chList))
 
-    # loop over LAT cal files
+    # loop over LAT cal files.
+    # each file's contribution is cached (see getPartial), so only new or changed files are read.
     scanStart = time.time()
     prevRun = 0
     evtCtr, totCtr, totRunTime = 0, 0, 0
+    nRead = 0
     for iF, f in enumerate(fileList):
 
         print("%d/%d %s" % (iF, len(fileList), f))
-        tf = TFile(f)
-        tt = tf.Get("skimTree")
-
-        # histogram these for each file (and then add to total)
-        fs10 = {ch:[] for ch in chList}
-        fs200 = {ch:[] for ch in chList}
-        fs238 = {ch:[] for ch in chList}
+        part = loadPartial(f, chSorted, fLo, fHi, fpb)
+        tf, tt = None, None
+        if part is None:
+            tf = TFile(f)
+            tt = tf.Get("skimTree")
+            part = getFileInfo(tt, chSorted)
 
         # increment the run time and fill the output dict of thresholds
-        tt.GetEntry(0)
-        run = tt.run
+        run = part["run"]
         if run!=prevRun:
-            start = tt.startTime_s
-            stop = tt.stopTime_s
+            start, stop = part["start"], part["stop"]
             runTime = stop-start
             if runTime < 0 or runTime > 9999:
                 print("run time error, run",run,"start",start,"stop")
             else:
                 totRunTime += runTime
 
-            # find thresholds for this run,
-            # to calculate sumET and mHT in the loop.
+            # thresholds for this run (found in its first file),
+            # to calculate sumET and mHT.
             # save them into the output dict (so we can compare w/ DB later).
-
-            n = tt.Draw("channel:threshKeV:threshSigma","","goff")
-            chan, thrM, thrS = tt.GetV1(), tt.GetV2(), tt.GetV3()
             tmpThresh = {}
-            for i in range(n):
-                if chan[i] not in chList:
-                    continue
-                if chan[i] in tmpThresh.keys():
-                    continue
-                if thrM[i] < 9999:
-                    thrK = thrM[i] + 3*thrS[i]
-                    tmpThresh[chan[i]] = [run,thrM[i],thrS[i],thrK]
-            for ch in chList:
-                if ch not in tmpThresh.keys():
+            for iC, ch in enumerate(chSorted):
+                if part["thrFound"][iC]:
+                    thrM, thrS = part["thrM"][iC], part["thrS"][iC]
+                    tmpThresh[ch] = [run,thrM,thrS,thrM + 3*thrS]
+                else:
                     tmpThresh[ch] = [-1,-1,-1,-1]
 
             # fill the output dict
@@ -156,70 +147,36 @@ def scanRuns(ds, key, mod, cIdx):
                 thrCal[ch].append(tmpThresh[ch]) # [run, thrM, thrS, thrK]
 
         prevRun = run
-        # continue
-
-        # loop over tree
-        for iE in range(tt.GetEntries()):
-            tt.GetEntry(iE)
-            if tt.EventDC1Bits != 0: continue
-            totCtr += 1
-
-            n = tt.channel.size()
-            chTmp = np.asarray([tt.channel.at(i) for i in range(n)])
-            idxRaw = [i for i in range(tt.channel.size()) if tt.channel.at(i) in chList]
-            hitERaw = np.asarray([tt.trapENFCal.at(i) for i in idxRaw])
-
-            # get indexes of hits above threshold (use thresholds from THIS CAL RUN)
-            idxList = [i for i in range(tt.channel.size())
-                if tt.channel.at(i) in chList
-                and tt.trapENFCal.at(i) > tmpThresh[tt.channel.at(i)][3]
-                and 0.7 < tt.trapENFCal.at(i) < 9999
-                ]
-            hitE = np.asarray([tt.trapENFCal.at(i) for i in idxList])
-
-            # calculate mHT and sumET
-            mHT, sumET = len(hitE), sum(hitE)
-
-            # save fitSlo data for 0-10 and 10-200 kev ranges for each channel
-            for i in idxList:
-                en = tt.trapENFCal.at(i)
-                ch = tt.channel.at(i)
-                fs = tt.fitSlo.at(i)
-                if fLo < fs < fHi:
-                    if 0 < en < 10:
-                        fs10[ch].append(fs)
-                    if 10 < en < 200:
-                        fs200[ch].append(fs)
-                    if 236 < en < 240:
-                        fs238[ch].append(fs)
-
-            # Save m2s238 events to output, skip everything else
-            if mHT!=2: continue
-            if not 237.28 < sumET < 239.46: continue
-            hitChans = np.asarray([tt.channel.at(i) for i in idxList])
-            hitSlo = np.asarray([tt.fitSlo.at(i) for i in idxList])
-            hitRise = np.asarray([tt.riseNoise.at(i) for i in idxList])
-            evtIdx.append([run,iE])
-            evtSumET.append(sumET)
-            evtHitE.append(hitE)
-            evtChans.append(hitChans)
-            evtSlo.append(hitSlo)
-            evtRise.append(hitRise)
 
+        # the hits depend on the thresholds of the run, so re-read them if those changed
+        thrK = np.asarray([tmpThresh[ch][3] for ch in chSorted], dtype=np.float64)
+        if "thrK" not in part or not np.array_equal(part["thrK"], thrK):
+            if tt is None:
+                tf = TFile(f)
+                tt = tf.Get("skimTree")
+            part.update(getFileInfo(tt, chSorted))
+            part.update(getFileHits(tt, chSorted, thrK, fLo, fHi, fpb))
+            savePartial(f, part, chSorted, fLo, fHi, fpb)
+            nRead += 1
+        if tf is not None:
+            tf.Close()
+
+        # add this file's results to the totals
+        totCtr += part["totCtr"]
+        spec = part["spec"]
+        for iC, ch in enumerate(chSorted):
+            for iR in range(3):
+                fSloSpec[ch][iR] += spec[iR, iC]
+        for iEvt in range(len(part["evtSumET"])):
+            evtIdx.append([run,int(part["evtEnt"][iEvt])])
+            evtSumET.append(part["evtSumET"][iEvt])
+            evtHitE.append(part["evtHitE"][iEvt])
+            evtChans.append(part["evtChans"][iEvt])
+            evtSlo.append(part["evtSlo"][iEvt])
+            evtRise.append(part["evtRise"][iEvt])
             evtCtr += 1
 
-        # fill the fitSlo histograms w/ the events from this file
-        for ch in chList:
-            x, h1 = wl.GetHisto(fs10[ch],fLo,fHi,fpb)
-            x, h2 = wl.GetHisto(fs200[ch],fLo,fHi,fpb)
-            x, h3 = wl.GetHisto(fs238[ch],fLo,fHi,fpb)
-            fSloSpec[ch][0] = np.sum([fSloSpec[ch][0], h1], axis=0)
-            fSloSpec[ch][1] = np.sum([fSloSpec[ch][1], h2], axis=0)
-            fSloSpec[ch][2] = np.sum([fSloSpec[ch][2], h3], axis=0)
-            # n1 = np.sum(fSloSpec[ch][0])
-            # n2 = np.sum(fSloSpec[ch][1])
-            # n3 = np.sum(fSloSpec[ch][2])
-            # print("ch:%d  n10 %d  n200 %d  n238 %d" % (ch, n1, n2, n3))
+    print("Read %d of %d files (the rest were cached)." % (nRead, len(fileList)))
 
     # get average threshold for each channel in this file list
     thrFinal = {chan:[] for chan in thrCal}
@@ -249,13 +206,219 @@ def scanRuns(ds, key, mod, cIdx):
         print("%d  %.3f  %.3f  %s" % (chan,thKeV,thE,errString))
 
     # save output
-    np.savez(outFile, evtIdx, evtSumET, evtHitE, evtChans, thrCal, thrFinal, evtCtr, totCtr, totRunTime, fSloSpec, x, evtSlo, evtRise)
+    evtIdx = np.asarray(evtIdx, dtype=np.int64).reshape(-1,2)
+    meta = {"ds":ds, "key":key, "mod":mod, "cIdx":cIdx, "evtCtr":evtCtr, "totCtr":totCtr, "totRunTime":float(totRunTime),
+            "fLo":fLo, "fHi":fHi, "fpb":fpb, "ranges":[[0,10],[10,200],[236,240]]}
+    thrCalTab = [(ch, run, thrM, thrS, thrK) for ch in sorted(thrCal) for run, thrM, thrS, thrK in thrCal[ch]]
+    thrFinalTab = [(ch, thrFinal[ch][0], thrFinal[ch][1]) for ch in sorted(thrFinal)]
+    saveEff(outFile, meta, {
+        "chans": chSorted,
+        "x": x,
+        "fSloSpec": np.asarray([fSloSpec[ch] for ch in chSorted]).reshape(len(chSorted),3,nbf),
+        "evtRun": evtIdx[:,0],
+        "evtEnt": evtIdx[:,1],
+        "evtSumET": np.asarray(evtSumET, dtype=np.float64),
+        "evtHitE": np.asarray(evtHitE, dtype=np.float64).reshape(-1,2),
+        "evtChans": np.asarray(evtChans, dtype=np.int64).reshape(-1,2),
+        "evtSlo": np.asarray(evtSlo, dtype=np.float64).reshape(-1,2),
+        "evtRise": np.asarray(evtRise, dtype=np.float64).reshape(-1,2),
+        "thrCal": np.array(thrCalTab, dtype=[("chan","i8"),("run","i8"),("thrM","f8"),("thrS","f8"),("thrK","f8")]),
+        "thrFinal": np.array(thrFinalTab, dtype=[("chan","i8"),("thrAvg","f8"),("thrDev","f8")])
+        })
 
     # output stats
     print("Done:",time.strftime('%X %x %Z'),", %.2f sec/file." % ((time.time()-scanStart)/len(fileList)))
     print("  m2s238 evts:",evtCtr, "total evts:",totCtr, "runTime:",totRunTime)
 
 
+def getFileInfo(tt, chSorted):
+    """ Used by scanRuns.  Run number, start/stop time, and the first threshold
+    (threshKeV, threshSigma) found in the file for each channel in chSorted.
+    """
+    tt.GetEntry(0)
+    info = {"run":int(tt.run), "start":tt.startTime_s, "stop":tt.stopTime_s}
+    n = tt.Draw("channel:threshKeV:threshSigma","","goff")
+    chan, thrM, thrS = tt.GetV1(), tt.GetV2(), tt.GetV3()
+    tmpThresh = {}
+    for i in range(n):
+        if chan[i] in tmpThresh.keys():
+            continue
+        if thrM[i] < 9999:
+            tmpThresh[chan[i]] = [thrM[i],thrS[i]]
+    info["thrFound"] = np.asarray([ch in tmpThresh for ch in chSorted])
+    info["thrM"] = np.asarray([tmpThresh[ch][0] if ch in tmpThresh else -1 for ch in chSorted], dtype=np.float64)
+    info["thrS"] = np.asarray([tmpThresh[ch][1] if ch in tmpThresh else -1 for ch in chSorted], dtype=np.float64)
+    return info
+
+
+def getFileHits(tt, chSorted, thrK, fLo, fHi, fpb):
+    """ Used by scanRuns.  One file's contribution to the output, given the
+    thresholds 'thrK' (one per channel in chSorted) of its run:
+    number of events, the fitSlo spectra [range, channel, bin], and the m2s238 events.
+    """
+    nbf = int((fHi-fLo)/fpb)+1
+    res = {"thrK":thrK}
+
+    # read the hits of every event passing the DC cut at once (one row per hit)
+    res["totCtr"] = int(tt.GetEntries("EventDC1Bits==0"))
+    ent, hitCh, hitE, hitSlo, hitRise = wl.GetDrawArrays(tt, ["Entry$","channel","trapENFCal","fitSlo","riseNoise"], "EventDC1Bits==0")
+    ent, hitCh = ent.astype(np.int64), hitCh.astype(np.int64)
+
+    # keep hits above threshold (use thresholds from THIS CAL RUN)
+    pos = np.minimum(np.searchsorted(chSorted, hitCh), len(chSorted)-1)
+    idx = (chSorted[pos] == hitCh) & (hitE > thrK[pos]) & (0.7 < hitE) & (hitE < 9999)
+    ent, hitCh, hitE, hitSlo, hitRise, pos = ent[idx], hitCh[idx], hitE[idx], hitSlo[idx], hitRise[idx], pos[idx]
+
+    # calculate mHT and sumET of each event (rows are sorted by entry)
+    evts, iLo, mHT = np.unique(ent, return_index=True, return_counts=True)
+    sumET = np.add.reduceat(hitE, iLo) if len(iLo) > 0 else np.zeros(0)
+
+    # fill the fitSlo histograms for 0-10, 10-200, and 236-240 kev ranges for each channel
+    inRange = (fLo < hitSlo) & (hitSlo < fHi)
+    iBin = np.floor((hitSlo - fLo)/fpb).astype(np.int64) + 1 # same bins as wl.GetHisto (bin 0 is empty)
+    res["spec"] = np.zeros((3, len(chSorted), nbf), dtype=np.int64)
+    for iR, (eLo, eHi) in enumerate([(0,10),(10,200),(236,240)]):
+        sel = inRange & (eLo < hitE) & (hitE < eHi)
+        res["spec"][iR] = np.bincount(pos[sel]*nbf + iBin[sel], minlength=len(chSorted)*nbf).reshape(len(chSorted),nbf)
+
+    # m2s238 events (always 2 hits, so these are [nEvt,2] arrays)
+    iEvt = np.flatnonzero((mHT==2) & (237.28 < sumET) & (sumET < 239.46))
+    hits = (iLo[iEvt][:,None] + np.arange(2)).reshape(-1,2) if len(iEvt) > 0 else np.zeros((0,2), dtype=np.int64)
+    res["evtEnt"] = evts[iEvt]
+    res["evtSumET"] = sumET[iEvt]
+    res["evtHitE"] = hitE[hits]
+    res["evtChans"] = hitCh[hits]
+    res["evtSlo"] = hitSlo[hits]
+    res["evtRise"] = hitRise[hits]
+    return res
+
+
+def getPartialPath(f):
+    return "%s/partial/%s.npz" % (dsi.effDir, os.path.basename(f).split(".root")[0])
+
+
+def loadPartial(f, chSorted, fLo, fHi, fpb):
+    """ Used by scanRuns.  Load the cached result of getFileInfo+getFileHits for LAT file 'f'.
+    Returns None if the file, the channel list, or the binning changed since it was saved.
+    """
+    pPath = getPartialPath(f)
+    if not os.path.isfile(pPath):
+        return None
+    st = os.stat(f)
+    try:
+        p = np.load(pPath)
+        stamp = p["stamp"]
+        if stamp[0] != st.st_size or stamp[1] != st.st_mtime or not np.array_equal(p["binning"], [fLo, fHi, fpb]):
+            return None
+        if not np.array_equal(p["chSorted"], chSorted):
+            return None
+        part = {key:p[key] for key in p.files}
+    except (IOError, ValueError, KeyError) as e:
+        print("Couldn't read cached result %s (%s)" % (pPath, str(e)))
+        return None
+    for key in ["run","totCtr"]:
+        part[key] = int(part[key])
+    for key in ["start","stop"]:
+        part[key] = part[key].item()
+    part["spec"] = part["spec"].astype(np.int64)
+    return part
+
+
+def savePartial(f, part, chSorted, fLo, fHi, fpb):
+    """ Used by scanRuns.  Save one file's result, keyed by the LAT file's path, size and mtime. """
+    pPath = getPartialPath(f)
+    if not os.path.isdir(os.path.dirname(pPath)):
+        os.makedirs(os.path.dirname(pPath))
+    st = os.stat(f)
+    tmpFile = "%s.%d.tmp.npz" % (pPath.split(".npz")[0], os.getpid())
+    np.savez(tmpFile, stamp=np.asarray([st.st_size, st.st_mtime]), binning=np.asarray([fLo, fHi, fpb]), chSorted=chSorted, **part)
+    os.replace(tmpFile, pPath)
+
+
+effVersion = 1
+effDatasets = {
+    "chans":    "(nCh) channels, sorted.  row index of the per-channel arrays",
+    "x":        "(nBin) fitSlo bin centers of the spectra",
+    "fSloSpec": "(nCh, 3, nBin) fitSlo spectrum of each channel, for each energy range in meta['ranges']",
+    "evtRun":   "(nEvt) run of each m2s238 event",
+    "evtEnt":   "(nEvt) entry of each m2s238 event in its LAT file",
+    "evtSumET": "(nEvt) sum energy of each m2s238 event",
+    "evtHitE":  "(nEvt, 2) hit energies",
+    "evtChans": "(nEvt, 2) hit channels",
+    "evtSlo":   "(nEvt, 2) hit fitSlo",
+    "evtRise":  "(nEvt, 2) hit riseNoise",
+    "thrCal":   "table (chan, run, thrM, thrS, thrK), one row per channel per run.  -1: no threshold",
+    "thrFinal": "table (chan, thrAvg, thrDev), average threshold (thrK) of each channel"
+    }
+
+def saveEff(outDir, meta, data):
+    """ Save the output of scanRuns as a directory of .npy files (one per dataset in 'effDatasets')
+    plus 'meta.json' w/ the scalars (evtCtr, totCtr, totRunTime, binning, ...) and a description
+    of each dataset.  No pickled objects, so any dataset can be memory-mapped (see EffFile).
+    """
+    import json, shutil
+    tmpDir = "%s.%d.tmp" % (outDir, os.getpid())
+    if os.path.isdir(tmpDir): shutil.rmtree(tmpDir)
+    os.makedirs(tmpDir)
+    meta = dict(meta)
+    meta["version"] = effVersion
+    meta["datasets"] = {}
+    for name in data:
+        np.save("%s/%s.npy" % (tmpDir, name), data[name])
+        meta["datasets"][name] = {"shape":list(data[name].shape), "dtype":str(data[name].dtype), "desc":effDatasets.get(name,"")}
+    with open("%s/meta.json" % tmpDir, "w") as f:
+        json.dump(meta, f, indent=2)
+    if os.path.isdir(outDir): shutil.rmtree(outDir)
+    os.rename(tmpDir, outDir)
+
+
+class EffFile:
+    """ Lazy reader for the output of scanRuns.  Datasets are memory-mapped the first time they're used.
+    Ex:  eff = EffFile("%s/eff_ds1_m1_c1" % dsi.effDir)
+         h = eff.getSpec(ch, 0)    # 0-10 keV fitSlo spectrum of one channel
+         eff["evtSumET"], eff.meta["totRunTime"]
+    Also reads the old eff_*.npz files (those have to be loaded all at once).
+    """
+    def __init__(self, path):
+        import json
+        self.path = path
+        self.data = {}
+        if path.endswith(".npz"):
+            self.loadNPZ(path)
+        else:
+            with open("%s/meta.json" % path) as f:
+                self.meta = json.load(f)
+        self.chIdx = {int(ch):i for i, ch in enumerate(self["chans"])}
+
+    def __getitem__(self, name):
+        if name not in self.data:
+            self.data[name] = np.load("%s/%s.npy" % (self.path, name), mmap_mode='r')
+        return self.data[name]
+
+    def getSpec(self, ch, iRange):
+        """ fitSlo spectrum of channel 'ch' in energy range 'iRange' (index of meta['ranges']) """
+        return self["fSloSpec"][self.chIdx[ch], iRange]
+
+    def loadNPZ(self, path):
+        """ Convert the old positional format """
+        f = np.load(path)
+        thrCal, thrFinal, fSloSpec = f['arr_4'].item(), f['arr_5'].item(), f['arr_9'].item()
+        chans = np.asarray(sorted(fSloSpec))
+        evtIdx = np.asarray(f['arr_0'], dtype=np.int64).reshape(-1,2)
+        self.meta = {"evtCtr":int(f['arr_6']), "totCtr":int(f['arr_7']), "totRunTime":float(f['arr_8']),
+                     "ranges":[[0,10],[10,200],[236,240]]}
+        self.data = {
+            "chans":chans, "x":f['arr_10'],
+            "fSloSpec":np.asarray([fSloSpec[ch] for ch in chans]),
+            "evtRun":evtIdx[:,0], "evtEnt":evtIdx[:,1], "evtSumET":f['arr_1'],
+            "evtHitE":f['arr_2'], "evtChans":f['arr_3'], "evtSlo":f['arr_11'], "evtRise":f['arr_12'],
+            "thrCal":np.array([(ch, r, m, s, k) for ch in sorted(thrCal) for r, m, s, k in thrCal[ch]],
+                dtype=[("chan","i8"),("run","i8"),("thrM","f8"),("thrS","f8"),("thrK","f8")]),
+            "thrFinal":np.array([(ch, thrFinal[ch][0], thrFinal[ch][1]) for ch in sorted(thrFinal)],
+                dtype=[("chan","i8"),("thrAvg","f8"),("thrDev","f8")])
+            }
+
+
 def getHistInfo(x,h):
     """ Computes max, mean, width, percentiles of a numpy
     array based histogram , w/ x values 'x' and counts 'h'. """
@@ -279,28 +442,27 @@ def getStats():
 
     makePlots = False
 
-    # fname = "/global/projecta/projectdirs/majorana/users/wisecg/cal/eff/eff_ds1_m1_c1.npz"
-    fname = "/global/projecta/projectdirs/majorana/users/wisecg/cal/eff/eff_ds0_m1_c16.npz"
+    # fname = "%s/eff_ds1_m1_c1" % dsi.effDir
+    fname = "%s/eff_ds0_m1_c16" % dsi.effDir
     key = fname.split('/')[-1].split(".")[0]
     tmp = key.split("_")
     ds, mod, cIdx = tmp[1], tmp[2], tmp[3]
     print("Scanning:",key)
 
-    f1 = np.load(fname)
-    fSloSpec = f1['arr_9'].item()
-    x = f1['arr_10']
+    eff = EffFile(fname)
+    x = eff["x"]
 
     fig = plt.figure(figsize=(18,6))
     p1 = plt.subplot(131)
     p2 = plt.subplot(132)
     p3 = plt.subplot(133)
 
-    chList = sorted(list(fSloSpec.keys()))
+    chList = [int(ch) for ch in eff["chans"]]
     for ch in chList:
 
-        h1 = fSloSpec[ch][0] # 0-10 keV
-        h2 = fSloSpec[ch][1] # 10-200 keV
-        h3 = fSloSpec[ch][2] # 236-240 keV
+        h1 = eff.getSpec(ch,0) # 0-10 keV
+        h2 = eff.getSpec(ch,1) # 10-200 keV
+        h3 = eff.getSpec(ch,2) # 236-240 keV
 
         max1, avg1, std1, pct1, wid1 = getHistInfo(x,h1)
         max2, avg2, std2, pct2, wid2 = getHistInfo(x,h2)
@@ -10,18 +10,28 @@ Usage Examples:
         ./lat3.py -tune /path/to/calib/files -db -s DS subDS Module -ch channel -bcMax
     Custom cut:
         ./lat3.py -tune /path/to/calib/files -db -s DS subDS Module -Custom "bcMax/bcMin"
-    Applying cuts:
+    Tuning w/ every cal run (streaming quantile sketches, optional sketch size k):
+        ./lat3.py -tune /path/to/calib/files -db -s DS subDS Module -all -sketch [-k 1000]
+    Merging the sketch files of separate jobs (ex. one per channel) into DB records:
+        ./lat3.py -mergeSketch "./output/sketch_ds1_idx0_m1*.npz" -db -s DS subDS Module
+    Applying cuts (cutType 'all' writes all seven combinations from one read):
         ./lat3.py -cut [dsNum] [cutType] [dataType]
+    Remaking diagnostic plots from saved data (no trees are read):
+        ./lat3.py -replot ["riseNoise_ds1_idx*"]
+    Saving every cut once, as per-hit bits, then writing files for one combination (ex. fs+rn+th):
+        ./lat3.py -bits [dsNum] [dataType]
+        ./lat3.py -mat [dsNum] [cutType] [dataType]
 v1: 03 Oct 2017
 ========= C. Wiseman (USC), B. Zhu (LANL) =========
 """
-import sys, time, ROOT, glob
+import sys, os, time, ROOT, glob
 sys.argv += [ '-b' ] # force ROOT to be loaded in batch mode.
 from ROOT import gROOT, gStyle, gPad
 from ROOT import TFile, TTree, TChain, TCanvas, TH1D, TH2D, TF1, TLegend, TLine, TGraph, TNamed
 import numpy as np
 from DataSetInfo import CalInfo
 import DataSetInfo as ds
+import dsi
 import waveLibs as wl
 from scipy.stats import mode
 from scipy.optimize import curve_fit
@@ -42,6 +52,7 @@ def main(argv):
     customPar = ""
     tuneNames, calList, parList, parNameList, chList = [], [], [], [], []
     fTune, fFor, fastMode, fDB, fCSV = False, False, False, False, False
+    fSketch, sketchK, sketchFiles = False, 1000, []
 
     if len(argv) == 0:
         return
@@ -103,6 +114,15 @@ def main(argv):
         if opt == "-db":
             fDB = True
             print "DB mode"
+        if opt == "-sketch":
+            fSketch = True
+            print "Using quantile sketches and ALL cal runs (no diagnostic plots)"
+        if opt == "-k":
+            sketchK = int(argv[i+1])
+            print "Sketch size k = %d" % sketchK
+        if opt == "-mergeSketch":
+            sketchFiles = sorted(glob.glob(argv[i+1]))
+            print "Merging %d sketch files" % len(sketchFiles)
 
         # -- Database options --
         if opt == "-force":
@@ -123,14 +143,35 @@ def main(argv):
             stopT = time.clock()
             print "Stopped:",time.strftime('%X %x %Z'),"\nProcess time (min):",(stopT - startT)/60
             return
+        if opt == "-replot":
+            RePlot(argv[i+1] if i+1 < len(argv) and not argv[i+1].startswith("-") else "*")
+            return
+        if opt == "-bits":
+            dsNum, dType = int(argv[i+1]), argv[i+2]
+            print "Saving cut bits for DS-%d (%s)..." % (dsNum, dType)
+            WriteCutBits(dsNum, dType)
+            stopT = time.clock()
+            print "Stopped:",time.strftime('%X %x %Z'),"\nProcess time (min):",(stopT - startT)/60
+            return
+        if opt == "-mat":
+            dsNum, cutType, dType = int(argv[i+1]), argv[i+2], argv[i+3]
+            print "Writing %s files for DS-%d (%s) from the cut bits..." % (cutType, dsNum, dType)
+            MaterializeCut(dsNum, cutType, dType)
+            stopT = time.clock()
+            print "Stopped:",time.strftime('%X %x %Z'),"\nProcess time (min):",(stopT - startT)/60
+            return
 
     # -- Load calibration files --
     if dsNum == -1 or subNum == -1 or modNum == -1:
         print "DS, subDS, or module number not set properly, exiting"
         return
+    elif sketchFiles:
+        SketchesToDB(dsNum, subNum, modNum, sketchFiles, fDB, fFor)
+        return
     elif fTune:
         # Limit to 10 calibration runs because that's all Clint processed!  What a jerk.
-        calList = cInfo.GetCalList("ds%d_m%d" % (dsNum, modNum), subNum, runLimit=10)
+        # (Sketches have bounded memory, so they can use every run.)
+        calList = cInfo.GetCalList("ds%d_m%d" % (dsNum, modNum), subNum, runLimit=None if fSketch else 10)
         for i in calList: skimTree.Add("%s/latSkimDS%d_run%d_*" % (pathToInput, dsNum, i))
     else:
         print "Tune or Cut option not set"
@@ -160,6 +201,20 @@ def main(argv):
         tunedPars = {}
         # Default is peak only
         if not tuneNames: tuneNames.append("Peak")
+
+        # read the calibration data once, and tune every channel, parameter, and range together
+        tRanges = {}
+        for tName in tuneNames:
+            if tName == "Continuum": tRanges[tName] = [5, 50]
+            elif tName == "Peak": tRanges[tName] = [236, 240]
+            elif tName == "SoftPlus": continue
+            else: tRanges[tName] = [int(tName.split("_")[0]), int(tName.split("_")[1])]
+        if tRanges and fSketch:
+            sketchFile = "./output/sketch_ds%d_idx%d_m%d%s.npz" % (dsNum, subNum, modNum, "_ch%d" % chNum if chNum != -1 else "")
+            tunedPars = TuneCutsSketch(tRanges, skimTree, chList, parList, parNameList, theCut, sketchK, sketchFile)
+        elif tRanges:
+            tunedPars = TuneCuts(dsNum, subNum, tRanges, skimTree, chList, parList, parNameList, theCut, fastMode)
+
         for par, parName in zip(parList, parNameList):
             for idx, tName in enumerate(tuneNames):
                 tRange = []
@@ -170,9 +225,9 @@ def main(argv):
 
                 key = "%s_ds%d_idx%d_m%d_%s"%(parName,dsNum,subNum,modNum,tName)
                 if not tRange:
-                    cutDict = TuneSoftPlus(dsNum, subNum, tName, skimTree, chList, par, parName, theCut, fastMode)
+                    cutDict = TuneSoftPlus(dsNum, subNum, tName, skimTree, chList, par, parName, theCut, fastMode, modNum)
                 else:
-                    cutDict = TuneCut(dsNum, subNum, tRange[0], tRange[1], tName, skimTree, chList, par, parName, theCut, fastMode)
+                    cutDict = tunedPars[(parName, tName)]
 
                 if fDB: ds.setDBRecord({"key":key,"vals":cutDict}, forceUpdate=fFor)
                 if fCSV:
@@ -183,10 +238,185 @@ def main(argv):
             dfTot = pd.concat(dfList)
             dfTot.to_csv("./output/Cuts_ds%d_idx%d_m%d.csv"%(dsNum,subNum,modNum))
 
+        # wait for the diagnostic plots (rendered in the background while tuning)
+        FinishPlots()
+
     stopT = time.clock()
     print "Stopped:",time.strftime('%X %x %Z'),"\nProcess time (min):",(stopT - startT)/60
 
 
+def TuneCuts(dsNum, subNum, tRanges, cal, chList, parList, parNameList, theCut, fastMode):
+    """ One-pass version of TuneCut.  Reads channel, energy, and every parameter in one go
+    (instead of one Draw per channel/parameter/range), then finds the 1, 5, 90, 95, 99 percentiles
+    of each {channel, range, parameter} from the arrays in memory.
+    tRanges: {tName:[tMin,tMax]}.  Returns {(parName, tName): {ch:[cut01,cut05,cut90,cut95,cut99]}}
+    """
+    eCut = " || ".join(["(trapENFCal > %d && trapENFCal < %d)" % (tMin, tMax) for tMin, tMax in tRanges.values()])
+    chCut = " || ".join(["channel==%d" % ch for ch in chList])
+    drawCut = theCut + " && (%s) && (%s)" % (eCut, chCut)
+    cols = wl.GetDrawArrays(cal, ["channel","trapENFCal"] + parList, drawCut)
+    hitCh, hitE, parVals = cols[0].astype(int), cols[1], cols[2:]
+    print "Read %d hits for %d parameters." % (len(hitE), len(parList))
+
+    tunedPars = {}
+    for parName, vals in zip(parNameList, parVals):
+        for tName, (tMin, tMax) in tRanges.items():
+            inRange = (hitE > tMin) & (hitE < tMax)
+            cutDict = {}
+            for ch in chList:
+                idx = inRange & (hitCh == ch)
+                nCutList, nEnergyList = vals[idx], hitE[idx]
+
+                # Error and warning messages
+                if len(nCutList) == 0:
+                    print "Error: Channel %d has no entries, cut cannot be set properly, setting to [0,0,0,0,0,0,0]"%(ch)
+                    cutDict[ch] = [0,0,0,0,0]
+                    continue
+                if len(nCutList) <= 1000:
+                    print "Warning: Channel %d has less than 1000 entries, cut values may not be accurate"%(ch)
+
+                vb, v5, v95 = 100000, np.percentile(nCutList, 5), np.percentile(nCutList,95)
+                vlo, vhi = v5-5*abs(v5), v95+5*abs(v95)
+                cut01,cut05,cut90,cut95,cut99 = GetCutPercentiles(nCutList, vb, vlo, vhi)
+                cutDict[ch] = [cut01,cut05,cut90,cut95,cut99]
+                if fastMode:
+                    print "Returning fastMode output: ", cut99,cut95,cut01,cut05,cut90
+                    continue
+                outPlot = "./plots/tuneCuts/%s_ds%d_idx%d_%s_ch%d.png" % (parName,dsNum,subNum,tName,ch)
+                QueuePlot(outPlot, "cut", **GetCutPlotData(nEnergyList, nCutList, parName, tMin, tMax, [cut01,cut05,cut90,cut95,cut99]))
+            tunedPars[(parName, tName)] = cutDict
+    return tunedPars
+
+
+def TuneCutsSketch(tRanges, cal, chList, parList, parNameList, theCut, k, sketchFile=None):
+    """ Streaming version of TuneCuts.  Reads the chain one file at a time into a KLL quantile sketch
+    for each {parameter, range, channel}, so memory doesn't grow w/ the number of cal runs.
+    The 1, 5, 90, 95, 99 percentiles are good to ~ wl.KLLSketch(k).GetRankError() in rank.
+    The sketches are saved in 'sketchFile' so results of separate jobs can be merged (see SketchesToDB).
+    Each sketch is seeded from its key, so the same data always gives the same cuts.
+    """
+    eCut = " || ".join(["(trapENFCal > %d && trapENFCal < %d)" % (tMin, tMax) for tMin, tMax in tRanges.values()])
+    chCut = " || ".join(["channel==%d" % ch for ch in chList])
+    drawCut = theCut + " && (%s) && (%s)" % (eCut, chCut)
+
+    sketches = {}
+    for parName in parNameList:
+        for tName in tRanges:
+            for ch in chList:
+                sketches[(parName, tName, ch)] = wl.KLLSketch(k, seed=wl.GetSketchSeed((parName, tName, ch)))
+
+    fileList = [f.GetTitle() for f in cal.GetListOfFiles()]
+    for iF, fName in enumerate(fileList):
+        tf = TFile(fName)
+        tt = tf.Get("skimTree")
+        tt.SetEntryList(dsi.getEntryList(fName, theCut, tt)) # only visit entries passing theCut (cached)
+        cols = wl.GetDrawArrays(tt, ["channel","trapENFCal"] + parList, drawCut)
+        hitCh, hitE, parVals = cols[0].astype(int), cols[1], cols[2:]
+        for tName, (tMin, tMax) in tRanges.items():
+            inRange = (hitE > tMin) & (hitE < tMax)
+            for ch in chList:
+                idx = inRange & (hitCh == ch)
+                for parName, vals in zip(parNameList, parVals):
+                    sketches[(parName, tName, ch)].update(vals[idx])
+        tf.Close()
+        print "%d/%d  %s  %d hits" % (iF, len(fileList), fName.split("/")[-1], len(hitE))
+
+    if sketchFile is not None:
+        wl.SaveSketches(sketchFile, sketches)
+        print "Saved sketches:", sketchFile
+    return GetSketchCuts(sketches)
+
+
+def GetSketchCuts(sketches):
+    """ {(parName, tName, ch): KLLSketch} -> {(parName, tName): {ch:[cut01,cut05,cut90,cut95,cut99]}} """
+    tunedPars = {}
+    for parName, tName in sorted(set(key[:2] for key in sketches)):
+        cutDict = {}
+        for ch in sorted(key[2] for key in sketches if key[:2] == (parName, tName)):
+            sk = sketches[(parName, tName, ch)]
+            if sk.n == 0:
+                print "Error: Channel %d has no entries, cut cannot be set properly, setting to [0,0,0,0,0,0,0]"%(ch)
+                cutDict[ch] = [0,0,0,0,0]
+                continue
+            if sk.n <= 1000:
+                print "Warning: Channel %d has less than 1000 entries, cut values may not be accurate"%(ch)
+            cutDict[ch] = sk.quantiles([0.01, 0.05, 0.90, 0.95, 0.99])
+            print "%s %s ch %d: n %d  cuts %s  (rank error ~%.2f%%)" % (parName, tName, ch, sk.n, wl.niceList(cutDict[ch]), 100*sk.GetRankError())
+        tunedPars[(parName, tName)] = cutDict
+    return tunedPars
+
+
+def SketchesToDB(dsNum, subNum, modNum, sketchFiles, fDB, fFor):
+    """ ./lat3.py -mergeSketch "[sketch files]" -s DS subDS Module [-db] [-force]
+    Merge the sketches saved by TuneCutsSketch in separate jobs (same DS/subDS/module),
+    and write the cuts from the merged sketches like -tune does.
+    """
+    sketches = {}
+    for f in sketchFiles:
+        wl.LoadSketches(f, merge=sketches)
+        print "Loaded", f
+    tunedPars = GetSketchCuts(sketches)
+    for (parName, tName), cutDict in sorted(tunedPars.items()):
+        key = "%s_ds%d_idx%d_m%d_%s"%(parName,dsNum,subNum,modNum,tName)
+        print key
+        if fDB: ds.setDBRecord({"key":key,"vals":cutDict}, forceUpdate=fFor)
+
+
+def GetCutPercentiles(vals, vb, vlo, vhi, pcts=[1,5,90,95,99]):
+    """ Same method as MakeCutPlot: fill a 'vb'-bin histogram between vlo and vhi, normalize it,
+    and return the bin center where the cumulative sum first passes each percentile.
+    """
+    h, edges = np.histogram(vals, bins=vb, range=(vlo, vhi))
+    if h.sum() == 0:
+        print "Error: histogram sum is 0 so cannot normalize, setting to [0,0,0,0,0]"
+        return [0 for p in pcts]
+    ctrs = (edges[:-1] + edges[1:])/2.
+    cdf = np.cumsum(h) / float(h.sum())
+    return [ctrs[np.argmax(cdf > p/100.)] for p in pcts]
+
+
+def GetCutPlotData(nEnergyList, nCutList, parName, tMin, tMax, cuts):
+    """ The (small) arrays PlotCut needs: 2D and 1D histograms, and the cumulative curve.
+    These are saved by QueuePlot, so plots can be made (or remade) w/o the data.
+    """
+    cut01,cut05,cut90,cut95,cut99 = cuts
+    vLo, vHi = cut01-abs(0.25*cut01), cut99+abs(0.25*cut99)
+    h2, xEdges, yEdges = np.histogram2d(nEnergyList, nCutList, bins=[int(tMax-tMin)+10, 200], range=[[tMin-5, tMax+5],[vLo, vHi]])
+    h1, hEdges = np.histogram(nCutList, bins=200, range=(vLo, vHi))
+    sortVals = np.sort(nCutList)
+    iPts = np.unique(np.linspace(0, len(sortVals)-1, min(len(sortVals), 2000)).astype(int))
+    return {"parName":parName, "cuts":np.asarray(cuts), "h2":h2, "xEdges":xEdges, "yEdges":yEdges, "h1":h1, "hEdges":hEdges,
+            "cdfX":sortVals[iPts], "cdfY":(iPts+1)/float(len(sortVals))}
+
+
+def PlotCut(d):
+    """ Diagnostic plot for TuneCuts, from the arrays of GetCutPlotData (no extra Draw's). """
+    cut01,cut05,cut90,cut95,cut99 = d["cuts"]
+    parName = str(d["parName"])
+    fig = plt.figure(figsize=(16,6))
+    p1, p2, p3 = plt.subplot(131), plt.subplot(132), plt.subplot(133)
+
+    p1.pcolormesh(d["xEdges"], d["yEdges"], d["h2"].T, cmap='jet')
+    for cut, col in zip([cut99,cut95,cut05,cut01], ['g','r','r','g']):
+        p1.axhline(cut, color=col)
+    p1.set_xlabel("trapENFCal")
+    p1.set_ylabel(parName)
+
+    p2.step(d["hEdges"][:-1], d["h1"], where='post')
+    p2.set_xlabel(parName)
+
+    p3.plot(d["cdfX"], d["cdfY"])
+    for cut, col in zip([cut99,cut95,cut05,cut01], ['g','r','r','g']):
+        p3.axvline(cut, color=col)
+    p3.set_xlim(cut01-abs(0.3*cut01), cut99+abs(0.3*cut99))
+    p3.set_xlabel(parName)
+    p3.set_ylabel("Percentile")
+
+    plt.tight_layout()
+    plt.savefig(str(d["outPlot"]))
+    plt.close(fig)
+
+
 def TuneCut(dsNum, subNum, tMin, tMax, tName, cal, chList, par, parName, theCut, fastMode):
     c = TCanvas("%s"%(parName),"%s"%(parName),1600,600)
     c.Divide(3,1,0.00001,0.00001)
@@ -219,62 +449,185 @@ def TuneCut(dsNum, subNum, tMin, tMax, tName, cal, chList, par, parName, theCut,
     return cutDict
 
 
-def TuneSoftPlus(dsNum, subNum, tName, cal, chList, par, parName, theCut, fastMode):
-    nTest = np.linspace(0, 250, 1000)
+def TuneSoftPlus(dsNum, subNum, tName, cal, chList, par, parName, theCut, fastMode, modNum=-1, nProc=None, binStat=0.5):
+    """ Fit the energy dependence of 'par' w/ a softplus, for each channel.  DB record: {ch:[a,b,c,d]}
+    - All channels are read in one go.  In each energy range the points are trimmed to the
+      5-85 (5-50 keV) or 5-90 percent (50-150, 150-240 keV) of 'par', w/ each bound computed once.
+    - The fit is done on 1 keV energy bins, to a quantile of 'par' in each bin ('binStat', 0-1,
+      default: the median), weighted by sqrt(number of points).  binStat="mean" fits the bin means
+      instead.  Either one is much faster than fitting the raw points, but the result isn't
+      identical to the old raw-point fit (softplus isn't linear across a bin, and the median isn't the mean).
+    - The fit results of the previous calIdx are the starting values, and channels are fit in parallel.
+    """
+    from multiprocessing import Pool
     cutDict = {}
+    spRanges = [(5, 50, 85), (50, 150, 90), (150, 240, 90)] # eLo, eHi, upper percentile
+
+    chCut = " || ".join(["channel==%d" % ch for ch in chList])
+    cols = wl.GetDrawArrays(cal, ["channel","trapENFCal",par], theCut + " && trapENFCal>5 && trapENFCal<240 && (%s)" % chCut)
+    hitCh, hitE, hitPar = cols[0].astype(int), cols[1], cols[2]
+
+    # starting values: the previous calIdx's result, if it's there
+    p0Prev = {}
+    if subNum > 0:
+        prevKey = "%s_ds%d_idx%d_m%d_%s" % (parName, dsNum, subNum-1, modNum, tName)
+        prev = dsi.getDBRecord(prevKey, False, dsi.CalDB("calDB.json"))
+        if prev: p0Prev = prev
+
+    jobs, fitData = [], {}
     for ch in chList:
         cutDict[ch] = [0,0,0,0]
-        nPass1 = cal.Draw("trapENFCal:%s"%(par),  theCut + "&& trapENFCal>5 && trapENFCal<50 && channel==%d"%(ch), "goff")
-        nCutArray1, nCutArray2, nCutArray3 = [], [], []
-        if nPass1 != 0:
-            nEnergy1 = cal.GetV1()
-            nCut1 = cal.GetV2()
-            nCutList1 = list(float(nCut1[n]) for n in xrange(nPass1))
-            nEnergyList1 = list(float(nEnergy1[n]) for n in xrange(nPass1))
-            nCutArray1 = [[x,y] for x,y in zip(nCutList1, nEnergyList1) if x > np.percentile(nCutList1, 5) and x < np.percentile(nCutList1, 85)]
-        nPass2 = cal.Draw("trapENFCal:%s"%(par),  theCut+"&& trapENFCal>50 && trapENFCal<150 && channel==%d"%(ch), "goff")
-        if nPass2 != 0:
-            nEnergy2 = cal.GetV1()
-            nCut2 = cal.GetV2()
-            nCutList2 = list(float(nCut2[n]) for n in xrange(nPass2))
-            nEnergyList2 = list(float(nEnergy2[n]) for n in xrange(nPass2))
-            nCutArray2 = [[x,y] for x,y in zip(nCutList2, nEnergyList2) if x > np.percentile(nCutList2, 5) and x < np.percentile(nCutList2, 90)]
-        nPass3 = cal.Draw("trapENFCal:%s"%(par),  theCut+"&& trapENFCal>150 && trapENFCal<240 && channel==%d"%(ch), "goff")
-        if nPass3 != 0:
-            nEnergy3 = cal.GetV1()
-            nCut3 = cal.GetV2()
-            nCutList3 = list(float(nCut3[n]) for n in xrange(nPass3))
-            nEnergyList3 = list(float(nEnergy3[n]) for n in xrange(nPass3))
-            nCutArray3 = [[x,y] for x,y in zip(nCutList3, nEnergyList3) if x > np.percentile(nCutList3, 5) and x < np.percentile(nCutList3, 90)]
-        nCutArray = np.asarray(nCutArray1 + nCutArray2 + nCutArray3)
-
-        if len(nCutArray) == 0:
+        isCh = hitCh == ch
+        nCut, nEnergy, nEnergyAll = [], [], []
+        for eLo, eHi, pHi in spRanges:
+            idx = isCh & (hitE > eLo) & (hitE < eHi)
+            vals, ens = hitPar[idx], hitE[idx]
+            nEnergyAll.append(ens)
+            if len(vals) == 0: continue
+            vLo, vHi = np.percentile(vals, 5), np.percentile(vals, pHi)
+            keep = (vals > vLo) & (vals < vHi)
+            nCut.append(vals[keep])
+            nEnergy.append(ens[keep])
+        if len(nCut) == 0 or sum(len(v) for v in nCut) == 0:
             print "No events (setting to [0,0,0,0]), skipping channel ", ch
             continue
-        popt,_ = curve_fit(softplus, nCutArray[:,1], nCutArray[:,0], p0=[1., 0.005, 10, 0.5], bounds = ((-10,0,-10,0),(10,10,150,100)))
-
+        nCut, nEnergy = np.concatenate(nCut), np.concatenate(nEnergy)
+        fitData[ch] = [nCut, nEnergy, np.concatenate(nEnergyAll)]
+        p0 = p0Prev.get(ch, [1., 0.005, 10, 0.5])
+        if len(p0) != 4 or not np.any(p0): p0 = [1., 0.005, 10, 0.5]
+        jobs.append((ch, nEnergy, nCut, p0, binStat))
+
+    results = []
+    if len(jobs) > 0:
+        pool = Pool(nProc)
+        results = pool.map(FitSoftPlus, jobs)
+        pool.close()
+        pool.join()
+
+    for ch, popt in results:
+        if popt is None:
+            print "Fit failed (setting to [0,0,0,0]), channel ", ch
+            continue
         cutDict[ch] = [popt[0], popt[1], popt[2], popt[3]]
         if fastMode: continue
 
-        # Draw plots
-        yFit = softplus(nTest, *popt)
-        g2 = sns.JointGrid(x=nCutArray[:,1], y=nCutArray[:,0], size=10, space=0.2)
-        g2.plot_joint(sns.kdeplot)
-        plt.plot(nTest, yFit, "-", color='red')
-        plt.ylabel('%s'%(parName))
-        plt.xlabel('Energy')
-        plt.title('Y-Offset: %.2f  Slope: %.3f  X-Shift: %.2f  Curvature: %.2f'%(popt[0], popt[1], popt[2], popt[3]))
-        g2.ax_marg_y.set_axis_off()
-        _ = g2.ax_marg_x.hist(np.array(nEnergyList1 + nEnergyList2 + nEnergyList3), alpha=0.8, bins=np.linspace(0, 250, 500))
-        g2.savefig("./plots/tuneCuts/%s_ds%d_idx%d_%s_ch%d.png" % (parName,dsNum,subNum,tName,ch))
+        # save the plot data (a sample of the fitted points is plenty for the KDE) and queue the plot
+        nCut, nEnergy, nEnergyAll = fitData[ch]
+        iPts = np.random.RandomState(ch).permutation(len(nCut))[:nKDE]
+        hE, hEdges = np.histogram(nEnergyAll, bins=np.linspace(0, 250, 500))
+        outPlot = "./plots/tuneCuts/%s_ds%d_idx%d_%s_ch%d.png" % (parName,dsNum,subNum,tName,ch)
+        QueuePlot(outPlot, "softplus", parName=parName, popt=np.asarray(popt), nEnergy=nEnergy[iPts], nCut=nCut[iPts], hE=hE, hEdges=hEdges)
     return cutDict
 
 
+def FitSoftPlus(args):
+    """ Used by TuneSoftPlus (runs in a worker process).  Returns [ch, popt or None]. """
+    ch, nEnergy, nCut, p0, binStat = args
+    bounds = ((-10,0,-10,0),(10,10,150,100))
+    eBins = np.arange(5, 241, 1)
+    iBin = np.digitize(nEnergy, eBins) - 1
+    nPts = np.bincount(iBin, minlength=len(eBins))
+    good = np.flatnonzero(nPts > 0)
+    xBin = np.bincount(iBin, weights=nEnergy, minlength=len(eBins))[good] / nPts[good]
+    if binStat == "mean":
+        yBin = np.bincount(iBin, weights=nCut, minlength=len(eBins))[good] / nPts[good]
+    else:
+        # sort by (bin, value) once, then each bin is a contiguous slice
+        sortCut = nCut[np.lexsort((nCut, iBin))]
+        start = np.concatenate(([0], np.cumsum(nPts)))
+        yBin = np.asarray([np.percentile(sortCut[start[i]:start[i+1]], 100*binStat) for i in good])
+    sigma = 1./np.sqrt(nPts[good])
+
+    # keep the starting values inside the bounds
+    lo, hi = np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float)
+    for pStart in [p0, [1., 0.005, 10, 0.5]]:
+        pStart = np.clip(pStart, lo + 1e-6*(hi-lo), hi - 1e-6*(hi-lo))
+        try:
+            popt,_ = curve_fit(softplus, xBin, yBin, p0=pStart, sigma=sigma, bounds=bounds)
+            return [ch, popt]
+        except (RuntimeError, ValueError):
+            continue
+    return [ch, None]
+
+
 def softplus(x, a, b, c, d):
     """ A = Y-offset, B = Slope , C = X shift for flatness, D = Curvature """
     return a + b*np.log(1+np.exp((x - c)/d) )
 
 
+def PlotSoftPlus(d):
+    """ Diagnostic plot for TuneSoftPlus, from the arrays it saved. """
+    popt, parName = d["popt"], str(d["parName"])
+    nTest = np.linspace(0, 250, 1000)
+    g2 = sns.JointGrid(x=d["nEnergy"], y=d["nCut"], size=10, space=0.2)
+    g2.plot_joint(sns.kdeplot)
+    plt.plot(nTest, softplus(nTest, *popt), "-", color='red')
+    plt.ylabel('%s'%(parName))
+    plt.xlabel('Energy')
+    plt.title('Y-Offset: %.2f  Slope: %.3f  X-Shift: %.2f  Curvature: %.2f'%(popt[0], popt[1], popt[2], popt[3]))
+    g2.ax_marg_y.set_axis_off()
+    g2.ax_marg_x.bar(d["hEdges"][:-1], d["hE"], width=np.diff(d["hEdges"]), align='edge', alpha=0.8)
+    g2.savefig(str(d["outPlot"]))
+    plt.close(g2.fig)
+
+
+# -- Background plotting.  Tuning saves each plot's arrays in ./plots/tuneCuts/data and moves on,
+#    a small process pool renders them.  Remake plots from the saved data w/ ./lat3.py -replot --
+plotDir, nPlotProc, nKDE = "./plots/tuneCuts/data", 4, 5000
+plotPool, plotJobs = None, []
+
+def QueuePlot(outPlot, kind, **data):
+    global plotPool
+    if not os.path.isdir(plotDir): os.makedirs(plotDir)
+    dataFile = "%s/%s.npz" % (plotDir, os.path.basename(outPlot).rsplit(".",1)[0])
+    np.savez(dataFile, kind=kind, outPlot=outPlot, **data)
+    if plotPool is None:
+        from multiprocessing import Pool
+        plotPool = Pool(nPlotProc)
+    plotJobs.append(plotPool.apply_async(RenderPlot, (dataFile,)))
+
+
+def RenderPlot(dataFile):
+    """ Used by QueuePlot (runs in a worker process). """
+    d = np.load(dataFile)
+    kind = str(d["kind"])
+    if kind == "cut": PlotCut(d)
+    elif kind == "softplus": PlotSoftPlus(d)
+    return str(d["outPlot"])
+
+
+def FinishPlots():
+    """ Wait for the queued plots, and report any that failed. """
+    global plotPool
+    if plotPool is None: return
+    plotPool.close()
+    plotPool.join()
+    nDone = 0
+    for job in plotJobs:
+        try:
+            job.get()
+            nDone += 1
+        except Exception as e:
+            print "Plot failed:", e
+    print "Made %d of %d plots." % (nDone, len(plotJobs))
+    plotPool, plotJobs[:] = None, []
+
+
+def RePlot(pattern="*"):
+    """ ./lat3.py -replot ["pattern"]
+    Remake plots from the data in ./plots/tuneCuts/data (ex. "riseNoise_ds1_idx*"), w/o reading any trees.
+    """
+    dataFiles = sorted(glob.glob("%s/%s.npz" % (plotDir, pattern)))
+    print "Remaking %d plots ..." % len(dataFiles)
+    if len(dataFiles) == 0: return
+    global plotPool
+    from multiprocessing import Pool
+    plotPool = Pool(nPlotProc)
+    for dataFile in dataFiles:
+        plotJobs.append(plotPool.apply_async(RenderPlot, (dataFile,)))
+    FinishPlots()
+
+
 def MakeCutPlot(c,cal,var,eb,elo,ehi,vb,vlo,vhi,d2Cut,d1Cut,outPlot,fastMode):
     """ Creates a channel-specific energy calibration plot. """
 
@@ -334,28 +687,13 @@ def MakeCutPlot(c,cal,var,eb,elo,ehi,vb,vlo,vhi,d2Cut,d1Cut,outPlot,fastMode):
     return cut99,cut95,cut01,cut05,cut90
 
 
-def ApplyChannelCuts(dsNum, cutType, dType):
-    """ ./lat3.py -cut [dsNum] [cutType]
-    This runs over whole datasets.
-    cutTypes:
-        fs, rn, wf, fs+rn, fs+wf, rn+wf, fs+rn+wf
-
-    dTypes:
-        bkg, cal
+def GetCutSets(dsNum, dType, cInfo):
+    """ Used by ApplyChannelCuts and WriteCutBits.  Loops over modules and bkgIdx's (calIdx's for cal),
+    yielding a dict w/ the chain and what's needed to cut it.  Files are added to the chain in sorted order.
     """
-    # load the database
-    calDB = db.TinyDB('../calDB.json')
-    pars = db.Query()
-
-    # setup a loop over modules and dataset ranges
-    gROOT.ProcessLine("gErrorIgnoreLevel = 3001;")
-    cInfo = ds.CalInfo()
     nMods = [1]
     if dsNum == 4: nMods = [2]
     if dsNum == 5: nMods = [1,2]
-    # Dummy string for file writing -- adds nothing to the directories if background
-    dString = ""
-    if dType == "cal": dString = "cal"
 
     for modNum in nMods:
         # Changed so range of idx are set here to take advantage of module number
@@ -367,7 +705,7 @@ def ApplyChannelCuts(dsNum, cutType, dType):
             nRanges = [0, len(cInfo.master['ds%d_m%d'%(dsNum, modNum)])-1]
         else:
             print "cal or bkg not set, returning"
-            return 0
+            return
 
         # Loop over bkgIdx, even though for calibration runs this will represent calIdx
         for bkgIdx in range(nRanges[0], nRanges[1]+1):
@@ -375,17 +713,17 @@ def ApplyChannelCuts(dsNum, cutType, dType):
             skimTree = TChain("skimTree")
 
             # build the file list
-            fRegex = ""
             fList = []
             if dType == "bkg":
-                fRegex = "/global/homes/w/wisecg/project/bg-lat/latSkimDS%d_%d_*.root" % (dsNum, bkgIdx)
-                fList = glob.glob(fRegex)
-                skimTree.Add(fRegex)
+                fList = sorted(glob.glob("/global/homes/w/wisecg/project/bg-lat/latSkimDS%d_%d_*.root" % (dsNum, bkgIdx)))
             elif dType == "cal":
                 calList = cInfo.GetCalList("ds%d_m%d" % (dsNum, modNum), bkgIdx, runLimit=10)
                 for i in calList:
-                    fList += glob.glob("/global/homes/w/wisecg/project/cal-lat/latSkimDS%d_run%d_*.root"%(dsNum,i))
-                    skimTree.Add("/global/homes/w/wisecg/project/cal-lat/latSkimDS%d_run%d_*.root" % (dsNum, i))
+                    fList += sorted(glob.glob("/global/homes/w/wisecg/project/cal-lat/latSkimDS%d_run%d_*.root"%(dsNum,i)))
+            if len(fList) == 0:
+                print "DS-%d subset %d, Mod-%d.  No files found, skipping." % (dsNum, bkgIdx, modNum)
+                continue
+            for f in fList: skimTree.Add(f)
             file0 = fList[0]
             print "DS-%d subset %d, Mod-%d.  N_files: %d" % (dsNum, bkgIdx, modNum, len(fList))
 
@@ -414,114 +752,297 @@ def ApplyChannelCuts(dsNum, cutType, dType):
             if dsNum==5 and modNum==2:
                 chList = [ch for ch in chList if ch > 1000 and ch!=1232]
 
-            # -- create a dict of cuts for each channel, covering each calIdx. --
-            cutDict = {}
-            for calIdx in range(calIdxLo, calIdxHi+1):
+            yield {"modNum":modNum, "bkgIdx":bkgIdx, "skimTree":skimTree, "fList":fList, "theCut":theCut,
+                   "calIdxList":range(calIdxLo, calIdxHi+1), "chList":chList}
 
-                runCovMin = cInfo.master["ds%d_m%d" % (dsNum, modNum)][calIdx][1]
-                runCovMax = cInfo.master["ds%d_m%d" % (dsNum, modNum)][calIdx][2]
-                runCut = "run>=%d && run<=%d" % (runCovMin, runCovMax)
 
-                fsD = ds.getDBRecord("fitSlo_ds%d_idx%d_m%d_Peak" % (dsNum, calIdx, modNum), False, calDB, pars)
-                rnSD = ds.getDBRecord("riseNoise_ds%d_idx%d_m%d_SoftPlus" % (dsNum, calIdx, modNum), False, calDB, pars)
-                rnCD = ds.getDBRecord("riseNoise_ds%d_idx%d_m%d_Continuum" % (dsNum, calIdx, modNum), False, calDB, pars)
-                wfD = ds.getDBRecord("wfstd_ds%d_idx%d_mod%d" % (dsNum, calIdx, modNum), False, calDB, pars)
+def ApplyChannelCuts(dsNum, cutType, dType):
+    """ ./lat3.py -cut [dsNum] [cutType] [dType]
+    This runs over whole datasets.
+    cutTypes:
+        fs, rn, wf, fs+rn, fs+wf, rn+wf, fs+rn+wf, or 'all' (makes all seven from one read)
 
-                for ch in chList:
+    dTypes:
+        bkg, cal
 
-                    fsCut, rnCut, wfCut, chanCut = None, None, None, None
+    The cuts are evaluated w/ numpy (GetCutPars, GetCutMasks) on columns read once per bkgIdx,
+    and each output file is copied w/ a TEntryList.  The equivalent TCut string is still saved as "chanCut".
+    To avoid writing a file set for each cut, see WriteCutBits and MaterializeCut.
+    """
+    # load the database (indexed, so the lookups below are cheap)
+    calDB = dsi.CalDB('../calDB.json')
 
-                    # print ch,":",fsD[ch][2]
+    cutList = cutTypes if cutType == "all" else [cutType]
+    if any(ct not in cutTypes for ct in cutList):
+        print "Unknown cut type %s, returning" % cutType
+        return 0
 
-                    # fitSlo: check the 90% value is positive
-                    if fsD[ch][2] > 0:
-                        fsCut = "fitSlo<%.2f" % fsD[ch][2]
+    gROOT.ProcessLine("gErrorIgnoreLevel = 3001;")
+    cInfo = ds.CalInfo()
 
-                    # riseNoise: check the softplus curvature is positive
-                    if rnSD[ch][3] > 0:
-                        rnCut = "riseNoise<(%.3f+%.5f*TMath::Log(1+TMath::Exp((trapENFCal-(%.3f))/%.3f)))" % (max(rnSD[ch][0],rnCD[ch][4]), rnSD[ch][1], rnSD[ch][2], rnSD[ch][3])
+    for cs in GetCutSets(dsNum, dType, cInfo):
+        skimTree, theCut, chList = cs["skimTree"], cs["theCut"], cs["chList"]
 
-                    # wfStd: check if ralph says this is ok to use
-                    if wfD!=0 and ch in wfD.keys() and wfD[ch][0]==u'y':
-                        wfCut = "abs(wfstd - sqrt((%.4e + %.4e*trapENFCal + %.4e*trapENFCal**2 + %.2e*pow(trapENFCal,3) + %.2e*pow(trapENFCal,4))**2 + %.4f)) < (%.2f+%.3f*trapENFCal)" % (wfD[ch][3], wfD[ch][4], wfD[ch][5], wfD[ch][6], wfD[ch][7], wfD[ch][8], wfD[ch][9], wfD[ch][10])
+        # -- load the cut parameters for each channel & calIdx, and build the equivalent TCut strings --
+        cutPars = GetCutPars(dsNum, cs["modNum"], cs["calIdxList"], chList, cInfo, calDB)
+        cutDicts = {ct:GetCutStrings(cutPars, chList, ct) for ct in cutList}
 
-                    # set the combination channel cut
-                    if cutType == "fs" and fsCut!=None:
-                        chanCut = "(%s && %s)" % (runCut, fsCut)
+        # -- evaluate every cut combination on every hit, in one pass --
+        cols = wl.GetDrawArrays(skimTree, ["channel","gain","trapENFCal","fitSlo","riseNoise","wfStd","run","Entry$"], theCut)
+        hitCh, hitEnt = cols[0].astype(int), cols[7].astype(np.int64)
+        passMasks = GetCutMasks(cutPars, chList, cutList, *cols[:7])
 
-                    if cutType == "rn" and rnCut!=None:
-                        chanCut = "(%s && %s)" % (runCut, rnCut)
+        # -- finally, loop over each channel we have an entry for, and create an output file. --
+        for ct in cutList:
+            for ch in cutDicts[ct]:
+                # TODO: threshold cut (or at least save the value for each bkgIdx)
+                chanCut = GetChanCutString(theCut, ct, ch, cutDicts[ct][ch])
+                outFile = GetCutFileName(dsNum, dType, ct, cs["bkgIdx"], ch)
+                WriteCutFile(skimTree, np.unique(hitEnt[passMasks[ct] & (hitCh == ch)]), outFile, chanCut)
 
-                    if cutType == "wf" and wfCut!=None:
-                        chanCut = "(%s && %s)" % (runCut, wfCut)
 
-                    if cutType == "fs+rn" and fsCut!=None and rnCut!=None:
-                        chanCut = "(%s && %s && %s)" % (runCut, fsCut, rnCut)
+def GetChanCutString(theCut, cutType, ch, cutStr):
+    chanCut = theCut + "&& gain==0 && channel==%d" % ch
+    if "fs" in cutType: chanCut += "&& fitSlo>0"
+    return chanCut + "&& %s" % cutStr
 
-                    if cutType == "fs+wf" and fsCut!=None and wfCut!=None:
-                        chanCut = "(%s && %s && %s)" % (runCut, fsCut, wfCut)
 
-                    if cutType == "rn+wf" and rnCut!=None and wfCut!=None:
-                        chanCut = "(%s && %s && %s)" % (runCut, rnCut, wfCut)
+def GetCutFileName(dsNum, dType, cutType, bkgIdx, ch):
+    # Dummy string for file writing -- adds nothing to the directories if background
+    dString = "cal" if dType == "cal" else ""
+    outDir, outName = cutFiles.get(cutType, (cutType.replace("+","_"),)*2)
+    return "~/project/cuts/%s%s/%s%s-DS%d-%d-ch%d.root" % (dString, outDir, dString, outName, dsNum, bkgIdx, ch)
 
-                    if cutType == "fs+rn+wf" and fsCut!=None and rnCut!=None and wfCut!=None:
-                        chanCut = "(%s && %s && %s && %s)" % (runCut, fsCut, rnCut, wfCut)
 
-                    # create dict entry for this channel or append to existing, taking care of parentheses and OR's.
-                    if ch in cutDict.keys() and chanCut!=None:
-                        cutDict[ch] += " || %s" % chanCut
-                    elif ch not in cutDict.keys() and chanCut!=None:
-                        cutDict[ch] = "(%s" % chanCut
+def WriteCutFile(skimTree, passEnt, outFile, chanCut):
+    """ Copy the (chain) entries in 'passEnt' to 'outFile' w/ a TEntryList, and save 'chanCut' w/ them.
+    An event is kept if any of its hits passes, the same as CopyTree(chanCut).
+    """
+    from ROOT import TEntryList
+    eList = TEntryList("eList", "eList")
+    for iEnt in passEnt: eList.Enter(int(iEnt), skimTree)
+    skimTree.SetEntryList(eList)
+
+    print "    Writing to:",outFile
+    print "    Cut used:",chanCut,"\n"
+    outFile = TFile(outFile,"RECREATE")
+    outTree = TTree()
+    outTree = skimTree.CopyTree("")
+    outTree.Write()
+    cutUsed = TNamed("chanCut",chanCut)
+    cutUsed.Write()
+    print "Wrote",outTree.GetEntries(),"entries."
+    outFile.Close()
+    skimTree.SetEntryList(0)
+
+
+def GetCutBitsFile(dsNum, dType, bkgIdx, modNum):
+    dString = "cal" if dType == "cal" else ""
+    return os.path.expanduser("~/project/cuts/%scutBits/%scutBits-DS%d-%d-m%d.npz" % (dString, dString, dsNum, bkgIdx, modNum))
+
+
+def WriteCutBits(dsNum, dType):
+    """ ./lat3.py -bits [dsNum] [dType]
+    Save the result of every cut, once, as a per-hit bitmask (see cutBits) instead of a file set per cut type.
+    One .npz per bkgIdx & module, w/ a row for each hit passing theCut in one of the module's channels:
+        entry (in the chain of 'fileList'), iHit, channel, run, trapENFCal, bits
+    Hits that aren't in the file fail every cut.  Use GetCutPass to combine cuts, or MaterializeCut for ROOT files.
+    """
+    calDB = dsi.CalDB('../calDB.json')
+    gROOT.ProcessLine("gErrorIgnoreLevel = 3001;")
+    cInfo = ds.CalInfo()
 
-            # close the parens for each channel entry
-            for key in cutDict:
-                cutDict[key] += ")"
+    for cs in GetCutSets(dsNum, dType, cInfo):
+        skimTree, chList = cs["skimTree"], cs["chList"]
+        cutPars = GetCutPars(dsNum, cs["modNum"], cs["calIdxList"], chList, cInfo, calDB)
+
+        exprs = ["channel","gain","trapENFCal","fitSlo","riseNoise","wfStd","run","Entry$","Iteration$","threshKeV","threshSigma"]
+        cols = dict(zip(exprs, wl.GetDrawArrays(skimTree, exprs, cs["theCut"])))
+        hitCh = cols["channel"].astype(int)
+        passMasks = GetCutMasks(cutPars, chList, ["fs","rn","wf"], *[cols[e] for e in exprs[:7]])
+
+        # analysis threshold: threshKeV + 3 threshSigma (same as lat2), gain==0 like the other bits
+        hitE, thrM, thrS = cols["trapENFCal"], cols["threshKeV"], cols["threshSigma"]
+        thPass = (cols["gain"] == 0) & (thrM < 9999) & (hitE > thrM + 3*thrS)
+
+        bits = np.zeros(len(hitCh), dtype=np.uint8)
+        for ct in ["fs","rn","wf"]:
+            bits[passMasks[ct]] |= cutBits[ct]
+        bits[thPass] |= cutBits["th"]
+
+        keep = np.in1d(hitCh, chList)
+        fileEnt = [TFile(f).Get("skimTree").GetEntries() for f in cs["fList"]]
+        outFile = GetCutBitsFile(dsNum, dType, cs["bkgIdx"], cs["modNum"])
+        if not os.path.isdir(os.path.dirname(outFile)): os.makedirs(os.path.dirname(outFile))
+        np.savez(outFile, entry=cols["Entry$"][keep].astype(np.int64), iHit=cols["Iteration$"][keep].astype(np.int32),
+                 channel=hitCh[keep].astype(np.int32), run=cols["run"][keep].astype(np.int32),
+                 trapENFCal=hitE[keep], bits=bits[keep], fileList=np.asarray(cs["fList"]),
+                 fileEntries=np.asarray(fileEnt, dtype=np.int64), theCut=np.asarray(cs["theCut"]))
+        print "    Wrote %d hits to %s" % (keep.sum(), outFile)
+
+
+def GetCutPass(bits, cutType):
+    """ Per-hit pass mask for a cut combination ("fs+rn", "fs+rn+th", ...) from the 'bits' of WriteCutBits. """
+    need = 0
+    for c in cutType.split("+"): need |= cutBits[c]
+    return (bits & need) == need
+
+
+def MaterializeCut(dsNum, cutType, dType):
+    """ ./lat3.py -mat [dsNum] [cutType] [dType]
+    Write the usual per-channel files of ApplyChannelCuts for one cut combination, from the WriteCutBits output.
+    Doesn't touch the DB.  Since the bits include the threshold, cutType can also use "th" (ex. fs+rn+th).
+    """
+    if any(c not in cutBits for c in cutType.split("+")):
+        print "Unknown cut type %s, returning" % cutType
+        return 0
+    gROOT.ProcessLine("gErrorIgnoreLevel = 3001;")
+    dString = "cal" if dType == "cal" else ""
+    bitFiles = sorted(glob.glob(os.path.expanduser("~/project/cuts/%scutBits/%scutBits-DS%d-*-m*.npz" % (dString, dString, dsNum))))
+    if len(bitFiles) == 0:
+        print "No cut bits found for DS-%d %s.  Run ./lat3.py -bits first." % (dsNum, dType)
+        return 0
+
+    for bitFile in bitFiles:
+        bkgIdx = int(os.path.basename(bitFile).split("-")[2])
+        cb = np.load(bitFile)
+        skimTree = TChain("skimTree")
+        for f in cb["fileList"]: skimTree.Add(str(f))
+        if skimTree.GetEntries() != cb["fileEntries"].sum():
+            print "Files changed since %s was written, skipping.  Re-run ./lat3.py -bits" % bitFile
+            continue
+
+        isPass = GetCutPass(cb["bits"], cutType)
+        for ch in np.unique(cb["channel"][isPass]):
+            passEnt = np.unique(cb["entry"][isPass & (cb["channel"] == ch)])
+            chanCut = str(cb["theCut"]) + "&& gain==0 && channel==%d && cutBits(%s)" % (ch, cutType)
+            outFile = GetCutFileName(dsNum, dType, cutType, bkgIdx, ch)
+            WriteCutFile(skimTree, passEnt, outFile, chanCut)
 
-            # -- finally, loop over each channel we have an entry for, get its cut, and create an output file. --
-            for ch in cutDict:
-                # TODO: threshold cut (or at least save the value for each bkgIdx)
 
-                chanCut = theCut + "&& gain==0 && channel==%d" % ch
-
-                if cutType == "fs":
-                    outFile = "~/project/cuts/%sfs/%sfitSlo-DS%d-%d-ch%d.root" % (dString, dString, dsNum, bkgIdx, ch)
-                    chanCut += "&& fitSlo>0 && %s" % cutDict[ch]
-
-                if cutType == "rn":
-                    outFile = "~/project/cuts/%srn/%sriseNoise-DS%d-%d-ch%d.root" % (dString, dString, dsNum, bkgIdx, ch)
-                    chanCut += "&& %s" % cutDict[ch]
-
-                if cutType == "wf":
-                    outFile = "~/project/cuts/%swf/%swfstd-DS%d-%d-ch%d.root" % (dString, dString, dsNum, bkgIdx, ch)
-                    chanCut += "&& %s" % cutDict[ch]
-
-                if cutType == "fs+rn":
-                    outFile = "~/project/cuts/%sfs_rn/%sfs_rn-DS%d-%d-ch%d.root" % (dString, dString, dsNum, bkgIdx, ch)
-                    chanCut += "&& fitSlo>0 && %s" % cutDict[ch]
-
-                if cutType == "fs+wf":
-                    outFile = "~/project/cuts/%sfs_wf/%sfs_wf-DS%d-%d-ch%d.root" % (dString, dString, dsNum, bkgIdx, ch)
-                    chanCut += "&& fitSlo>0 && %s" % cutDict[ch]
-
-                if cutType == "rn+wf":
-                    outFile = "~/project/cuts/%srn_wf/%srn_wf-DS%d-%d-ch%d.root" % (dString, dString, dsNum, bkgIdx, ch)
-                    chanCut += "&& %s" % cutDict[ch]
-
-                if cutType == "fs+rn+wf":
-                    outFile = "~/project/cuts/%sfs_rn_wf/%sfs_rn_wf-DS%d-%d-ch%d.root" % (dString, dString, dsNum, bkgIdx, ch)
-                    chanCut += "&& fitSlo>0 && %s" % cutDict[ch]
-
-                print "    Writing to:",outFile
-                print "    Cut used:",chanCut,"\n"
-                outFile = TFile(outFile,"RECREATE")
-                outTree = TTree()
-                outTree = skimTree.CopyTree(chanCut)
-                outTree.Write()
-                cutUsed = TNamed("chanCut",chanCut)
-                cutUsed.Write()
-                print "Wrote",outTree.GetEntries(),"entries."
-                outFile.Close()
-                # return
+cutTypes = ["fs", "rn", "wf", "fs+rn", "fs+wf", "rn+wf", "fs+rn+wf"]
+cutBits = {"fs":1, "rn":2, "wf":4, "th":8} # one bit per cut, and the analysis threshold
+cutFiles = {"fs":("fs","fitSlo"), "rn":("rn","riseNoise"), "wf":("wf","wfstd"), "fs+rn":("fs_rn","fs_rn"),
+            "fs+wf":("fs_wf","fs_wf"), "rn+wf":("rn_wf","rn_wf"), "fs+rn+wf":("fs_rn_wf","fs_rn_wf")}
+
+def roundLike(x, fmt):
+    """ Round 'x' like the TCut strings do, so the numpy cuts and the strings agree exactly. """
+    return float(fmt % x)
+
+
+def GetCutPars(dsNum, modNum, calIdxList, chList, cInfo, calDB):
+    """ Load the fitSlo, riseNoise and wfStd cut parameters into arrays indexed by [calIdx, channel].
+    Each cut has an "OK" array, False where there's no usable cut (that channel fails it for that calIdx).
+    """
+    nCal, nCh = len(calIdxList), len(chList)
+    cutPars = {
+        "calIdx": np.asarray(calIdxList), "runLo": np.zeros(nCal, dtype=int), "runHi": np.zeros(nCal, dtype=int),
+        "fs": np.zeros((nCal,nCh)), "fsOK": np.zeros((nCal,nCh), dtype=bool),
+        "rn": np.zeros((nCal,nCh,4)), "rnOK": np.zeros((nCal,nCh), dtype=bool),
+        "wf": np.zeros((nCal,nCh,8)), "wfOK": np.zeros((nCal,nCh), dtype=bool)
+        }
+    for i, calIdx in enumerate(calIdxList):
+
+        cutPars["runLo"][i] = cInfo.master["ds%d_m%d" % (dsNum, modNum)][calIdx][1]
+        cutPars["runHi"][i] = cInfo.master["ds%d_m%d" % (dsNum, modNum)][calIdx][2]
+
+        fsD = dsi.getDBRecord("fitSlo_ds%d_idx%d_m%d_Peak" % (dsNum, calIdx, modNum), False, calDB)
+        rnSD = dsi.getDBRecord("riseNoise_ds%d_idx%d_m%d_SoftPlus" % (dsNum, calIdx, modNum), False, calDB)
+        rnCD = dsi.getDBRecord("riseNoise_ds%d_idx%d_m%d_Continuum" % (dsNum, calIdx, modNum), False, calDB)
+        wfD = dsi.getDBRecord("wfstd_ds%d_idx%d_mod%d" % (dsNum, calIdx, modNum), False, calDB)
+
+        for j, ch in enumerate(chList):
+
+            # fitSlo: check the 90% value is positive
+            if fsD[ch][2] > 0:
+                cutPars["fs"][i,j] = roundLike(fsD[ch][2], "%.2f")
+                cutPars["fsOK"][i,j] = True
+
+            # riseNoise: check the softplus curvature is positive
+            if rnSD[ch][3] > 0:
+                cutPars["rn"][i,j] = [roundLike(max(rnSD[ch][0],rnCD[ch][4]),"%.3f"), roundLike(rnSD[ch][1],"%.5f"), roundLike(rnSD[ch][2],"%.3f"), roundLike(rnSD[ch][3],"%.3f")]
+                cutPars["rnOK"][i,j] = True
+
+            # wfStd: check if ralph says this is ok to use
+            if wfD!=0 and ch in wfD.keys() and wfD[ch][0]==u'y':
+                fmts = ["%.4e","%.4e","%.4e","%.2e","%.2e","%.4f","%.2f","%.3f"]
+                cutPars["wf"][i,j] = [roundLike(wfD[ch][k+3], fmts[k]) for k in range(8)]
+                cutPars["wfOK"][i,j] = True
+
+    return cutPars
+
+
+def GetCutStrings(cutPars, chList, cutType):
+    """ The TCut string equivalent to GetCutMasks, for each channel: {ch:"(run>=... && fitSlo<... || ...)"} """
+    cutDict = {}
+    for i in range(len(cutPars["calIdx"])):
+        runCut = "run>=%d && run<=%d" % (cutPars["runLo"][i], cutPars["runHi"][i])
+        for j, ch in enumerate(chList):
+            fsCut, rnCut, wfCut = None, None, None
+            if cutPars["fsOK"][i,j]:
+                fsCut = "fitSlo<%.2f" % cutPars["fs"][i,j]
+            if cutPars["rnOK"][i,j]:
+                rnCut = "riseNoise<(%.3f+%.5f*TMath::Log(1+TMath::Exp((trapENFCal-(%.3f))/%.3f)))" % tuple(cutPars["rn"][i,j])
+            if cutPars["wfOK"][i,j]:
+                wfCut = "abs(wfStd - sqrt((%.4e + %.4e*trapENFCal + %.4e*trapENFCal**2 + %.2e*pow(trapENFCal,3) + %.2e*pow(trapENFCal,4))**2 + %.4f)) < (%.2f+%.3f*trapENFCal)" % tuple(cutPars["wf"][i,j])
+
+            # set the combination channel cut
+            parts = {"fs":fsCut, "rn":rnCut, "wf":wfCut}
+            useCuts = [parts[c] for c in cutType.split("+")]
+            if None in useCuts: continue
+            chanCut = "(%s && %s)" % (runCut, " && ".join(useCuts))
+
+            # create dict entry for this channel or append to existing, taking care of parentheses and OR's.
+            if ch in cutDict.keys():
+                cutDict[ch] += " || %s" % chanCut
+            else:
+                cutDict[ch] = "(%s" % chanCut
+
+    # close the parens for each channel entry
+    for key in cutDict:
+        cutDict[key] += ")"
+    return cutDict
+
+
+def GetCutMasks(cutPars, chList, cutList, hitCh, hitGain, hitE, hitFS, hitRN, hitWF, hitRun):
+    """ Evaluate the channel cuts on per-hit columns (ex. from wl.GetDrawArrays).
+    Cal ranges can overlap, so like the TCut from GetCutStrings, a hit passes a cut combination if it
+    passes it for ANY calIdx whose run range covers it.  Each calIdx is one numpy expression per cut.
+    Returns {cutType: boolean mask}.  Same as the TCut from GetCutStrings, plus gain==0 (and fitSlo>0 for fs).
+    """
+    chArr = np.asarray(chList)
+    chOrder = np.argsort(chArr)
+    k = np.minimum(np.searchsorted(chArr[chOrder], hitCh), len(chArr)-1)
+    iCh = chOrder[k]
+    isGood = (chArr[iCh] == hitCh) & (hitGain == 0)
+
+    passMasks = {ct:np.zeros(len(hitCh), dtype=bool) for ct in cutList}
+    for i in range(len(cutPars["calIdx"])):
+        idx = np.flatnonzero(isGood & (hitRun >= cutPars["runLo"][i]) & (hitRun <= cutPars["runHi"][i]))
+        if len(idx) == 0: continue
+        jCh, e = iCh[idx], hitE[idx]
+
+        # fitSlo
+        fsPass = cutPars["fsOK"][i,jCh] & (hitFS[idx] > 0) & (hitFS[idx] < cutPars["fs"][i,jCh])
+
+        # riseNoise (softplus), log(1+exp(x)) = logaddexp(0,x)
+        rn = cutPars["rn"][i,jCh]
+        rnOK = cutPars["rnOK"][i,jCh]
+        rnD = np.where(rnOK, rn[:,3], 1.)
+        rnPass = rnOK & (hitRN[idx] < rn[:,0] + rn[:,1] * np.logaddexp(0, (e - rn[:,2]) / rnD))
+
+        # wfStd (polynomial)
+        wf = cutPars["wf"][i,jCh]
+        wfPoly = wf[:,0] + wf[:,1]*e + wf[:,2]*e**2 + wf[:,3]*e**3 + wf[:,4]*e**4
+        with np.errstate(invalid='ignore'): # nan fails, like in ROOT
+            wfPass = cutPars["wfOK"][i,jCh] & (np.abs(hitWF[idx] - np.sqrt(wfPoly**2 + wf[:,5])) < wf[:,6] + wf[:,7]*e)
+
+        cutPass = {"fs":fsPass, "rn":rnPass, "wf":wfPass}
+        for ct in cutList:
+            mask = np.ones(len(idx), dtype=bool)
+            for c in ct.split("+"): mask &= cutPass[c]
+            passMasks[ct][idx] |= mask
+    return passMasks
 
 
 if __name__ == "__main__":
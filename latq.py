@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+===================== latq.py =====================
+
+A local, file-based task queue for LAT, and a persistent worker.
+
+The worker imports lat.py (ROOT, SciPy, pywt), loads the templates,
+noise spectra and filters ONCE, then forks a child for each task.
+The children inherit everything that's already loaded, so a task
+starts in milliseconds instead of paying tens of seconds of
+interpreter and library start-up (and a crashing task can't take
+the worker down with it).
+
+A task is one lat.py command line, ex. from 'job-panda.py -q -lat'.
+Queue directory layout (default: ./jobs/latq):
+    pending/  one file per task
+    running/  claimed tasks.  Claiming is an atomic rename, so
+              several workers can share a queue w/o running a task twice.
+    done/  failed/
+    logs/     output of each task
+
+Put the queue on the shared project filesystem (ex. -q $LATDATADIR/latq)
+and start a worker on each node: nodes that finish early keep taking
+tasks instead of sitting idle.  No server or database is needed:
+  - Each claim is a lease.  The worker renews it (touches the task file)
+    every leaseSec/4 while the task runs.
+  - A lease that hasn't been renewed in leaseSec (the node died or hung)
+    is released: any worker moves the task back to pending/.
+  - A failed task goes back to pending/ until it has been tried maxTries
+    times, then to failed/.  Each attempt is recorded in the task file.
+  - A worker that finds its lease gone (released, or re-claimed by another
+    worker) kills the task, so two nodes don't write the same output.
+NOTE: lease ages use the file mtimes, so node clocks should agree to
+much better than leaseSec (default 600 sec).  A lease is checked again
+right before it's released, but a renewal can still land in between:
+then the owner finds it's lost the task at its next renewal and kills it.
+
+Usage:
+./latq.py [-q queueDir]
+          [-add [jobList] add each lat.py line of a job list as a task]
+          [-work [nProc] [idleSec] run tasks, nProc at a time, until
+                 nothing has been pending or running for idleSec (default 60)]
+          [-lease [leaseSec] [maxTries] set before -work (default 600, 3)]
+          [-status]
+          [-retry  move failed tasks back to pending]
+
+===================================================
+"""
+import sys, os, time, glob, shlex, signal, socket
+
+queueDir = "./jobs/latq"
+qSubDirs = ["pending", "running", "done", "failed", "logs"]
+leaseSec, maxTries = 600, 3
+
+def main(argv):
+
+    global queueDir, leaseSec, maxTries
+    if len(argv) == 0:
+        print(__doc__)
+        return
+    for i, opt in enumerate(argv):
+        if opt == "-q":
+            queueDir = argv[i+1]
+        if opt == "-lease":
+            leaseSec, maxTries = int(argv[i+1]), int(argv[i+2])
+    makeQueue(queueDir)
+
+    for i, opt in enumerate(argv):
+        if opt == "-add":
+            addTasks(argv[i+1])
+        if opt == "-work":
+            nProc = int(argv[i+1]) if i+1 < len(argv) and argv[i+1].isdigit() else 1
+            idleSec = int(argv[i+2]) if i+2 < len(argv) and argv[i+2].isdigit() else 60
+            runWorker(nProc, idleSec)
+        if opt == "-status":
+            printStatus()
+        if opt == "-retry":
+            retryFailed()
+
+
+def makeQueue(qDir):
+    for d in qSubDirs:
+        if not os.path.isdir("%s/%s" % (qDir, d)):
+            os.makedirs("%s/%s" % (qDir, d))
+
+
+def getTasks(state):
+    return sorted(glob.glob("%s/%s/*.task" % (queueDir, state)))
+
+
+def readTask(task):
+    """ A task file is the command, followed by a '#try' line for each attempt.  Returns [cmd, nTries]. """
+    with open(task) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    return lines[0], sum(1 for line in lines if line.startswith("#try"))
+
+
+def getWorkerID():
+    return "%s %d" % (socket.gethostname(), os.getpid())
+
+
+def isOwner(task):
+    """ True if this worker made the last claim of 'task' (and it's still in running/). """
+    try:
+        with open(task) as f:
+            tries = [line.strip() for line in f if line.startswith("#try")]
+    except (OSError, IOError):
+        return False
+    return len(tries) > 0 and tries[-1].split()[1:3] == getWorkerID().split()
+
+
+def addTasks(jobList):
+    """ Add each lat.py command in 'jobList' as a task.  Skips lines starting w/ '#',
+    non-LAT commands, and commands that are already pending or running.
+    Log redirects (ex. '>& ./logs/lat-ds1-5-0.txt') are dropped, the worker keeps its own logs.
+    """
+    queued = set()
+    for f in getTasks("pending") + getTasks("running"):
+        queued.add(readTask(f)[0])
+
+    nAdd, nSkip = 0, 0
+    with open(jobList) as f:
+        lines = [line.strip() for line in f]
+    for iL, line in enumerate(lines):
+        cmd = line.split(">")[0].strip()
+        if len(cmd) == 0 or cmd.startswith("#"): continue
+        if "lat.py" not in cmd.split()[0] or cmd in queued:
+            nSkip += 1
+            continue
+        name = "%s/pending/%d-%05d.task" % (queueDir, int(time.time()*1000), iL)
+        with open(name + ".tmp", "w") as tf: tf.write(cmd + "\n")
+        os.rename(name + ".tmp", name)
+        queued.add(cmd)
+        nAdd += 1
+    print("Added %d tasks to %s (skipped %d)" % (nAdd, queueDir, nSkip))
+
+
+def claimTask():
+    """ Move the oldest pending task to running/ and return its path (None if the queue is empty).
+    If another worker renames it first, try the next one.  The claim starts a new lease: the file
+    is touched before the rename (it keeps its mtime), so releaseExpired can't take it back right away. """
+    for f in getTasks("pending"):
+        claimed = "%s/running/%s" % (queueDir, os.path.basename(f))
+        try:
+            os.utime(f, None)
+            os.rename(f, claimed)
+            with open(claimed, "r+") as tf: # fails if it's gone: don't recreate it w/o the command
+                tf.seek(0, 2)
+                tf.write("#try %s %s\n" % (getWorkerID(), time.strftime('%X %x %Z')))
+        except (OSError, IOError):
+            continue
+        return claimed
+    return None
+
+
+def renewLeases(running):
+    """ Touch our running tasks ({pid:task}) so other workers know they're alive.
+    Returns the pids whose lease was lost (the task was released, or claimed by another worker). """
+    lost = []
+    for pid, task in running.items():
+        try:
+            if not isOwner(task): raise OSError
+            os.utime(task, None)
+        except OSError:
+            print("%s  lost lease, stopping  %s" % (time.strftime('%X'), os.path.basename(task)))
+            lost.append(pid)
+    return lost
+
+
+def releaseExpired():
+    """ Move running tasks whose lease is older than leaseSec back to pending/ (or failed/, after maxTries). """
+    for f in getTasks("running"):
+        try:
+            if time.time() - os.stat(f).st_mtime < leaseSec: continue
+        except OSError:
+            continue # someone else just moved it
+        releaseTask(f, "lease expired", leaseSec)
+
+
+def releaseTask(task, why, minAge=None):
+    """ Put a task back in pending/, or in failed/ if it's been tried maxTries times.
+    If 'minAge' is given, only if the lease still hasn't been renewed in that long. """
+    try:
+        nTries = readTask(task)[1]
+        state = "pending" if nTries < maxTries else "failed"
+        if minAge is not None and time.time() - os.stat(task).st_mtime < minAge:
+            return # renewed after all
+        os.rename(task, "%s/%s/%s" % (queueDir, state, os.path.basename(task)))
+        print("%s  %s (%s, try %d/%d)  %s" % (time.strftime('%X'), state, why, nTries, maxTries, os.path.basename(task)))
+    except (OSError, IOError, IndexError):
+        pass # another worker got to it first
+
+
+def finishTask(task, status):
+    if not isOwner(task):
+        print("%s  finished (status %d), but the lease was lost (it may run again)  %s" % (time.strftime('%X'), status, os.path.basename(task)))
+        return
+    if status != 0:
+        releaseTask(task, "exit status %d" % status)
+        return
+    try:
+        os.rename(task, "%s/done/%s" % (queueDir, os.path.basename(task)))
+        print("%s  done  %s" % (time.strftime('%X'), os.path.basename(task)))
+    except OSError:
+        print("%s  done, but the lease was lost (it may run again)  %s" % (time.strftime('%X'), os.path.basename(task)))
+
+
+def runWorker(nProc=1, idleSec=60):
+    """ ./latq.py -work [nProc] [idleSec]
+    Load LAT once, then run the pending tasks (a forked child each, up to nProc at a time).
+    """
+    global queueDir
+    latDir = os.environ['LATDIR']
+    queueAbs = os.path.abspath(queueDir)
+    os.chdir(latDir) # lat.py loads its style file and data from here
+
+    # everything the tasks share, loaded before the first fork
+    start = time.time()
+    import matplotlib
+    matplotlib.use('Agg')
+    sys.argv.append("-b") # ROOT batch mode
+    import lat
+    for ds in [1, 2]: lat.loadTemplate(ds)
+    lat.loadNoise()
+    lat.getFilters()
+    print("Worker %d ready, %.1f sec.  Queue: %s" % (os.getpid(), time.time()-start, queueAbs))
+
+    queueDir = queueAbs
+    running = {} # pid : task
+    lastBusy, lastRenew = time.time(), time.time()
+    while True:
+        # collect finished tasks
+        while running:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0: break
+            finishTask(running.pop(pid), status)
+            lastBusy = time.time()
+
+        # renew our leases (and stop the tasks we lost), and release the ones other workers abandoned
+        if time.time() - lastRenew > leaseSec/4.:
+            for pid in renewLeases(running):
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                running.pop(pid) # not ours anymore: no finishTask
+            releaseExpired()
+            lastRenew = time.time()
+
+        task = None
+        if len(running) < nProc:
+            task = claimTask()
+            if task is None:
+                releaseExpired() # nothing pending: pick up tasks of workers that died
+                task = claimTask()
+        if task is not None:
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                runTask(lat, task)
+            running[pid] = task
+            lastBusy = time.time()
+            continue
+
+        # other workers' tasks can still come back (failed, or lease expired), so wait them out too
+        if running or getTasks("running"):
+            lastBusy = time.time()
+        elif time.time() - lastBusy > idleSec:
+            break
+        time.sleep(0.5)
+    print("Queue empty for %d sec, worker %d exiting." % (idleSec, os.getpid()))
+
+
+def runTask(lat, task):
+    """ Used by runWorker (runs in the forked child, never returns).  Runs lat.main w/ the task's
+    arguments, w/ stdout and stderr going to logs/[task].txt.  Exit code 1 if lat.main raises.
+    """
+    argv = shlex.split(readTask(task)[0])[1:]
+    log = open("%s/logs/%s.txt" % (queueDir, os.path.basename(task).split(".")[0]), "w")
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    status = 0
+    try:
+        print("latq task:", " ".join(argv))
+        lat.main(argv)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status)
+
+
+def printStatus():
+    for state in ["pending", "running", "done", "failed"]:
+        print("%-8s %d" % (state, len(getTasks(state))))
+    now = time.time()
+    for f in getTasks("running"):
+        cmd, nTries = readTask(f)
+        print("  running: %s  try %d  lease age %d sec  %s" % (os.path.basename(f), nTries, now - os.stat(f).st_mtime, cmd))
+    for f in getTasks("failed"):
+        cmd, nTries = readTask(f)
+        print("  failed: %s  tries %d  %s" % (os.path.basename(f), nTries, cmd))
+
+
+def retryFailed():
+    """ Move failed tasks back to pending, w/ a fresh set of tries. """
+    tasks = getTasks("failed")
+    for f in tasks:
+        cmd, nTries = readTask(f)
+        with open(f, "w") as tf: tf.write(cmd + "\n")
+        os.rename(f, "%s/pending/%s" % (queueDir, os.path.basename(f)))
+    print("Moved %d failed tasks back to pending." % len(tasks))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+""" python3 -m pytest -q tests
+    Checks the DetInfo run-setting lookups against the original loop over each history.
+"""
+import os, sys
+import numpy as np
+
+swDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('LATDIR', swDir)
+os.environ.setdefault('LATDATADIR', swDir)
+sys.path.insert(0, swDir)
+import dsi
+
+
+def getDet():
+    """ DetInfo w/ just the run settings (the .npz has pickled dicts, newer numpy needs allow_pickle). """
+    det = dsi.DetInfo.__new__(dsi.DetInfo)
+    f = np.load("%s/data/runSettings-v2.npz" % swDir, allow_pickle=True)
+    det.detHV, det.detTH = f['arr_0'].item(), f['arr_1'].item()
+    det.setIdx = {}
+    return det
+
+
+def loopSetting(hist, run, default):
+    """ The original getHVAtRun/getTrapThreshAtRun: last entry in list order w/ r <= run. """
+    val = default
+    for r, v in hist:
+        if run >= r: val = v
+    return val
+
+
+def test_settingAtRunDS5():
+    det = getDet()
+
+    # unsorted histories, ex. DS5 cpd 121
+    assert det.getTrapThreshAtRun(5, 19125)['121'] == 1172
+
+    for opt, hists, default in [("hv", det.detHV[5], 0), ("th", det.detTH[5], -1)]:
+        allRuns = sorted(set(r for cpd in hists for r, v in hists[cpd]))
+        runs = np.unique(np.concatenate([allRuns, np.asarray(allRuns)-1, np.asarray(allRuns)+1]))
+        vals = det.getSettingAtRun(5, runs, opt, "cpd", default)
+        for cpd in hists:
+            if len(hists[cpd]) == 0: continue
+            expect = [loopSetting(hists[cpd], run, default) for run in runs]
+            assert list(vals[str(cpd)]) == expect, "DS5 %s cpd %s" % (opt, cpd)
+
+
+def test_calIdxArrayMatchesScalar():
+    """ Cal ranges overlap (ex. ds5_m1 idx 15/16): the array lookup must give the scalar answer. """
+    cal = dsi.CalInfo()
+    for key in cal.GetKeys():
+        lo, hi = cal.covLo[key], cal.covIdx[key]
+        runs = np.arange(lo.min()-2, hi.max()+3)
+        arr = cal.GetCalIdx(key, runs)
+        for run, idx in zip(runs, arr):
+            scalar = cal.GetCalIdx(key, int(run))
+            assert idx == (-1 if scalar is None else scalar), "%s run %d" % (key, run)
+
+
+def test_bkgIntervals():
+    """ The bkg run ranges are searched w/ searchIntervals, which needs non-overlapping ranges. """
+    bkg = dsi.BkgInfo()
+    for ds in bkg.master:
+        for sub in bkg.master[ds]:
+            run = bkg.master[ds][sub][0]
+            assert bkg.GetBkgIdx(ds, run) == sub
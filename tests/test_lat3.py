@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+""" python3 -m pytest -q tests
+    Checks the numpy channel cuts (lat3.GetCutMasks) against the TCut strings (lat3.GetCutStrings).
+"""
+import os, sys
+import numpy as np
+
+swDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('LATDIR', swDir)
+os.environ.setdefault('LATDATADIR', swDir)
+sys.path.insert(0, swDir)
+import dsi
+
+
+def getCutFuncs():
+    """ lat3.py is python 2 and needs ROOT, so just load the (numpy only) cut functions from its source. """
+    src = open("%s/lat3.py" % swDir).read()
+    src = src[src.index("def roundLike("):src.index('if __name__ == "__main__":')]
+    ns = {"np":np, "dsi":dsi}
+    exec(src, ns)
+    return ns
+
+
+def evalCutString(cut, hit):
+    """ Evaluate a TCut string from GetCutStrings for one hit. """
+    expr = cut.replace("&&"," and ").replace("||"," or ").replace("TMath::Log","np.log").replace("TMath::Exp","np.exp")
+    expr = expr.replace("pow(","np.power(").replace("sqrt(","np.sqrt(")
+    return bool(eval(expr, {"np":np}, dict(hit)))
+
+
+def getCutPars(ns, rng):
+    """ Synthetic cut pars, w/ overlapping cal ranges and some unusable cuts. """
+    runLo, runHi = [100, 105, 105, 130, 120], [110, 108, 125, 140, 150]
+    nCal, nCh = len(runLo), 3
+    fsOK, rnOK, wfOK = [rng.rand(nCal, nCh) > 0.2 for i in range(3)]
+    rl = ns["roundLike"]
+    fmts = ["%.4e","%.4e","%.4e","%.2e","%.2e","%.4f","%.2f","%.3f"]
+    return {
+        "calIdx": np.arange(nCal), "runLo": np.asarray(runLo), "runHi": np.asarray(runHi),
+        "fs": np.vectorize(lambda x: rl(x, "%.2f"))(rng.uniform(50, 150, (nCal,nCh))), "fsOK": fsOK,
+        "rn": np.stack([np.vectorize(lambda x: rl(x, f))(rng.uniform(a, b, (nCal,nCh)))
+            for f, a, b in [("%.3f",1,3), ("%.5f",0.001,0.01), ("%.3f",5,20), ("%.3f",1,5)]], axis=-1), "rnOK": rnOK,
+        "wf": np.stack([np.vectorize(lambda x: rl(x, f))(rng.uniform(a, b, (nCal,nCh)))
+            for f, a, b in zip(fmts, [1,0,0,0,0,0,0.5,0], [2,0.01,1e-4,1e-7,1e-10,1,1,0.01])], axis=-1), "wfOK": wfOK
+        }
+
+
+def test_cutMasksMatchStrings():
+    ns = getCutFuncs()
+    rng = np.random.RandomState(1)
+    chList = [584, 592, 608]
+    cutPars = getCutPars(ns, rng)
+    cutList = ["fs", "rn", "wf", "fs+rn", "fs+wf", "fs+rn+wf"]
+
+    nHit = 3000
+    hits = {
+        "channel": rng.choice(chList + [600], nHit), "gain": (rng.rand(nHit) > 0.9).astype(int),
+        "trapENFCal": rng.uniform(0, 50, nHit), "fitSlo": rng.uniform(-10, 200, nHit),
+        "riseNoise": rng.uniform(0, 4, nHit), "wfStd": rng.uniform(0, 3, nHit), "run": rng.randint(95, 155, nHit)
+        }
+    cols = [hits[v] for v in ["channel","gain","trapENFCal","fitSlo","riseNoise","wfStd","run"]]
+    masks = ns["GetCutMasks"](cutPars, chList, cutList, *cols)
+
+    nCover = 0
+    for ct in cutList:
+        cutDict = ns["GetCutStrings"](cutPars, chList, ct)
+        for iH in range(nHit):
+            hit = {v:hits[v][iH] for v in hits}
+            ch = hit["channel"]
+            expect = hit["gain"] == 0 and ch in cutDict and evalCutString(cutDict[ch], hit)
+            if "fs" in ct: expect = expect and hit["fitSlo"] > 0
+            assert masks[ct][iH] == expect, "%s hit %d run %d ch %d" % (ct, iH, hit["run"], ch)
+            nCover += expect and sum((hit["run"] >= lo) & (hit["run"] <= hi) for lo, hi in zip(cutPars["runLo"], cutPars["runHi"])) > 1
+
+    # make sure the overlaps were exercised
+    assert nCover > 0